@@ -1,37 +1,237 @@
-from flask import Flask, jsonify, make_response, abort, request
+from flask import Flask, Response, jsonify, make_response, abort, request, g
 import yaml
+import json
 import os
 import random
 import string
+import time
+import threading
+import atexit
 from datetime import datetime, timedelta
-from lib.sqlite import SQLite
+from lib.sqlite import SQLitePool, PoolTimeout
+from lib.cache import TTLCache
+from lib.trie import PrefixTrie
+from lib.ring import HotWindow
+from lib.lib import monotonic
+from lib.metrics import REGISTRY, render, read_snapshots
+import lib.schema as schema
 
 app = Flask(__name__)
 
+# Pool of database connections shared by the requests, created by init_app
+pool = None
+
+# Table of every monitoring type served by get_last
+MON_TABLES = {'ping': 'ping_table', 'tcp': 'tcp_table'}
+
+# Last rows of every table of MON_TABLES kept in memory (lib.ring.HotWindow), created by init_app
+hot_windows = {}
+
+# Expiration of the tokens already validated, avoids a database query per request
+token_cache = TTLCache(max_size=10000, ttl=60)
+
+# Token expiration refreshes waiting to be written to the database, only the last one of every token is written
+pending_expirations = {}
+pending_lock = threading.Lock()
+last_expiration_flush = time.time()
+expiration_flush_interval = 5
+
+# Snapshots of the metrics written by the scheduler processes, served on /metrics with the ones of the API
+metrics_dir = None
+metrics_max_age = 300
+REQUEST_SECONDS = REGISTRY.histogram('monitor_api_request_seconds', 'Time to answer a request', ('endpoint',))
+
+# Trie of the prefixes announced, rebuilt from bgp_prefix_table when it expires
+prefix_trie = TTLCache(max_size=1, ttl=60)
+prefix_trie_lock = threading.Lock()
+
+
+def parse_expiration(expiration):
+    """ Expiration datetime as stored by sqlite3, with or without microseconds """
+    if isinstance(expiration, datetime):
+        return expiration
+    try:
+        return datetime.strptime(expiration, '%Y-%m-%d %H:%M:%S.%f')
+    except ValueError:
+        return datetime.strptime(expiration, '%Y-%m-%d %H:%M:%S')
+
+
+def get_token_expiration(token):
+    """ Expiration of the token from the cache or the database, None if the token does not exist """
+    expiration = token_cache.get(token)
+    if expiration is not None:
+        return expiration
+
+    with pending_lock:
+        expiration = pending_expirations.get(token)
+
+    if expiration is None:
+        # Query to check if token is valid
+        sql = '''SELECT expiration FROM tokens_table WHERE token=?'''
+        with pool.connection() as d:
+            resp = d.query(sql, (token,))
+
+        if len(resp) == 0:
+            return None
+        expiration = parse_expiration(resp[0][0])
+
+    token_cache.set(token, expiration)
+    return expiration
+
+
+def refresh_token(token):
+    """ Extend the expiration of the token, written to the database by flush_expirations """
+    expiration = datetime.utcnow() + timedelta(minutes=token_timeout)
+    token_cache.set(token, expiration)
+    with pending_lock:
+        pending_expirations[token] = expiration
+    flush_expirations()
+
+
+def flush_expirations(force=False):
+    """ Write the pending expirations every expiration_flush_interval seconds in a single transaction, they are
+    written again by the next flush if it fails """
+    global last_expiration_flush
+
+    with pending_lock:
+        if len(pending_expirations) == 0:
+            return
+        if not force and time.time() - last_expiration_flush < expiration_flush_interval:
+            return
+        rows = [(expiration, token) for token, expiration in pending_expirations.items()]
+        last_expiration_flush = time.time()
+
+    # Update the expiration datetime for the tokens
+    sql = '''UPDATE tokens_table SET expiration = ? WHERE token = ?'''
+    with pool.connection() as d:
+        for row in rows:
+            d.query(sql, row)
+        d.commit()
+
+    # The expirations stay pending until they are committed, unless the token was refreshed again meanwhile
+    with pending_lock:
+        for expiration, token in rows:
+            if pending_expirations.get(token) == expiration:
+                del pending_expirations[token]
+
+
+def get_prefix_trie():
+    """ Trie of the prefixes announced, built once every prefix_trie_ttl seconds """
+    trie = prefix_trie.get('trie')
+    if trie is None:
+        with prefix_trie_lock:
+            trie = prefix_trie.get('trie')
+            if trie is None:
+                with pool.connection() as d:
+                    trie = PrefixTrie.from_db(d)
+                prefix_trie.set('trie', trie)
+    return trie
+
+
+def require_token():
+    """ Abort the request unless it has a valid token, returns the token """
+    token = request.headers.get('token')
+
+    # If no token on the request header abort
+    if token is None:
+        abort(make_response(jsonify(error="Unauthorized, Token not present"), 401))
+
+    # Continue if token is present, check if token is valid
+    expiration = get_token_expiration(token)
+    if expiration is None or datetime.utcnow() >= expiration:
+        abort(make_response(jsonify(error="Unauthorized, Token not valid"), 401))
+    return token
+
+
+def create_tables(db):
+    """ Create the tables used by the API, run once at startup """
+    for table_name in ('tokens_table', 'ping_table', 'tcp_table', 'bgp_table', 'bgp_prefix_table'):
+        schema.create_table(db, table_name)
+
+
+def init_app(yaml_file):
+    """ Load the configuration and open the database pool, once at startup """
+    global db_name, token_timeout, token_cache, expiration_flush_interval, pool, prefix_trie, hot_windows
+    global metrics_dir, metrics_max_age
+
+    # Load the config.yaml file
+    with open(yaml_file, 'r') as f:
+        config = yaml.load(f)
+
+    db_name = os.path.join(os.path.dirname(os.path.abspath(yaml_file)), config['db_name'])
+
+    token_timeout = config['api']['token_timeout']
+
+    token_cache = TTLCache(max_size=config['api'].get('token_cache_size', 10000),
+                           ttl=config['api'].get('token_cache_ttl', 60))
+
+    expiration_flush_interval = config['api'].get('expiration_flush_interval', 5)
+
+    prefix_trie = TTLCache(max_size=1, ttl=config['api'].get('prefix_trie_ttl', 60))
+
+    pool = SQLitePool(db_name, size=config['api'].get('db_pool_size', 8), setup=create_tables,
+                      timeout=config['api'].get('db_pool_timeout', 10))
+
+    # Fill the windows of the last rows from the database, a size of 0 disables them
+    hot_windows = {}
+    window_size = config['api'].get('hot_window_size', 1000)
+    if window_size > 0:
+        with pool.connection() as d:
+            for table_name in MON_TABLES.values():
+                hot_windows[table_name] = HotWindow(d, table_name, capacity=window_size,
+                                                    refresh_interval=config['api'].get('hot_window_refresh', 1))
+
+    metrics_config = config.get('metrics') or {}
+    if metrics_config.get('dir'):
+        metrics_dir = os.path.join(os.path.dirname(os.path.abspath(yaml_file)), metrics_config['dir'])
+    metrics_max_age = metrics_config.get('max_age', 300)
+
+    # Write the pending token expirations on exit
+    atexit.register(flush_expirations, True)
+
+    app.secret_key = config['api']['secret_key']
+    return config
+
+
+@app.before_request
+def start_timer():
+    g.request_start = monotonic()
+
+
+@app.after_request
+def observe_request(response):
+    start = g.get('request_start')
+    if start is not None:
+        # Streamed bodies like the one of get_last are sent after this, the request ends when the response closes
+        endpoint = request.endpoint or 'unknown'
+        response.call_on_close(lambda: REQUEST_SECONDS.labels(endpoint).observe(monotonic() - start))
+    return response
+
 
 @app.errorhandler(404)
 def page_not_found(error):
     return make_response(jsonify({'error': error.description}), 404)
 
 
+@app.errorhandler(PoolTimeout)
+def pool_timeout(error):
+    return make_response(jsonify({'error': "Service unavailable, the database is busy"}), 503)
+
+
 @app.route('/api/v1.0/get_token', methods=['POST'])
 def get_token():
     # Create the Token
     token = ''.join(random.SystemRandom().choice(
         string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(48))
 
-    # Create table if does not exists
-    d = SQLite(db_name)
-    d.create_table('tokens_table', ('id integer PRIMARY KEY', 'token TEXT', 'expiration DATETIME'))
-
     # Insert token in table
-    d.insert('tokens_table', (token, datetime.utcnow() + timedelta(minutes=token_timeout)))
-
-    # Close the database
-    d.close()
+    expiration = datetime.utcnow() + timedelta(minutes=token_timeout)
+    with pool.connection() as d:
+        d.insert('tokens_table', (token, expiration))
+    token_cache.set(token, expiration)
 
     # Return JSON response
-    return jsonify({'date': datetime.utcnow(), 'token': token, 'expiration': datetime.utcnow() + timedelta(minutes=token_timeout)})
+    return jsonify({'date': datetime.utcnow(), 'token': token, 'expiration': expiration})
 
 
 @app.route('/api/v1.0/test_token', methods=['GET'])
@@ -40,19 +240,12 @@ def test_token():
     if token is None:
         abort(make_response(jsonify(error="Unauthorized"), 401))
     else:
-        # Create table if does not exists
-        d = SQLite(db_name)
-        d.create_table('tokens_table', ('id integer PRIMARY KEY', 'token text', 'expiration DATETIME'))
-
-        # Query to check if token is valid
-        sql = '''SELECT * FROM tokens_table WHERE token=?'''
-        resp = d.query(sql, (token,))
-
-        # Close Database
-        d.close()
+        expiration = get_token_expiration(token)
+        if expiration is None:
+            abort(make_response(jsonify(error="Unauthorized"), 401))
 
         # Check if token is valid
-        if datetime.utcnow() >= datetime.strptime(resp[0][2], '%Y-%m-%d %H:%M:%S.%f'):
+        if datetime.utcnow() >= expiration:
             return jsonify({'date': datetime.now(), 'token': token, 'status': 'Token is Expired!'})
         else:
             return jsonify({'date': datetime.now(), 'token': token, 'status': 'Token is valid'})
@@ -61,92 +254,101 @@ def test_token():
 @app.route('/api/v1.0/get_last/<mon_type>', defaults={'n': 1}, methods=['GET'])
 @app.route('/api/v1.0/get_last/<mon_type>/<int:n>', methods=['GET'])
 def get_last(mon_type, n):
-    # Get the Token on the request
-    token =request.headers.get('token')
+    token = require_token()
 
-    # If no token on the request header abort
-    if token is None:
-        abort(make_response(jsonify(error="Unauthorized, Token not present"), 401))
-
-    # Continue if token is present
-    g = SQLite(db_name)
-    g.create_table('tokens_table', ('id integer PRIMARY KEY', 'token text', 'expiration DATETIME'))
-
-    # Query to check if token is valid
-    sql = '''SELECT * FROM tokens_table WHERE token=?'''
-    resp = g.query(sql, (token,))
-
-    # Check if token is valid
-    if datetime.utcnow() >= datetime.strptime(resp[0][2], '%Y-%m-%d %H:%M:%S.%f'):
-        # Close Database
-        g.close()
-
-        abort(make_response(jsonify(error="Unauthorized, Token not valid"), 401))
-
-    if mon_type == 'ping':
-        g.create_table('ping_table', ('id integer PRIMARY KEY', 'created_at DATE', 'version integer', 'dst_ip text',
-                                      'rtt real', 'pkt_sent integer', 'pkt_loss integer'))
-        columns = g.get_columns_from_table('ping_table')
-        last_data = g.get_last_n('ping_table', n)
-
-        # Close Database
-        g.close()
-
-        result = []
-        for l in last_data:
-            data = {}
-            i = 0
-            for v in l:
-                data[columns[i]] = v
-                i += 1
-            result.append(data)
-    elif mon_type == 'tcp':
-        g = SQLite(db_name)
-        g.create_table('tcp_table', ('id integer PRIMARY KEY', 'created_at DATE', 'version integer', 'url text',
-                                  'response_code integer'))
-        columns = g.get_columns_from_table('tcp_table')
-        last_data = g.get_last_n('tcp_table', n)
-
-        # Close Database
-        g.close()
-
-        result = []
-        for l in last_data:
-            data = {}
-            i = 0
-            for v in l:
-                data[columns[i]] = v
-                i += 1
-            result.append(data)
-    else:
+    if mon_type not in MON_TABLES:
         abort(make_response(jsonify(error="Type %s does not exist, only ping or tcp" % mon_type), 400))
 
-    # Create table if does not exists
-    d = SQLite(db_name)
-    d.create_table('tokens_table', ('id integer PRIMARY KEY', 'token text', 'expiration DATETIME'))
+    # Pagination, rows older than after_id
+    after_id = request.args.get('after_id', type=int)
+    if after_id is None and request.args.get('after_id') is not None:
+        abort(make_response(jsonify(error="after_id should be an integer"), 400))
 
     # Update the expiration datetime for the token
-    sql = '''UPDATE tokens_table SET expiration = ? WHERE token = ?'''
-    resp = d.query(sql, (datetime.utcnow() + timedelta(minutes=token_timeout), token))
-
-    # Close Database
-    d.close()
-
-    return jsonify(result)
+    refresh_token(token)
+
+    # Answer from memory when the window holds all the rows asked
+    window = hot_windows.get(MON_TABLES[mon_type])
+    if window is not None:
+        if window.stale:
+            with pool.connection() as d:
+                window.refresh(d)
+        rows = window.rows(n, after_id)
+        if rows is not None:
+            return Response(json.dumps([dict(zip(window.columns, row)) for row in rows], default=str),
+                            mimetype='application/json')
+
+    return Response(stream_last(MON_TABLES[mon_type], n, after_id), mimetype='application/json')
+
+
+def read_last(table_name, n, after_id):
+    """ Columns and list of the last n rows of the table older than after_id, the connection is returned at once """
+    with pool.connection() as d:
+        columns, rows = d.iter_last_n(table_name, n, after_id)
+        return columns, list(rows)
+
+
+def stream_last(table_name, n, after_id, batch_size=500):
+    """ Generator of the JSON list of the last n rows of the table, the id of the last row is the after_id of the
+    next page. The rows are read batch_size at a time and the connection goes back to the pool before they are
+    sent, a slow client does not hold it. The first batch is read before the response starts, so a busy pool is
+    still answered with a 503 """
+    columns, rows = read_last(table_name, min(n, batch_size), after_id)
+
+    def generate(rows):
+        yield '['
+        separator = ''
+        left = n
+        while True:
+            for row in rows:
+                yield separator + json.dumps(dict(zip(columns, row)), default=str)
+                separator = ','
+            left -= len(rows)
+            if left <= 0 or len(rows) < batch_size:
+                break
+            # The next batch starts below the id, the first column, of the last row sent
+            rows = read_last(table_name, min(left, batch_size), rows[-1][0])[1]
+        yield ']'
+
+    return generate(rows)
+
+
+@app.route('/api/v1.0/bgp_coverage', methods=['GET'])
+def bgp_coverage():
+    """ Most specific prefix announced covering every address (or prefix) of the request, only among the ones of
+    autonomous_system when given """
+    token = require_token()
+
+    addresses = request.args.getlist('address')
+    if len(addresses) == 0:
+        abort(make_response(jsonify(error="At least one address is needed"), 400))
+    autonomous_system = request.args.get('autonomous_system')
+
+    refresh_token(token)
+
+    trie = get_prefix_trie()
+    results = []
+    for address in addresses:
+        try:
+            match = trie.longest_match(address, autonomous_system)
+        except ValueError as e:
+            abort(make_response(jsonify(error=str(e)), 400))
+        results.append({'address': address, 'covered': match is not None,
+                        'prefix': match[0] if match else None,
+                        'autonomous_systems': sorted(match[1]) if match else []})
+
+    return jsonify({'date': datetime.utcnow(), 'results': results})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """ Metrics of the API and of the scheduler processes in the Prometheus text format, without a token so
+    Prometheus can scrape them """
+    snapshots = [('api', REGISTRY.snapshot())] + read_snapshots(metrics_dir, max_age=metrics_max_age)
+    return Response(render(snapshots), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
-    yaml_file = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config.yaml')
-
-    # Load the config.yaml file
-    with open(yaml_file, 'r') as f:
-        config = yaml.load(f)
-
-    global db_name
-    db_name = os.path.join(os.path.dirname(os.path.dirname(__file__)), config['db_name'])
+    config = init_app(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.yaml'))
 
-    global token_timeout
-    token_timeout = config['api']['token_timeout']
-
-    app.secret_key = config['api']['secret_key']
-    app.run(host=config['api']['host'], debug=config['api']['debug'])
\ No newline at end of file
+    app.run(host=config['api']['host'], debug=config['api']['debug'], threaded=True)
@@ -0,0 +1,38 @@
+""" Benchmark of the RESTApi routes with the Flask test client, on the database of benchmarks.bench_storage
+
+Run from the repository root: python -m benchmarks.suite -k api
+"""
+import os
+import yaml
+import RESTApi as api
+from benchmarks.harness import populate
+
+NAMES = ('api test_token', 'api get_last ping 100 ring', 'api get_last ping 100 sqlite', 'api get_last tcp 1 ring')
+
+
+def cases(options):
+    """ Cases of benchmarks.suite, the API serves the database of options.rows results in options.workdir """
+    db_name = os.path.join(options.workdir, 'bench.db')
+    populate(db_name, options.rows)
+
+    yaml_file = os.path.join(options.workdir, 'config.yaml')
+    with open(yaml_file, 'w') as f:
+        yaml.safe_dump({'db_name': 'bench.db', 'api': {'host': '127.0.0.1', 'debug': False, 'secret_key': 'bench',
+                                                       'token_timeout': 60}}, f)
+    api.init_app(yaml_file)
+
+    client = api.app.test_client()
+    headers = {'token': client.post('/api/v1.0/get_token').get_json()['token']}
+    windows = api.hot_windows
+
+    def get_last(path, hot_windows):
+        api.hot_windows = hot_windows
+        response = client.get(path, headers=headers)
+        response.get_data()
+        if response.status_code != 200:
+            raise AssertionError("%s returned %i" % (path, response.status_code))
+
+    return [('api test_token', lambda: client.get('/api/v1.0/test_token', headers=headers), 2000),
+            ('api get_last ping 100 ring', lambda: get_last('/api/v1.0/get_last/ping/100', windows), 1000),
+            ('api get_last ping 100 sqlite', lambda: get_last('/api/v1.0/get_last/ping/100', {}), 1000),
+            ('api get_last tcp 1 ring', lambda: get_last('/api/v1.0/get_last/tcp', windows), 2000)]
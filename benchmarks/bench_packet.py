@@ -0,0 +1,101 @@
+""" Micro benchmark of the ICMP echo request building
+
+Run from the repository root: python -m benchmarks.bench_packet, its cases are also part of benchmarks.suite
+"""
+import socket
+import struct
+import timeit
+import argparse
+from lib.packet import EchoTemplate, checksum, make_payload
+
+MOD = 1 << 16
+
+NAMES = ('packet build 48B', 'packet checksum 1400B')
+
+
+def ones_comp_add16(num1, num2):
+    result = num1 + num2
+    return result if result < MOD else (result + 1) % MOD
+
+
+def legacy_calculate_checksum(icmp_packet):
+    """ Checksum as it was computed by pingv4.py, kept as the baseline """
+    hex_packet = "".join("%02x" % b for b in bytearray(icmp_packet))
+
+    hex_packet_list = []
+    for i in range(0, len(hex_packet), 4):
+        if i == 4:
+            hex_packet_list.append('0000')
+        else:
+            hex_packet_list.append(hex_packet[i:i+4])
+
+    sum = ones_comp_add16(int(hex_packet_list[0], 16), int(hex_packet_list[1], 16))
+    for word in hex_packet_list[2:]:
+        sum = ones_comp_add16(sum, int(word, 16))
+
+    return 65535 - sum
+
+
+def legacy_build(id, sequence):
+    """ Echo request as it was built by threaded_sender """
+    header = struct.pack('bbHHh', 8, 0, 0, id, sequence)
+    data = bytes(bytearray(i for i in range(65, 65 + 48)))
+    checksum = legacy_calculate_checksum(header + data)
+    header = struct.pack('bbHHh', 8, 0, socket.htons(checksum), id, sequence)
+    return header + data
+
+
+def verify(template):
+    """ The new builder must produce exactly the same packets as the legacy one """
+    for id, sequence in [(0, 1), (1234, 1), (65535, 2), (4321, 32767)]:
+        if template.build(id, sequence) != legacy_build(id, sequence):
+            raise AssertionError("Packet mismatch for id %i sequence %i" % (id, sequence))
+        if checksum(template.build(id, sequence)) != 0:
+            raise AssertionError("Invalid checksum for id %i sequence %i" % (id, sequence))
+
+
+def cases(options):
+    """ Cases of benchmarks.suite: building an echo request and checksumming a large one """
+    template = EchoTemplate()
+    verify(template)
+    big = bytes(bytearray(8)) + make_payload(1400)
+    return [('packet build 48B', lambda: template.build(1234, 42), 100000),
+            ('packet checksum 1400B', lambda: checksum(big), 20000)]
+
+
+def rate(func, number):
+    """ Packets per second of func, best of 3 """
+    return number / min(timeit.repeat(func, number=number, repeat=3))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="number", help="Specify the number of packets per round", action="store",
+                        default=20000)
+    parser.add_argument("-l", dest="size", help="Specify the custom payload size in bytes", action="store",
+                        default=1400)
+
+    args = parser.parse_args()
+    number = int(args.number)
+
+    template = EchoTemplate()
+    verify(template)
+
+    counter = {'seq': 0}
+
+    def next_seq():
+        counter['seq'] = counter['seq'] % 32767 + 1
+        return counter['seq']
+
+    before = rate(lambda: legacy_build(1234, next_seq()), number)
+    after = rate(lambda: template.build(1234, next_seq()), number)
+    print("48 bytes payload, legacy builder:   %12.0f packets/s" % before)
+    print("48 bytes payload, echo template:    %12.0f packets/s (x%0.1f)" % (after, after / before))
+
+    payload = make_payload(int(args.size))
+    big = bytes(bytearray(8)) + payload
+    before = rate(lambda: legacy_calculate_checksum(big), number // 10)
+    after = rate(lambda: checksum(big), number // 10)
+    print("%i bytes payload, legacy checksum: %12.0f checksums/s" % (len(payload), before))
+    print("%i bytes payload, array checksum:  %12.0f checksums/s (x%0.1f)" % (len(payload), after, after / before))
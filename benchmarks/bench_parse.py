@@ -0,0 +1,151 @@
+""" Micro benchmark of the IPv4/ICMPv4 header parsing of the receive path
+
+Run from the repository root: python -m benchmarks.bench_parse, its cases are also part of benchmarks.suite
+"""
+import socket
+import struct
+import timeit
+import argparse
+from ctypes import Structure, c_ubyte, c_ushort, c_uint32
+from lib.lib import IP, ICMPv4
+from lib.packet import EchoTemplate
+from lib.ping import PingEngine
+
+NAMES = ('parse header views', 'parse source filter', 'ping engine match reply')
+
+
+class LegacyIP(Structure):
+    """ ctypes header as it was defined in lib.lib, kept as the baseline """
+    _fields_ = [
+        ("ihl", c_ubyte, 4),
+        ("version", c_ubyte, 4),
+        ("tos", c_ubyte),
+        ("len", c_ushort),
+        ("id", c_ushort),
+        ("flags", c_ushort),
+        ("ttl", c_ubyte),
+        ("protocol_num", c_ubyte),
+        ("sum", c_ushort),
+        ("src", c_uint32),
+        ("dst", c_uint32)
+    ]
+
+    def __new__(self, socket_buffer=None):
+        return self.from_buffer_copy(socket_buffer)
+
+    def __init__(self, socket_buffer=None):
+        self.protocol_map = {6: "TCP", 17: "UDP", 1: "ICMP"}
+        self.src_address = socket.inet_ntoa(struct.pack("<L", self.src))
+        self.dst_address = socket.inet_ntoa(struct.pack("<L", self.dst))
+        self.ttl = self.ttl
+        try:
+            self.protocol = self.protocol_map[self.protocol_num]
+        except:
+            self.protocol = str(self.protocol_num)
+
+
+class LegacyICMPv4(Structure):
+    """ ctypes header as it was defined in lib.lib, kept as the baseline """
+    _fields_ = [
+        ("icmp_type", c_ubyte),
+        ("icmp_code", c_ubyte),
+        ("checksum", c_ushort),
+        ("id", c_ushort),
+        ("sequence", c_ushort)
+    ]
+
+    def __new__(self, socket_buffer):
+        return self.from_buffer_copy(socket_buffer)
+
+    def __init__(self, socket_buffer):
+        self.icmp_type = self.icmp_type
+        self.icmp_code = self.icmp_code
+        self.checksum = struct.unpack(">H", struct.pack("<H", self.checksum))[0]
+        self.id_le = self.id
+        self.id_be = struct.unpack(">H", struct.pack("<H", self.id))[0]
+        self.sequence_le = self.sequence
+        self.sequence_be = struct.unpack(">H", struct.pack("<H", self.sequence))[0]
+
+
+def make_reply(src_ip, id, sequence, ttl=64):
+    """ Synthetic echo reply as returned by a raw socket: IPv4 header followed by the ICMP packet """
+    icmp = bytearray(EchoTemplate().build(id, sequence))
+    # Turn the request into a reply, the checksum does not matter for the parsing
+    icmp[0] = 0
+    ip_header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(icmp), 1, 0, ttl, socket.IPPROTO_ICMP, 0,
+                            socket.inet_aton(src_ip), socket.inet_aton('192.0.2.1'))
+    return ip_header + bytes(icmp)
+
+
+def legacy_parse(data):
+    ip_header = LegacyIP(data[0:20])
+    icmp_header = LegacyICMPv4(data[20:29])
+    return ip_header.src_address, ip_header.ttl, icmp_header.icmp_type, icmp_header.id_le, icmp_header.sequence_le
+
+
+def view_parse(data):
+    buf = memoryview(data)
+    ip_header = IP(buf)
+    icmp_header = ICMPv4(buf, ip_header.header_length)
+    return ip_header.src_address, ip_header.ttl, icmp_header.icmp_type, icmp_header.id_le, icmp_header.sequence_le
+
+
+def legacy_filter(data):
+    return LegacyIP(data[0:20]).src_address == '203.0.113.9'
+
+
+def view_filter(data):
+    return IP(data).src == FILTER_ADDR
+
+
+FILTER_ADDR = socket.inet_aton('203.0.113.9')
+
+
+def cases(options):
+    """ Cases of benchmarks.suite: header parsing and matching a reply against the requests in flight """
+    data = make_reply('198.51.100.7', 1234, 42)
+
+    # The engine only reads the replies given to process_reply, it does not need a socket
+    engine = PingEngine(None, 1234, count=1, timeout=3600)
+    engine.logger.disabled = True
+    for i in range(100):
+        engine.add_target('198.51.100.7')
+    buffer = bytearray(data)
+
+    def match_reply():
+        engine.in_flight.add(1234, 42, engine.targets[0], 0)
+        engine.process_reply(buffer, 0.001, len(data))
+
+    return [('parse header views', lambda: view_parse(data), 100000),
+            ('parse source filter', lambda: view_filter(data), 100000),
+            ('ping engine match reply', match_reply, 100000)]
+
+
+def rate(func, number):
+    """ Packets per second of func, best of 5 """
+    return number / min(timeit.repeat(func, number=number, repeat=5))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="number", help="Specify the number of packets per round", action="store",
+                        default=50000)
+
+    args = parser.parse_args()
+    number = int(args.number)
+
+    data = make_reply('198.51.100.7', 1234, 42)
+    if legacy_parse(data) != view_parse(data):
+        raise AssertionError("Parsed fields mismatch: %r != %r" % (legacy_parse(data), view_parse(data)))
+
+    before = rate(lambda: legacy_parse(data), number)
+    after = rate(lambda: view_parse(data), number)
+    print("full parse, ctypes headers:    %10.0f packets/s" % before)
+    print("full parse, header views:      %10.0f packets/s (x%0.1f)" % (after, after / before))
+
+    # Flood of packets that are not ours, only the source address is needed to drop them
+    before = rate(lambda: legacy_filter(data), number)
+    after = rate(lambda: view_filter(data), number)
+    print("source filter, ctypes headers: %10.0f packets/s" % before)
+    print("source filter, header views:   %10.0f packets/s (x%0.1f)" % (after, after / before))
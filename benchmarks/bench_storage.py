@@ -0,0 +1,48 @@
+""" Benchmark of the SQLite storage paths on a database of synthetic results
+
+Run from the repository root: python -m benchmarks.suite -k sqlite
+"""
+import datetime
+import json
+import os
+import lib.sqlite as db
+import lib.schema as schema
+from lib.ring import HotWindow
+from benchmarks.harness import populate
+
+NAMES = ('sqlite insert', 'sqlite insert_many 100 rows', 'sqlite buffered_insert', 'sqlite get_last json 100 rows',
+         'ring get_last json 100 rows', 'sqlite get_range 1 hour')
+
+
+def get_last_json(p, table_name, n):
+    """ JSON of the last n rows built like RESTApi.stream_last """
+    columns, rows = p.iter_last_n(table_name, n)
+    return '[' + ','.join(json.dumps(dict(zip(columns, row)), default=str) for row in rows) + ']'
+
+
+def cases(options):
+    """ Cases of benchmarks.suite, the database of options.rows results is created in options.workdir """
+    db_name = os.path.join(options.workdir, 'bench.db')
+    populate(db_name, options.rows)
+
+    p = db.SQLite(db_name)
+    for table_name in ('ping_table', 'tcp_table'):
+        schema.create_table(p, table_name)
+
+    now = datetime.datetime.utcnow()
+    row = (now, 4, '10.0.0.1', 1.0, 3, 0)
+    batch = [row] * 100
+    window = HotWindow(p, 'ping_table', capacity=1000)
+    start = datetime.datetime(2020, 1, 1)
+    end = start + datetime.timedelta(hours=1)
+
+    def window_json():
+        rows = window.rows(100)
+        return json.dumps([dict(zip(window.columns, r)) for r in rows], default=str)
+
+    return [('sqlite insert', lambda: p.insert('ping_table', row), 2000),
+            ('sqlite insert_many 100 rows', lambda: p.insert_many('ping_table', batch), 500),
+            ('sqlite buffered_insert', lambda: p.buffered_insert('ping_table', row), 50000),
+            ('sqlite get_last json 100 rows', lambda: get_last_json(p, 'ping_table', 100), 2000),
+            ('ring get_last json 100 rows', window_json, 2000),
+            ('sqlite get_range 1 hour', lambda: p.get_range('ping_table', '10.0.0.1', start, end), 2000)]
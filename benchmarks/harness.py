@@ -0,0 +1,96 @@
+""" Timing, reporting and baseline comparison shared by the benchmarks of the suite
+
+A case is a (name, func, number) tuple: func is called number times, every call is timed on its own to get the
+latency percentiles and the total gives the operations per second.
+"""
+import datetime
+import json
+import os
+import timeit
+
+import lib.sqlite as db
+import lib.schema as schema
+
+
+def percentile(values, fraction):
+    """ Value at the fraction (0 to 1) of the sorted values, nearest rank """
+    index = min(int(fraction * len(values)), len(values) - 1)
+    return values[index]
+
+
+def measure(name, func, number, warmup=None):
+    """ Run func number times after warmup calls, returns the result of the case """
+    timer = timeit.default_timer
+    for _ in range(warmup if warmup is not None else max(number // 10, 1)):
+        func()
+
+    latencies = []
+    start = timer()
+    for _ in range(number):
+        call_start = timer()
+        func()
+        latencies.append(timer() - call_start)
+    total = timer() - start
+
+    latencies.sort()
+    return {'name': name, 'number': number, 'ops': number / total,
+            'p50_us': percentile(latencies, 0.5) * 1e6, 'p99_us': percentile(latencies, 0.99) * 1e6}
+
+
+def compare(results, baseline, tolerance):
+    """ List of (name, ops, baseline ops) of the cases slower than the baseline by more than tolerance (a fraction
+    of the baseline operations per second) """
+    regressions = []
+    for result in results:
+        before = baseline.get(result['name'])
+        if before is not None and result['ops'] < before['ops'] * (1 - tolerance):
+            regressions.append((result['name'], result['ops'], before['ops']))
+    return regressions
+
+
+def report(results, baseline=None):
+    """ Print a line per case, with the change against the baseline when there is one """
+    print("%-40s %14s %12s %12s %9s" % ('case', 'ops/s', 'p50 us', 'p99 us', 'change'))
+    for result in results:
+        change = ''
+        before = (baseline or {}).get(result['name'])
+        if before is not None:
+            change = '%+0.1f%%' % ((result['ops'] / before['ops'] - 1) * 100)
+        print("%-40s %14.0f %12.2f %12.2f %9s" % (result['name'], result['ops'], result['p50_us'],
+                                                  result['p99_us'], change))
+
+
+def load_baseline(file_name):
+    """ Results of a previous run saved by save_baseline, keyed by case name """
+    with open(file_name, 'r') as f:
+        return dict((result['name'], result) for result in json.load(f)['results'])
+
+
+def save_baseline(file_name, results):
+    with open(file_name, 'w') as f:
+        json.dump({'created_at': str(datetime.datetime.utcnow()), 'results': results}, f, indent=2,
+                  sort_keys=True)
+
+
+def populate(db_name, rows, targets=100, batch_size=50000):
+    """ Fill the ping_table and tcp_table of the database with rows synthetic results spread over targets
+    hosts, once: an existing database is kept """
+    if os.path.exists(db_name):
+        return
+    p = db.SQLite(db_name)
+    schema.create_table(p, 'ping_table')
+    schema.create_table(p, 'tcp_table')
+
+    start = datetime.datetime(2020, 1, 1)
+    for first in range(0, rows, batch_size):
+        ping_rows = []
+        tcp_rows = []
+        for i in range(first, min(first + batch_size, rows)):
+            created_at = start + datetime.timedelta(seconds=i)
+            host = '10.0.%i.%i' % (i % targets // 256, i % targets % 256)
+            ping_rows.append((created_at, 4, host, 1.0 + i % 50, 3, 1 if i % 7 == 0 else 0))
+            tcp_rows.append((created_at, 4, 'http://%s:80/' % host, 200, 1.0, None, 2.0, None, None, 0.1, 1.5,
+                             2.5))
+        p.insert_many('ping_table', ping_rows)
+        p.insert_many('tcp_table', tcp_rows)
+    p.close()
@@ -0,0 +1,72 @@
+""" Offline benchmark suite of the measurement and storage hot paths
+
+Runs the cases of every benchmark module, reports the operations per second and the p50/p99 latency of each one
+and compares them with a baseline saved by a previous run. Exits with 1 when a case is slower than the baseline by
+more than the tolerance.
+
+Run from the repository root: python -m benchmarks.suite --save baseline.json
+                              python -m benchmarks.suite --baseline baseline.json
+"""
+import argparse
+import importlib
+import shutil
+import sys
+import tempfile
+from benchmarks.harness import measure, compare, report, load_baseline, save_baseline
+
+# Modules with the NAMES of their cases and a cases(options) function building them, in the order they run
+MODULES = ('benchmarks.bench_packet', 'benchmarks.bench_parse', 'benchmarks.bench_storage', 'benchmarks.bench_api')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-k", dest="keyword", help="Only run the cases whose name contains this keyword",
+                        action="store")
+    parser.add_argument("--rows", help="Specify the number of results of the synthetic database", action="store",
+                        default=1000000)
+    parser.add_argument("--scale", help="Multiply the number of calls of every case", action="store", default=1)
+    parser.add_argument("--workdir", help="Directory of the synthetic database, kept between runs when given "
+                        "[Optional]", action="store")
+    parser.add_argument("--baseline", help="Compare with the results saved in this JSON file", action="store")
+    parser.add_argument("--save", help="Save the results in this JSON file", action="store")
+    parser.add_argument("--tolerance", help="Slowdown allowed against the baseline, as a fraction", action="store",
+                        default=0.1)
+
+    args = parser.parse_args()
+    args.rows = int(args.rows)
+    temporary = args.workdir is None
+    if temporary:
+        args.workdir = tempfile.mkdtemp(prefix='bench')
+
+    results = []
+    try:
+        for module_name in MODULES:
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError as e:
+                print("Skipping %s: %s" % (module_name, e))
+                continue
+            # Building the cases can be expensive (the database, the API), skip the modules -k does not select
+            if args.keyword is not None and not any(args.keyword in name for name in module.NAMES):
+                continue
+            for name, func, number in module.cases(args):
+                if name not in module.NAMES:
+                    raise ValueError("The case %s is missing from %s.NAMES" % (name, module_name))
+                if args.keyword is None or args.keyword in name:
+                    results.append(measure(name, func, max(int(number * float(args.scale)), 1)))
+    finally:
+        if temporary:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    baseline = load_baseline(args.baseline) if args.baseline is not None else None
+    report(results, baseline)
+    if args.save is not None:
+        save_baseline(args.save, results)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, float(args.tolerance))
+        for name, ops, before in regressions:
+            print("Regression %s: %0.0f ops/s, baseline %0.0f ops/s" % (name, ops, before))
+        if regressions:
+            sys.exit(1)
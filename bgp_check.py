@@ -1,11 +1,13 @@
 import lib.sqlite as db
+import lib.schema as schema
+from lib.bgp import PrefixStore
+from lib.ripe import RipeClient
+from lib.metrics import CHECK_SECONDS
 import datetime
 import argparse
 import logging
 import yaml
 import sys
-import requests
-import json
 
 LEVEL = {'debug': logging.DEBUG,
          'info': logging.INFO,
@@ -21,6 +23,39 @@ def parse_prefixes_from_as(resp, logger):
     return v4_prefixes, v6_prefixes, query_time
 
 
+def fetch_prefixes(client, autonomous_system, list_prefixes=False, logger=None):
+    """ Get the prefixes announced by the autonomous system with the lib.ripe.RipeClient, returns the v4 and v6
+    prefixes (their counts without list_prefixes) and the query time """
+    logger = logger if logger is not None else logging.getLogger('bgp_check')
+    with CHECK_SECONDS.labels('bgp').time():
+        resp = client.fetch(autonomous_system, list_prefixes=list_prefixes)
+    return parse_prefixes_from_as(resp, logger)
+
+
+def make_client(config, verify=False, replay_dir=None, record_dir=None, logger=None):
+    """ lib.ripe.RipeClient configured with the bgp section of the configuration """
+    bgp_config = config.get('bgp') or {}
+    return RipeClient(cache_dir=bgp_config.get('cache_dir'), cache_ttl=bgp_config.get('cache_ttl', 300),
+                      replay_dir=replay_dir if replay_dir is not None else bgp_config.get('replay_dir'),
+                      record_dir=record_dir, verify=verify or bgp_config.get('verify', False), logger=logger)
+
+
+def store_snapshot(store, autonomous_system, v4_prefixes, v6_prefixes, query_time, logger):
+    """ Apply the snapshot to the lib.bgp.PrefixStore, returns the bgp_table row summarizing it """
+    now = datetime.datetime.utcnow()
+    if not isinstance(v4_prefixes, list) or not isinstance(v6_prefixes, list):
+        # Only the counts, there is nothing to compare
+        return now, None, None, query_time, autonomous_system, v4_prefixes, v6_prefixes, None, None
+
+    announced, withdrawn = store.update(autonomous_system, v4_prefixes, v6_prefixes, now)
+    for prefix in announced:
+        logger.info("%s announced %s" % (autonomous_system, prefix))
+    for prefix in withdrawn:
+        logger.info("%s withdrew %s" % (autonomous_system, prefix))
+    return (now, None, None, query_time, autonomous_system, len(v4_prefixes), len(v6_prefixes), len(announced),
+            len(withdrawn))
+
+
 if __name__ == "__main__":
 
     # Create the parser for the arguments
@@ -28,7 +63,11 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbose", help="Turn on verbosity on the output", action="store_true", default=False)
     parser.add_argument("--ssl", help="Enforce ssl verification", action="store_true", default=False)
     parser.add_argument("--list_prefixes", help="List prefixes announced by the AS", action="store_true", default=False)
-    parser.add_argument("-a", "--autonomous_system", help="Specify the BGP Autonomous system to find out if prefixes are announced", action="store")
+    parser.add_argument("-a", "--autonomous_system", help="Specify the BGP Autonomous system to find out if prefixes are announced, can be repeated", action="append", required=True)
+    parser.add_argument("--replay", help="Read the responses from the JSON fixtures of this directory instead of RIPE",
+                        action="store")
+    parser.add_argument("--record", help="Save the responses from RIPE as JSON fixtures in this directory",
+                        action="store")
 
     args = parser.parse_args()
 
@@ -61,32 +100,31 @@ if __name__ == "__main__":
         logger.critical('You have to configure the database name on the config file')
         sys.exit(1)
 
-    # Building the URL
-    if args.list_prefixes:
-        url = 'https://stat.ripe.net/data/ris-prefixes/data.json?resource=%s&list_prefixes=true' %args.autonomous_system
-    else:
-        url = 'https://stat.ripe.net/data/ris-prefixes/data.json?resource=%s&list_prefixes=false' %args.autonomous_system
-
-    logger.info("Sending GET request to RIPE")
-    r = requests.get(url, verify=args.ssl)
-
-    logger.info("Checking the result status code")
-    if r.status_code == 200:
-        logger.info("Status code 200 retrieving data")
-        response = r.json()
-        v4_prefx, v6_prefx, qtime = parse_prefixes_from_as(response, logger)
-    else:
-        logger.Error("Error connecting to the url status code %i" %r.status_code)
-        sys.exit(1)
+    client = make_client(config, verify=args.ssl, replay_dir=args.replay, record_dir=args.record, logger=logger)
 
     # Create database
     logger.info('Creating Database if does not exist')
     p = db.SQLite(db_name)
-    # Create table
-    logger.info('Creating bgp_table if does not exist')
-    p.create_table('bgp_table', ('id integer PRIMARY KEY', 'created_at DATETIME', 'v4_prefixes text',
-                                 'v6_prefixes text', 'query_time text'))
-    # Insert data in database table
-    logger.info('Inserting data in bgp_table')
-    p.insert('bgp_table', (datetime.datetime.utcnow(), json.dumps(v4_prefx), json.dumps(v6_prefx),  qtime))
-    p.close()
\ No newline at end of file
+    # Create tables
+    logger.info('Creating bgp_table and bgp_prefix_table if do not exist')
+    store = PrefixStore(p)
+
+    failed = False
+    for autonomous_system in args.autonomous_system:
+        try:
+            v4_prefx, v6_prefx, qtime = fetch_prefixes(client, autonomous_system, list_prefixes=args.list_prefixes,
+                                                       logger=logger)
+        except IOError as e:
+            logger.error(e)
+            failed = True
+            continue
+
+        # Write the announcements and withdrawals, then the snapshot
+        row = store_snapshot(store, autonomous_system, v4_prefx, v6_prefx, qtime, logger)
+        logger.info('Inserting data in bgp_table')
+        p.insert('bgp_table', row)
+
+    client.close()
+    p.close()
+    if failed:
+        sys.exit(1)
@@ -1,13 +1,20 @@
 import lib.sqlite as db
+import lib.schema as schema
 import datetime
 import dns.resolver
 import dns.query
 import dns.dnssec
+import dns.message
+import dns.rdatatype
+from multiprocessing.pool import ThreadPool
+from lib.resolver import CachingResolver
+from lib.answers import AnswerStore
+from lib.metrics import CHECK_SECONDS
+from lib.lib import monotonic
 import argparse
 import logging
 import yaml
 import sys
-import json
 
 LEVEL = {'debug': logging.DEBUG,
          'info': logging.INFO,
@@ -16,14 +23,166 @@ LEVEL = {'debug': logging.DEBUG,
          'critical': logging.CRITICAL}
 
 
+def lookup(resolver, name, rdtype):
+    """ Resolve name, returns the answer or the exception raised """
+    try:
+        return resolver.query(name, rdtype)
+    except Exception as e:
+        return e
+
+
+def udp_lookup(domain, rdtype, nameserver, timeout, want_dnssec=False):
+    """ Query the nameserver directly, returns the response or the exception raised """
+    try:
+        query = dns.message.make_query(domain, rdtype, want_dnssec=want_dnssec)
+        return dns.query.udp(query, nameserver, timeout=timeout)
+    except Exception as e:
+        return e
+
+
+def server_addresses(answer, hosts, lookups, record, logger):
+    """ List of (host, address) of the hosts of an MX or NS answer, ('ERROR', 'ERROR') if the answer failed """
+    if isinstance(answer, Exception):
+        return [('ERROR', 'ERROR')]
+
+    servers = []
+    for host in hosts:
+        result = lookups[(host, record)].get()
+        if isinstance(result, Exception):
+            logger.error("There was a problem trying to get the %s records of %s" % (record, host))
+            logger.error(result)
+            servers.append((host, 'N/A'))
+        else:
+            for rdata in result:
+                servers.append((host, rdata.address))
+    return servers
+
+
+def check_domains(resolver, domains, pool, timeout, logger):
+    """ Check the domains and return the rows of their results, lib.answers.AnswerStore.encode turns them into
+    dns_table rows
+
+    The lookups run as a pipeline on the thread pool, every stage fans out the independent queries of all the
+    domains at once: MX, NS and SOA records first, then the A/AAAA records of the exchanges and nameservers plus
+    the address of the primary nameserver, and finally the A, AAAA and DNSKEY queries to the primary nameserver.
+    Every query has its own timeout.
+    """
+    start = monotonic()
+    resolver.lifetime = timeout
+
+    # Stage 1: MX, NS and SOA records of every domain
+    logger.info("Query for MX, NS and SOA records of %i domains" % len(domains))
+    stage1 = {}
+    for domain in domains:
+        for record, rdtype in (('MX', dns.rdatatype.MX), ('NS', dns.rdatatype.NS), ('SOA', dns.rdatatype.SOA)):
+            stage1[(domain, record)] = pool.apply_async(lookup, (resolver, domain, rdtype))
+
+    # Stage 2: addresses of the exchange servers, nameservers and primary nameserver
+    answers = {}
+    hosts = {}
+    lookups = {}
+    for domain in domains:
+        for record in ('MX', 'NS', 'SOA'):
+            answer = stage1[(domain, record)].get()
+            answers[(domain, record)] = answer
+            if isinstance(answer, Exception):
+                logger.error("There was a problem trying to get the %s records of the domain %s" % (record, domain))
+                logger.error(answer)
+
+        mx = answers[(domain, 'MX')]
+        ns = answers[(domain, 'NS')]
+        hosts[(domain, 'MX')] = [] if isinstance(mx, Exception) else [r.exchange.to_text() for r in mx]
+        hosts[(domain, 'NS')] = [] if isinstance(ns, Exception) else [r.to_text() for r in ns]
+        for host in hosts[(domain, 'MX')] + hosts[(domain, 'NS')]:
+            for record, rdtype in (('A', dns.rdatatype.A), ('AAAA', dns.rdatatype.AAAA)):
+                if (host, record) not in lookups:
+                    lookups[(host, record)] = pool.apply_async(lookup, (resolver, host, rdtype))
+
+        soa = answers[(domain, 'SOA')]
+        if not isinstance(soa, Exception):
+            logger.info("The soa record of %s is %s" % (domain, soa.rrset[0].to_text()))
+            lookups[(domain, 'primary_ns')] = pool.apply_async(lookup, (resolver, soa.rrset[0].mname,
+                                                                        dns.rdatatype.A))
+
+    # Stage 3: A, AAAA and DNSKEY records from the primary nameserver
+    direct = {}
+    for domain in domains:
+        if (domain, 'primary_ns') not in lookups:
+            continue
+        answer = lookups[(domain, 'primary_ns')].get()
+        if isinstance(answer, Exception):
+            logger.error("There was a problem trying to get the primary nameserver of the domain %s" % domain)
+            logger.error(answer)
+            continue
+        primary_ns = answer.rrset[0].to_text()
+        for record, rdtype in (('A', dns.rdatatype.A), ('AAAA', dns.rdatatype.AAAA)):
+            direct[(domain, record)] = pool.apply_async(udp_lookup, (domain, rdtype, primary_ns, timeout))
+        direct[(domain, 'DNSKEY')] = pool.apply_async(udp_lookup, (domain, dns.rdatatype.DNSKEY, primary_ns,
+                                                                   timeout, True))
+
+    rows = []
+    for domain in domains:
+        mx_servers_ipv4 = server_addresses(answers[(domain, 'MX')], hosts[(domain, 'MX')], lookups, 'A', logger)
+        mx_servers_ipv6 = server_addresses(answers[(domain, 'MX')], hosts[(domain, 'MX')], lookups, 'AAAA', logger)
+        ns_servers_ipv4 = server_addresses(answers[(domain, 'NS')], hosts[(domain, 'NS')], lookups, 'A', logger)
+        ns_servers_ipv6 = server_addresses(answers[(domain, 'NS')], hosts[(domain, 'NS')], lookups, 'AAAA', logger)
+
+        soa = answers[(domain, 'SOA')]
+        soa_record = 'Error' if isinstance(soa, Exception) else soa.rrset[0].to_text()
+
+        records = {}
+        for record in ('A', 'AAAA', 'DNSKEY'):
+            records[record] = direct[(domain, record)].get() if (domain, record) in direct else None
+
+        answer_a = records['A']
+        if answer_a is None or isinstance(answer_a, Exception):
+            logger.error("There was a problem trying to get the A records of the domain %s" % domain)
+            a_record = 'Error'
+        else:
+            a_record = answer_a.answer[0].items[0].address
+
+        answer_aaaa = records['AAAA']
+        if answer_aaaa is None or isinstance(answer_aaaa, Exception):
+            logger.error("There was a problem trying to get the AAAA records of the domain %s" % domain)
+            aaaa_record = 'Error'
+        else:
+            try:
+                aaaa_record = answer_aaaa.answer[0].items[0].address
+            except Exception as e:
+                logger.error("There is not a AAAA record for the domain %s" % domain)
+                logger.error(e)
+                aaaa_record = 'No IPv6'
+
+        answer_dnskey = records['DNSKEY']
+        if answer_dnskey is None or isinstance(answer_dnskey, Exception):
+            logger.error("There was a problem trying to get the DNSKEY records of the domain %s" % domain)
+            dnskey_record = 'Error'
+        elif len(answer_dnskey.answer) != 0:
+            dnskey_record = 'Present'
+            logger.info("The dnskey record of %s is %s" % (domain, answer_dnskey.answer[0]))
+        else:
+            dnskey_record = 'Not Present'
+            logger.info("No DNSKEY record found for %s" % domain)
+
+        rows.append((datetime.datetime.utcnow(), mx_servers_ipv4, mx_servers_ipv6, ns_servers_ipv4, ns_servers_ipv6,
+                     soa_record, a_record, aaaa_record, dnskey_record, domain))
+    CHECK_SECONDS.labels('dns').observe(monotonic() - start)
+    return rows
+
+
 if __name__ == "__main__":
 
     # Create the parser for the arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", help="Turn on verbosity on the output", action="store_true", default=False)
-    parser.add_argument("-d", dest="domain", help="Specify the domain to check", action="store")
+    parser.add_argument("-d", dest="domain", help="Specify the domain to check, can be repeated", action="append",
+                        required=True)
     parser.add_argument("--ns1", help="Specify the first name server to use [Optional]", action="store")
     parser.add_argument("--ns2", help="Specify the second name server to use [Optional]", action="store")
+    parser.add_argument("-t", dest="timeout", help="Specify the timeout of every query in seconds", action="store",
+                        default=5)
+    parser.add_argument("-w", dest="workers", help="Specify the number of concurrent queries", action="store",
+                        default=20)
 
     args = parser.parse_args()
 
@@ -62,150 +221,34 @@ if __name__ == "__main__":
     # Add NS on the resolver object if they were specified on the arguments
     if (args.ns1 is not None) or (args.ns2 is not None):
         logger.info("Name servers specified")
-        dns_resolver.nameservers = [args.ns1, args.ns2]
+        dns_resolver.nameservers = [ns for ns in (args.ns1, args.ns2) if ns is not None]
     else:
         logger.info("Name servers NOT specified")
 
-    logger.info("Query for MX Servers")
-    # Query NS for the MX Records
-    try:
-        answer_mx = dns_resolver.query(args.domain, dns.rdatatype.MX)
-    except Exception as e:
-        logger.error("There was a problem trying to get the MX records of the domain %s" %(args.domain))
-        logger.error(e)
-        mx_servers_ipv4 = [('ERROR', 'ERROR')]
-        mx_servers_ipv6 = [('ERROR', 'ERROR')]
-    else:
-        mx_servers_ipv4 = []
-        mx_servers_ipv6 = []
-        # Process the MX exchange servers and resolve the ip address to each one of them
-        for rdata_mx in answer_mx:
-            # Processing ipv4 addresses
-            logger.info("Processing %s ipv4 exchange server" %(rdata_mx.exchange))
-            try:
-                answer = dns_resolver.query(rdata_mx.exchange, dns.rdatatype.A)
-            except Exception as e:
-                logger.error("There was a problem trying to get the A records of %s" %(rdata_mx.exchange))
-                logger.error(e)
-                mx_servers_ipv4.append((rdata_mx.exchange.to_text(), 'N/A'))
-            for rdata in answer:
-                mx_servers_ipv4.append((rdata_mx.exchange.to_text(), rdata.address))
-            # Processing ipv6 addresses
-            logger.info("Processing %s ipv6 exchange server" % (rdata_mx.exchange))
-            try:
-                answer = dns_resolver.query(rdata_mx.exchange, dns.rdatatype.AAAA)
-            except Exception as e:
-                logger.error("There was a problem trying to get the AAAAA records of %s" % (rdata_mx.exchange))
-                logger.error(e)
-                mx_servers_ipv6.append((rdata_mx.exchange.to_text(), 'N/A'))
-            for rdata in answer:
-                mx_servers_ipv6.append((rdata_mx.exchange.to_text(), rdata.address))
-
-    logger.info("Query for NS Servers")
-    # Query NS for the NS Records of the Domain
-    try:
-        answer_ns = dns_resolver.query(args.domain, dns.rdatatype.NS)
-    except Exception as e:
-        logger.error("There was a problem trying to get the NS records of the domain %s" % (args.domain))
-        logger.error(e)
-        ns_servers_ipv4 = [('ERROR', 'ERROR')]
-        ns_servers_ipv6 = [('ERROR', 'ERROR')]
-    else:
-        ns_servers_ipv4 = []
-        ns_servers_ipv6 = []
-        # Process the NS servers and resolve the ip address to each one of them
-        for rdata_ns in answer_ns:
-            # Processing IPv4 Addresses
-            logger.info("Processing %s ipv4 nameserver" % (rdata_ns.to_text()))
-            try:
-                answer = dns_resolver.query(rdata_ns.to_text(), dns.rdatatype.A)
-            except Exception as e:
-                logger.error("There was a problem trying to get the A records of %s" % (rdata_ns.to_text()))
-                logger.error(e)
-                ns_servers_ipv4.append((rdata_ns.to_text(), 'N/A'))
-            for rdata in answer:
-                ns_servers_ipv4.append((rdata_ns.to_text(), rdata.address))
-            # Processing Ipv6 Addresses
-            logger.info("Processing %s ipv6 nameserver" % (rdata_ns.to_text()))
-            try:
-                answer = dns_resolver.query(rdata_ns.to_text(), dns.rdatatype.AAAA)
-            except Exception as e:
-                logger.error("There was a problem trying to get the AAAA records of %s" % (rdata_ns.to_text()))
-                logger.error(e)
-                ns_servers_ipv6.append((rdata_ns.to_text(), 'N/A'))
-            for rdata in answer:
-                ns_servers_ipv6.append((rdata_ns.to_text(), rdata.address))
-
-    logger.info("Query for SOA Record")
-    # Query NS for the SOA Record
-    try:
-        answer_soa = dns_resolver.query(args.domain, dns.rdatatype.SOA)
-    except Exception as e:
-        logger.error("There was a problem trying to get the SOA records of the domain %s" % (args.domain))
-        logger.error(e)
-        soa_record = 'Error'
-    else:
-        soa_record = answer_soa.rrset[0].to_text()
-        logger.info("The soa record is %s" % (soa_record))
-        primary_ns = dns.resolver.query(answer_soa.rrset[0].mname, dns.rdatatype.A).rrset[0].to_text()
-
-    logger.info("Query for A Records")
-    # Query NS for the A Record
-    try:
-        query = dns.message.make_query(args.domain, dns.rdatatype.A)
-        answer_a = dns.query.udp(query, primary_ns)
-    except Exception as e:
-        logger.error("There was a problem trying to get the A records of the domain %s" % (args.domain))
-        logger.error(e)
-        a_record = 'Error'
-    else:
-        a_record = answer_a.answer[0].items[0].address
-
-    logger.info("Query for AAAA Records")
-    # Query NS for the AAAAA Record
-    try:
-        query = dns.message.make_query(args.domain, dns.rdatatype.AAAA)
-        answer_aaaa = dns.query.udp(query, primary_ns)
-    except Exception as e:
-        logger.error("There was a problem trying to get the AAAA records of the domain %s" % (args.domain))
-        logger.error(e)
-        aaaa_record = 'Error'
-    else:
-        try:
-            aaaa_record = answer_aaaa.answer[0].items[0].address
-        except Exception as e:
-            logger.error("There is not a AAAA record for the domain %s" % (args.domain))
-            logger.error(e)
-            aaaa_record = 'No IPv6'
-
-    logger.info("Get DNSKEY record for domain %s" % args.domain)
-    # Query NS for the DNSKEY Record
-    try:
-        query = dns.message.make_query(args.domain, dns.rdatatype.DNSKEY, want_dnssec=True)
-        answer_dnskey = dns.query.udp(query, primary_ns)
-    except Exception as e:
-        logger.error("There was a problem trying to get the DNSKEY records of the domain %s" % (args.domain))
-        logger.error(e)
-        dnskey_record = 'Error'
-    else:
-        if len(answer_dnskey.answer) != 0:
-            dnskey_record = 'Present'
-            logger.info("The dnskey record is %s" % (answer_dnskey.answer[0]))
-        else:
-            dnskey_record = 'Not Present'
-            logger.info("No DNSKEY record found")
+    # Cache of the answers shared by all the lookups
+    dns_config = config.get('dns') or {}
+    resolver = CachingResolver(dns_resolver, max_size=dns_config.get('cache_size', 10000))
+    persist_cache = dns_config.get('persist_cache', True)
 
     # Create database
     logger.info('Creating Database if does not exist')
     p = db.SQLite(db_name)
-    # Create table
-    logger.info('Creating dns_table if does not exist')
-    p.create_table('dns_table', ('id integer PRIMARY KEY', 'created_at DATETIME', 'ipv4_mx_servers text',
-                                 'ipv6_mx_servers text', 'ipv4_ns_servers text', 'ipv6_ns_servers text',
-                                 'soa_record text', 'a_record text', 'aaaa_record text', 'dnskey_record text'))
+    # Create tables
+    logger.info('Creating dns_table and its answer sets tables if do not exist')
+    store = AnswerStore(p)
+    if persist_cache:
+        schema.create_table(p, 'dns_cache_table')
+        logger.info('Loaded %i cached answers' % resolver.load(p))
+
+    pool = ThreadPool(int(args.workers))
+    rows = check_domains(resolver, args.domain, pool, float(args.timeout), logger)
+    pool.close()
+    pool.join()
+    logger.info('Cache hits %i, misses %i' % (resolver.cache.hits, resolver.cache.misses))
+
     # Insert data in database table
-    logger.info('Inserting data in dns_table')
-    p.insert('dns_table', (datetime.datetime.utcnow(), json.dumps(mx_servers_ipv4), json.dumps(mx_servers_ipv6),
-                           json.dumps(ns_servers_ipv4), json.dumps(ns_servers_ipv6), soa_record, a_record, aaaa_record,
-                           dnskey_record))
-    p.close()
\ No newline at end of file
+    logger.info('Inserting %i rows in dns_table' % len(rows))
+    p.insert_many('dns_table', store.encode(rows))
+    if persist_cache:
+        logger.info('Saved %i cached answers' % resolver.save(p))
+    p.close()
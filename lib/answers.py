@@ -0,0 +1,112 @@
+import hashlib
+import json
+from . import schema
+
+# Columns of dns_table holding a reference to an answer set
+SET_FIELDS = ('mx_v4_set', 'mx_v6_set', 'ns_v4_set', 'ns_v6_set')
+
+
+def set_digest(servers):
+    """ Content address of a list of (host, address), the same for any order of the same pairs """
+    canonical = json.dumps(sorted([host, address] for host, address in servers))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class AnswerStore():
+    """ Dictionary encoding of the answers of dns_check.py
+
+    Host names and addresses are interned in dns_name_table and dns_address_table. A list of (host, address) of the
+    exchanges or nameservers of a domain is an answer set, stored once in dns_set_table under the digest of its
+    content with a dns_set_member_table row per pair. A dns_table row only holds the id of its answer sets, so an
+    unchanged set is a reference to the one written before and a change of set is a different id.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        for table_name in ('dns_table', 'dns_name_table', 'dns_address_table', 'dns_set_table',
+                           'dns_set_member_table'):
+            schema.create_table(self.db, table_name)
+
+        # Ids already resolved on this connection, cleared when encode rolls back the rows they point to
+        self.names = {}
+        self.addresses = {}
+        self.sets = {}
+
+    def _intern(self, table_name, field, value, cache):
+        try:
+            return cache[value]
+        except KeyError:
+            pass
+        # Another process may intern the same value, the unique index keeps a single row
+        self.db.query('''INSERT OR IGNORE INTO {tbl} ({fld}) VALUES (?)'''.format(tbl=table_name, fld=field),
+                      (value,))
+        id = self.db.query('''SELECT id FROM {tbl} WHERE {fld} = ?'''.format(tbl=table_name, fld=field),
+                           (value,))[0][0]
+        cache[value] = id
+        return id
+
+    def name_id(self, name):
+        return self._intern('dns_name_table', 'name', name, self.names)
+
+    def address_id(self, address):
+        return self._intern('dns_address_table', 'address', address, self.addresses)
+
+    def set_id(self, servers):
+        """ Id of the answer set of the list of (host, address), written if it is new """
+        digest = set_digest(servers)
+        try:
+            return self.sets[digest]
+        except KeyError:
+            pass
+
+        pairs = sorted(set(servers))
+        # The set and its members are written in the transaction committed by encode, a set row always has its
+        # members
+        self.db.query('''INSERT OR IGNORE INTO dns_set_table (digest, size) VALUES (?, ?)''', (digest, len(pairs)))
+        created = self.db.c.rowcount == 1
+        id = self.db.query('''SELECT id FROM dns_set_table WHERE digest = ?''', (digest,))[0][0]
+        if created:
+            for host, address in pairs:
+                self.db.query('''INSERT INTO dns_set_member_table (set_id, name_id, address_id) VALUES (?, ?, ?)''',
+                              (id, self.name_id(host), self.address_id(address)))
+        self.sets[digest] = id
+        return id
+
+    def encode(self, rows):
+        """ dns_table rows of the results of dns_check.check_domains, the interned values they reference are
+        written and committed first, in a single transaction """
+        try:
+            encoded = []
+            for (created_at, mx_v4, mx_v6, ns_v4, ns_v6, soa_record, a_record, aaaa_record, dnskey_record,
+                 domain) in rows:
+                encoded.append((created_at, None, None, None, None, soa_record, a_record, aaaa_record, dnskey_record,
+                                domain, self.set_id(mx_v4), self.set_id(mx_v6), self.set_id(ns_v4),
+                                self.set_id(ns_v6)))
+            self.db.commit()
+        except Exception:
+            self.db.conn.rollback()
+            self.names.clear()
+            self.addresses.clear()
+            self.sets.clear()
+            raise
+        return encoded
+
+    def servers(self, set_id):
+        """ List of (host, address) of the answer set """
+        return self.db.query('''SELECT n.name, a.address FROM dns_set_member_table m
+                                JOIN dns_name_table n ON n.id = m.name_id
+                                JOIN dns_address_table a ON a.id = m.address_id
+                                WHERE m.set_id = ? ORDER BY n.name, a.address''', (set_id,))
+
+    def changes(self, field, domain=None):
+        """ List of (created_at, domain, previous set id, set id) of the rows whose answer set of field (one of
+        SET_FIELDS) differs from the previous row of the same domain """
+        if field not in SET_FIELDS:
+            raise ValueError("The field should be one of %s" % ", ".join(SET_FIELDS))
+        sql = '''SELECT r.created_at, r.domain, p.{fld}, r.{fld} FROM dns_table r
+                 JOIN dns_table p ON p.id = (SELECT max(id) FROM dns_table
+                                             WHERE domain = r.domain AND id < r.id AND {fld} IS NOT NULL)
+                 WHERE r.{fld} IS NOT NULL AND r.{fld} != p.{fld}'''.format(fld=field)
+        if domain is None:
+            return self.db.query(sql + ''' ORDER BY r.id''')
+        return self.db.query(sql + ''' AND r.domain = ? ORDER BY r.id''', (domain,))
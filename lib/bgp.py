@@ -0,0 +1,54 @@
+from . import schema
+
+
+class PrefixStore():
+    """ Prefixes originated by every autonomous system, one row per announcement
+
+    A prefix gets a row with first_seen when it shows up in a snapshot and last_seen stays NULL while it is announced.
+    When a snapshot no longer has it last_seen is set to the previous snapshot, the last one that had it, so only
+    the announcements and withdrawals are written. A prefix announced again gets a new row.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        for table_name in ('bgp_table', 'bgp_prefix_table'):
+            schema.create_table(self.db, table_name)
+
+    def announced(self, autonomous_system):
+        """ Dict of the id of the row of every prefix announced by the autonomous system """
+        rows = self.db.query('''SELECT prefix, id FROM bgp_prefix_table WHERE autonomous_system = ?
+                                AND last_seen IS NULL''', (autonomous_system,))
+        return dict(rows)
+
+    def last_snapshot(self, autonomous_system):
+        """ Date of the last snapshot of the autonomous system, None if there is none """
+        return self.db.query('''SELECT max(created_at) FROM bgp_table WHERE autonomous_system = ?''',
+                             (autonomous_system,))[0][0]
+
+    def update(self, autonomous_system, v4_prefixes, v6_prefixes, seen_at):
+        """ Apply the snapshot of the prefixes seen at seen_at, returns the lists of prefixes announced and
+        withdrawn since the previous snapshot """
+        current = self.announced(autonomous_system)
+        versions = dict((prefix, 4) for prefix in v4_prefixes)
+        versions.update((prefix, 6) for prefix in v6_prefixes)
+
+        announced = sorted(set(versions) - set(current))
+        withdrawn = sorted(set(current) - set(versions))
+
+        try:
+            if withdrawn:
+                last_seen = self.last_snapshot(autonomous_system) or seen_at
+                for prefix in withdrawn:
+                    self.db.query('''UPDATE bgp_prefix_table SET last_seen = ? WHERE id = ?''',
+                                  (last_seen, current[prefix]))
+            self.db.insert_many('bgp_prefix_table', [(autonomous_system, prefix, versions[prefix], seen_at, None)
+                                                      for prefix in announced])
+            self.db.commit()
+        except Exception:
+            self.db.conn.rollback()
+            raise
+        return announced, withdrawn
+
+    def history(self, prefix):
+        """ Rows of the announcements of the prefix by any autonomous system, oldest first """
+        return self.db.query('''SELECT * FROM bgp_prefix_table WHERE prefix = ? ORDER BY first_seen''', (prefix,))
@@ -0,0 +1,88 @@
+import collections
+import threading
+import time
+
+
+class TTLCache():
+    """ Bounded LRU cache whose entries expire
+
+    Every entry has its own expiration (the default ttl or the one given to set), an expired entry is dropped when
+    it is looked up and the least recently used entry is evicted when the cache is full. All the operations are O(1)
+    and thread safe.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, clock=time.time):
+        # Error Checks
+        if not isinstance(max_size, int):
+            raise TypeError("The size of the cache should be an integer")
+        if max_size <= 0:
+            raise ValueError("The size of the cache should be greater than or equal to 1")
+        if ttl <= 0:
+            raise ValueError("The ttl should be greater than 0")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """ Value of key, default when it is missing or expired """
+        with self.lock:
+            try:
+                value, expiration = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expiration <= self.clock():
+                self.misses += 1
+                return default
+            # Move it to the end, the most recently used
+            self.entries[key] = (value, expiration)
+            self.hits += 1
+            return value
+
+    def ttl_left(self, key):
+        """ Seconds left before key expires, 0 when it is missing or expired """
+        with self.lock:
+            try:
+                value, expiration = self.entries[key]
+            except KeyError:
+                return 0
+            return max(expiration - self.clock(), 0)
+
+    def set(self, key, value, ttl=None):
+        """ Store value for key during ttl seconds (the default ttl when it is None) """
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            if ttl <= 0:
+                return
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            self.entries[key] = (value, self.clock() + ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def items(self):
+        """ List of (key, value, expiration) of the entries not expired, from the least recently used """
+        now = self.clock()
+        with self.lock:
+            return [(k, v, e) for k, (v, e) in self.entries.items() if e > now]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,413 @@
+import collections
+import socket
+import select
+import ssl
+import errno
+import threading
+import logging
+from .lib import monotonic
+from .cache import TTLCache
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:59.0) Gecko/20100101 Firefox/59.0'
+
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+# What a connection waits for before it can go on
+WANT_READ = 1
+WANT_WRITE = 2
+
+# Client side sessions can only be resumed from Python 3.6
+SESSION_RESUMPTION = hasattr(ssl, 'SSLSession')
+
+
+def make_context():
+    """ TLS context shared by the probes, the certificates are not verified as the probes only measure """
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class Probe():
+    """ HTTP GET of host:port/path, holds the response code and the timings in ms from the start of the probe
+
+    The timings mark the end of every phase: connect_start_ms (the address resolved), connect_ms, tls_ms,
+    request_sent_ms, first_byte_ms and last_byte_ms, so the time spent in a phase is the difference with the
+    previous one. The phases a probe did not go through are None (connect and TLS on a reused connection), as is
+    last_byte_ms when the body was not read to its end (without keepalive only the status line is read).
+    """
+
+    def __init__(self, host, port, path='/', use_ssl=False, ipv6=False):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.use_ssl = use_ssl
+        self.ipv6 = ipv6
+
+        self.response_code = 0
+        self.connect_start_ms = None
+        self.connect_ms = None
+        self.tls_ms = None
+        self.handshake_ms = None
+        self.tls_resumed = None
+        self.request_sent_ms = None
+        self.first_byte_ms = None
+        self.last_byte_ms = None
+        self.reused = False
+        self.error = None
+
+    @property
+    def url(self):
+        return '%s:%i' % (self.host, self.port)
+
+    @property
+    def key(self):
+        """ Probes with the same key can share a keep-alive connection """
+        return self.host, self.port, self.use_ssl, self.ipv6
+
+
+class IdleConnections():
+    """ Keep-alive connections waiting for the next probe to the same host, shared by the engines of all the threads
+
+    Connections idle longer than max_idle seconds are closed, the servers usually drop them soon after.
+    """
+
+    def __init__(self, max_per_host=4, max_idle=5):
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Most recently used connection to key still fresh, None if there is none """
+        now = monotonic()
+        with self.lock:
+            idle = self.connections.get(key, [])
+            while idle:
+                sock, since = idle.pop()
+                if now - since < self.max_idle:
+                    return sock
+                sock.close()
+        return None
+
+    def put(self, key, sock):
+        with self.lock:
+            idle = self.connections.setdefault(key, [])
+            if len(idle) >= self.max_per_host:
+                idle.pop(0)[0].close()
+            idle.append((sock, monotonic()))
+
+    def close(self):
+        with self.lock:
+            for idle in self.connections.values():
+                for sock, since in idle:
+                    sock.close()
+            self.connections.clear()
+
+
+class Connection():
+    """ State of a probe in the engine, the socket moves through connect, TLS handshake, send and receive """
+
+    def __init__(self, probe, sock, start, reused=False):
+        self.probe = probe
+        self.sock = sock
+        self.start = start
+        self.reused = reused
+        self.step = None
+        self.want = WANT_WRITE
+
+        self.request = b''
+        self.buffer = b''
+        self.status_end = -1
+        self.headers_end = -1
+        self.body_left = None
+        self.keepalive = False
+
+    def elapsed_ms(self, now):
+        return (now - self.start) * 1000
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class ProbeEngine():
+    """ Run many HTTP probes concurrently from a single thread
+
+    Every probe is a non-blocking socket driven by a select loop, the response is read only until its status line
+    is parsed. With keepalive the response is read to its end instead and the connection is kept in idle for the
+    next probe to the same host, a reused connection that turns out to be closed is retried on a new one. The probes
+    to a host with a probe in flight wait for it to finish and take over its connection. The TLS
+    handshakes share one context and resume the last session of the host when the Python version allows it.
+    """
+
+    def __init__(self, timeout=2, keepalive=False, idle=None, context=None, sessions=None, logger=None):
+        # Error Checks
+        if timeout <= 0:
+            raise ValueError("The timeout should be greater than 0")
+
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.idle = idle if idle is not None else IdleConnections()
+        self.context = context if context is not None else make_context()
+        # TLS session of every host:port, resumed by the next handshake while the server keeps it
+        self.sessions = sessions if sessions is not None else TTLCache(max_size=1024, ttl=300)
+        self.logger = logger if logger is not None else logging.getLogger('http_probe')
+
+        self.probes = []
+
+    def add(self, probe):
+        self.probes.append(probe)
+        return probe
+
+    def _request(self, probe):
+        return ('GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: %s\r\nConnection: %s\r\n\r\n'
+                % (probe.path, probe.host, USER_AGENT, 'keep-alive' if self.keepalive else 'close')).encode('ascii')
+
+    def _open(self, probe, start, reuse=True):
+        """ Connection for the probe, a keep-alive one if there is one idle and reuse is set """
+        if self.keepalive and reuse:
+            sock = self.idle.get(probe.key)
+            if sock is not None:
+                conn = Connection(probe, sock, start, reused=True)
+                probe.reused = True
+                self._start_request(conn)
+                return conn
+
+        family = socket.AF_INET6 if probe.ipv6 else socket.AF_INET
+        address = socket.getaddrinfo(probe.host, probe.port, family, socket.SOCK_STREAM)[0][4]
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        conn = Connection(probe, sock, start)
+        probe.connect_start_ms = conn.elapsed_ms(monotonic())
+        conn.step = self._connect
+        err = sock.connect_ex(address)
+        if err != 0 and err not in CONNECT_IN_PROGRESS:
+            sock.close()
+            raise socket.error(err, errno.errorcode.get(err, str(err)))
+        return conn
+
+    def _connect(self, conn, now):
+        err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            raise socket.error(err, errno.errorcode.get(err, str(err)))
+        conn.probe.connect_ms = conn.elapsed_ms(now)
+        self.logger.debug("Connected to %s in %0.2f ms" % (conn.probe.url, conn.probe.connect_ms))
+
+        if conn.probe.use_ssl:
+            kwargs = {'server_hostname': conn.probe.host, 'do_handshake_on_connect': False}
+            if SESSION_RESUMPTION:
+                # A session can only be resumed with the context that created it
+                context, session = self.sessions.get(conn.probe.url, (None, None))
+                if context is self.context:
+                    kwargs['session'] = session
+            conn.sock = self.context.wrap_socket(conn.sock, **kwargs)
+            conn.step = self._handshake
+            self._handshake(conn, now)
+        else:
+            self._start_request(conn)
+
+    def _handshake(self, conn, now):
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                conn.want = WANT_READ
+                return
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                conn.want = WANT_WRITE
+                return
+            raise
+        probe = conn.probe
+        probe.tls_ms = conn.elapsed_ms(monotonic())
+        probe.handshake_ms = probe.tls_ms - probe.connect_ms
+        if SESSION_RESUMPTION:
+            probe.tls_resumed = conn.sock.session_reused
+        self.logger.debug("TLS handshake with %s done in %0.2f ms, resumed %s" % (probe.url, probe.handshake_ms,
+                                                                                probe.tls_resumed))
+        self._start_request(conn)
+
+    def _start_request(self, conn):
+        conn.request = self._request(conn.probe)
+        conn.step = self._send
+        conn.want = WANT_WRITE
+
+    def _send(self, conn, now):
+        try:
+            sent = conn.sock.send(conn.request)
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        conn.request = conn.request[sent:]
+        if not conn.request:
+            conn.probe.request_sent_ms = conn.elapsed_ms(monotonic())
+            conn.step = self._receive
+            conn.want = WANT_READ
+
+    def _receive(self, conn, now):
+        """ Read what is available, returns True when the probe is done """
+        while True:
+            try:
+                data = conn.sock.recv(4096)
+            except ssl.SSLError as e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    return False
+                raise
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+
+            if not data:
+                if conn.status_end < 0:
+                    raise socket.error(errno.ECONNRESET, "Connection closed before the status line")
+                # The server closed the connection, it is not reused
+                conn.keepalive = False
+                return True
+
+            conn.probe.last_byte_ms = conn.elapsed_ms(now)
+            if conn.probe.first_byte_ms is None:
+                conn.probe.first_byte_ms = conn.probe.last_byte_ms
+            if self._parse(conn, data):
+                return True
+            # TLS may hold decrypted data that select does not see
+            if not (conn.probe.use_ssl and conn.sock.pending()):
+                return False
+
+    def _parse(self, conn, data):
+        """ Add the data to the response, returns True when nothing else has to be read """
+        conn.buffer += data
+
+        if conn.status_end < 0:
+            conn.status_end = conn.buffer.find(b'\r\n')
+            if conn.status_end < 0:
+                return False
+            parts = conn.buffer[:conn.status_end].split(None, 2)
+            try:
+                conn.probe.response_code = int(parts[1])
+            except (IndexError, ValueError):
+                raise ValueError("Invalid status line from %s" % conn.probe.url)
+            if not self.keepalive:
+                return True
+
+        if conn.headers_end < 0:
+            conn.headers_end = conn.buffer.find(b'\r\n\r\n')
+            if conn.headers_end < 0:
+                return False
+            conn.body_left = self._body_length(conn)
+            if conn.body_left is None:
+                # The end of the body is the end of the connection, read no further
+                return True
+            conn.keepalive = True
+            conn.body_left -= len(conn.buffer) - conn.headers_end - 4
+        else:
+            conn.body_left -= len(data)
+
+        return conn.body_left <= 0
+
+    def _body_length(self, conn):
+        """ Length of the body, None when the connection can not be reused after it """
+        headers = {}
+        for line in conn.buffer[conn.status_end + 2:conn.headers_end].split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        if headers.get(b'connection') == b'close' or b'transfer-encoding' in headers:
+            return None
+        code = conn.probe.response_code
+        if code == 204 or code == 304 or 100 <= code < 200:
+            return 0
+        try:
+            return int(headers[b'content-length'])
+        except (KeyError, ValueError):
+            return None
+
+    def _finish(self, conn, now):
+        if conn.body_left is None or conn.body_left > 0:
+            # The last byte read is not the last byte of the response
+            conn.probe.last_byte_ms = None
+        # Sessions sent after the handshake (TLS 1.3) are only there once the response was read
+        if conn.probe.use_ssl and SESSION_RESUMPTION and conn.sock.session is not None:
+            session = conn.sock.session
+            self.sessions.set(conn.probe.url, (self.context, session), ttl=session.timeout or None)
+        if self.keepalive and conn.keepalive and conn.body_left == 0:
+            self.idle.put(conn.probe.key, conn.sock)
+        else:
+            conn.sock.close()
+        self.logger.info("Response code %i from %s" % (conn.probe.response_code, conn.probe.url))
+
+    def _fail(self, conn, error):
+        conn.sock.close()
+        conn.probe.response_code = 0
+        conn.probe.error = error
+        self.logger.error("Error probing %s: %s" % (conn.probe.url, error))
+
+    def _start(self, probe, active):
+        """ Open the connection of the probe and add it to active, returns False if it could not connect """
+        try:
+            active.append(self._open(probe, monotonic()))
+            return True
+        except (socket.error, socket.gaierror) as e:
+            probe.error = e
+            self.logger.error("Error connecting to %s: %s" % (probe.url, e))
+            return False
+
+    def _next(self, key, active, waiting):
+        """ Start the next probe waiting for the connection to key """
+        queue = waiting.get(key)
+        while queue:
+            if self._start(queue.popleft(), active):
+                return
+
+    def run(self):
+        """ Run every probe and return the list of Probe with the results """
+        active = []
+        # Probes waiting for the probe in flight to the same host, by key, only with keepalive
+        waiting = {}
+        for probe in self.probes:
+            if self.keepalive and probe.key in waiting:
+                waiting[probe.key].append(probe)
+            elif self._start(probe, active) and self.keepalive:
+                waiting[probe.key] = collections.deque()
+
+        while active:
+            now = monotonic()
+            for conn in [c for c in active if now - c.start >= self.timeout]:
+                active.remove(conn)
+                if conn.status_end >= 0:
+                    # The status line arrived but not the whole body, the connection is not reused
+                    conn.keepalive = False
+                    self._finish(conn, now)
+                else:
+                    self._fail(conn, socket.timeout("Timeout after %s seconds" % self.timeout))
+                self._next(conn.probe.key, active, waiting)
+            if not active:
+                break
+
+            wait = min(c.start for c in active) + self.timeout - now
+            readable, writable, _ = select.select([c for c in active if c.want == WANT_READ],
+                                                  [c for c in active if c.want == WANT_WRITE], [], max(wait, 0))
+            now = monotonic()
+            for conn in readable + writable:
+                try:
+                    if conn.step(conn, now):
+                        active.remove(conn)
+                        self._finish(conn, now)
+                        self._next(conn.probe.key, active, waiting)
+                except Exception as e:
+                    active.remove(conn)
+                    if conn.reused and conn.probe.response_code == 0:
+                        # The server closed the idle connection, retry on a new one
+                        conn.sock.close()
+                        self.logger.debug("Idle connection to %s closed, reconnecting" % conn.probe.url)
+                        conn.probe.reused = False
+                        try:
+                            active.append(self._open(conn.probe, monotonic(), reuse=False))
+                        except (socket.error, socket.gaierror) as e:
+                            self._fail(conn, e)
+                            self._next(conn.probe.key, active, waiting)
+                    else:
+                        self._fail(conn, e)
+                        self._next(conn.probe.key, active, waiting)
+
+        return self.probes
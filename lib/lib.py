@@ -2,63 +2,129 @@ import struct
 from ctypes import *
 import socket
 import platform
+import time
+import sys
 
 
-
-class IP(Structure):
+class timespec(Structure):
     _fields_ = [
-        ("ihl", c_ubyte, 4),
-        ("version", c_ubyte, 4),
-        ("tos", c_ubyte),
-        ("len", c_ushort),
-        ("id", c_ushort),
-        ("flags", c_ushort),
-        ("ttl", c_ubyte),
-        ("protocol_num", c_ubyte),
-        ("sum", c_ushort),
-        # Could be a problem for 32 or 64 bits, original type was c_ulong
-        ("src", c_uint32),
-        ("dst", c_uint32)
+        ("tv_sec", c_long),
+        ("tv_nsec", c_long)
     ]
 
-    def __new__(self, socket_buffer=None):
-        return self.from_buffer_copy(socket_buffer)
 
-    def __init__(self, socket_buffer=None):
+def _clock_gettime_monotonic():
+    """ Fallback monotonic clock for interpreters without time.monotonic (linux only) """
+    CLOCK_MONOTONIC = 1
+    librt = CDLL('librt.so.1', use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [c_int, POINTER(timespec)]
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, pointer(t)) != 0:
+            raise OSError(get_errno(), "clock_gettime failed")
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+
+# Monotonic clock in seconds to measure intervals, never goes backwards with wall clock changes
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    try:
+        monotonic = _clock_gettime_monotonic()
+    except (OSError, AttributeError):
+        monotonic = time.time
+
+
+# map protocol constants to their names
+PROTOCOL_MAP = {6: "TCP", 17: "UDP", 1: "ICMP"}
+
+# version/ihl, tos, len, id, flags, ttl, protocol, sum, src and dst of the IPv4 header
+IP_HEADER = struct.Struct('!BBHHHBBH4s4s')
+# type, code, checksum, id and sequence of the ICMPv4 echo header in network byte order
+ICMP_HEADER = struct.Struct('!BBHHH')
+
+
+IP_FIELDS = frozenset(['version_ihl', 'tos', 'len', 'id', 'flags', 'ttl', 'protocol_num', 'sum', 'src', 'dst'])
+ICMP_FIELDS = frozenset(['icmp_type', 'icmp_code', 'checksum', 'id_be', 'sequence_be', 'id_le', 'sequence_le'])
+
 
-        # map protocol constants to their names
-        self.protocol_map = {6: "TCP", 17: "UDP", 1: "ICMP"}
+class IP(object):
+    """ IPv4 header view over a receive buffer
 
+    Nothing is copied, all the fields are decoded at once from the buffer the first time one of them is accessed
+    and the addresses are only formatted when they are asked for.
+    """
+    __slots__ = ('buffer', 'offset', 'version_ihl', 'tos', 'len', 'id', 'flags', 'ttl', 'protocol_num', 'sum',
+                 'src', 'dst')
+
+    def __init__(self, socket_buffer, offset=0):
+        self.buffer = socket_buffer
+        self.offset = offset
+
+    def __getattr__(self, name):
+        # Only called while the header fields are not decoded yet
+        if name not in IP_FIELDS:
+            raise AttributeError(name)
+        (self.version_ihl, self.tos, self.len, self.id, self.flags, self.ttl, self.protocol_num, self.sum,
+         self.src, self.dst) = IP_HEADER.unpack_from(self.buffer, self.offset)
+        return getattr(self, name)
+
+    @property
+    def version(self):
+        return self.version_ihl >> 4
+
+    @property
+    def ihl(self):
+        return self.version_ihl & 0x0f
+
+    @property
+    def header_length(self):
+        """ Length of the header in bytes, the offset of the payload """
+        return (self.version_ihl & 0x0f) * 4
+
+    @property
+    def src_address(self):
         # human readable IP addresses
-        self.src_address = socket.inet_ntoa(struct.pack("<L", self.src))
-        self.dst_address = socket.inet_ntoa(struct.pack("<L", self.dst))
+        return socket.inet_ntoa(self.src)
 
-        self.ttl = self.ttl
+    @property
+    def dst_address(self):
+        return socket.inet_ntoa(self.dst)
 
+    @property
+    def protocol(self):
         # human readable protocol
         try:
-            self.protocol = self.protocol_map[self.protocol_num]
-        except:
-            self.protocol = str(self.protocol_num)
+            return PROTOCOL_MAP[self.protocol_num]
+        except KeyError:
+            return str(self.protocol_num)
 
 
-class ICMPv4(Structure):
-    _fields_ = [
-        ("icmp_type", c_ubyte),
-        ("icmp_code", c_ubyte),
-        ("checksum", c_ushort),
-        ("id", c_ushort),
-        ("sequence", c_ushort)
-    ]
+class ICMPv4(object):
+    """ ICMPv4 echo header view over a receive buffer, usually at the offset given by IP.header_length
+
+    The id and sequence are available in network byte order (id_be, sequence_be) and in the native byte order used
+    to build the echo requests (id_le, sequence_le).
+    """
+    __slots__ = ('buffer', 'offset', 'icmp_type', 'icmp_code', 'checksum', 'id_be', 'sequence_be', 'id_le',
+                 'sequence_le')
+
+    def __init__(self, socket_buffer, offset=0):
+        self.buffer = socket_buffer
+        self.offset = offset
 
-    def __new__(self, socket_buffer):
-        return self.from_buffer_copy(socket_buffer)
-
-    def __init__(self, socket_buffer):
-        self.icmp_type = self.icmp_type
-        self.icmp_code = self.icmp_code
-        self.checksum = struct.unpack(">H", struct.pack("<H", self.checksum))[0]
-        self.id_le = self.id
-        self.id_be = struct.unpack(">H", struct.pack("<H", self.id))[0]
-        self.sequence_le = self.sequence
-        self.sequence_be = struct.unpack(">H", struct.pack("<H", self.sequence))[0]
\ No newline at end of file
+    def __getattr__(self, name):
+        # Only called while the header fields are not decoded yet
+        if name not in ICMP_FIELDS:
+            raise AttributeError(name)
+        (self.icmp_type, self.icmp_code, self.checksum, self.id_be,
+         self.sequence_be) = ICMP_HEADER.unpack_from(self.buffer, self.offset)
+        if sys.byteorder == 'little':
+            self.id_le = ((self.id_be & 0xff) << 8) | (self.id_be >> 8)
+            self.sequence_le = ((self.sequence_be & 0xff) << 8) | (self.sequence_be >> 8)
+        else:
+            self.id_le, self.sequence_le = self.id_be, self.sequence_be
+        return getattr(self, name)
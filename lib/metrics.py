@@ -0,0 +1,307 @@
+import bisect
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+from .lib import monotonic
+
+# Upper bounds in seconds of the buckets of the histograms, from a fast SQLite insert to a slow check
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    """ Family of samples sharing a name, one child per combination of label values, created by calling child """
+
+    kind = None
+
+    def __init__(self, name, help, labels, child):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.child = child
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """ Child of the label values, created on first use """
+        if len(values) != len(self.label_names):
+            raise ValueError("%s needs the labels %s" % (self.name, ", ".join(self.label_names)))
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self.children[values] = self.child()
+        return child
+
+    def reset(self):
+        self.lock = threading.Lock()
+        for child in self.children.values():
+            child.reset()
+
+    def snapshot(self):
+        return {'type': self.kind, 'help': self.help, 'labels': list(self.label_names),
+                'samples': [[list(values), child.value()] for values, child in list(self.children.items())]}
+
+
+class CounterChild():
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.count += amount
+
+    def value(self):
+        return self.count
+
+
+class GaugeChild():
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def value(self):
+        return self.current
+
+
+class HistogramChild():
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        # The last count is the +Inf bucket, the counts are not cumulative until they are exported
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        """ Observe the seconds spent in the with block """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start)
+
+    def value(self):
+        with self.lock:
+            return [list(self.counts), self.sum]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        Metric.__init__(self, name, help, labels, CounterChild)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        Metric.__init__(self, name, help, labels, GaugeChild)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        buckets = tuple(sorted(buckets))
+        Metric.__init__(self, name, help, labels, lambda: HistogramChild(buckets))
+        self.buckets = buckets
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def snapshot(self):
+        snapshot = Metric.snapshot(self)
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+
+class Registry():
+    """ Counters, gauges and histograms of a process
+
+    Every update is an increment under the lock of a single sample, cheap enough to keep the instrumentation on. The
+    metrics are declared once by name, declaring an existing name returns it. A snapshot is a JSON document, the
+    snapshots of several processes are rendered together by render.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.label_names != tuple(labels):
+                raise ValueError("The metric %s is already declared with other type or labels" % name)
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return dict((metric.name, metric.snapshot()) for metric in metrics)
+
+    def reset(self):
+        """ Zero every sample and replace the locks, for a forked process: it inherits the counts of its parent and
+        the locks held by the threads of the parent, which do not exist in the child """
+        self.lock = threading.Lock()
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def write(self, file_name):
+        """ Write the snapshot atomically, a reader never sees it half written """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file_name) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.rename(tmp, file_name)
+
+
+def render(snapshots):
+    """ Prometheus text format of a list of (process, snapshot), every sample gets a process label """
+    families = {}
+    for process, snapshot in snapshots:
+        for name, family in snapshot.items():
+            families.setdefault(name, []).append((process, family))
+
+    lines = []
+    for name in sorted(families):
+        first = families[name][0][1]
+        lines.append('# HELP %s %s' % (name, first['help'].replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE %s %s' % (name, first['type']))
+        for process, family in families[name]:
+            names = ['process'] + family['labels']
+            for values, value in family['samples']:
+                values = [process] + values
+                if family['type'] != 'histogram':
+                    lines.append('%s%s %s' % (name, format_labels(names, values), format_value(value)))
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(family['buckets'] + [float('inf')], counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %i' % (name, format_labels(names + ['le'], values + [
+                        format_value(float(bound))]), cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels(names, values), format_value(total)))
+                lines.append('%s_count%s %i' % (name, format_labels(names, values), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def read_snapshots(directory, max_age=300, clock=time.time):
+    """ List of (process, snapshot) of the snapshots written in directory during the last max_age seconds, the
+    process is the file name without the extension """
+    snapshots = []
+    if directory is None or not os.path.isdir(directory):
+        return snapshots
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.json'):
+            continue
+        path = os.path.join(directory, file_name)
+        try:
+            if clock() - os.path.getmtime(path) > max_age:
+                continue
+            with open(path, 'r') as f:
+                snapshots.append((file_name[:-len('.json')], json.load(f)))
+        except (IOError, OSError, ValueError):
+            continue
+    return snapshots
+
+
+class Exporter():
+    """ Thread writing the snapshot of the registry to file_name every interval seconds, and once more on stop """
+
+    def __init__(self, registry, file_name, interval=10):
+        self.registry = registry
+        self.file_name = file_name
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='metrics-exporter')
+        self.thread.daemon = True
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.registry.write(self.file_name)
+
+    def start(self):
+        directory = os.path.dirname(self.file_name)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Already created, by another process too
+            if not os.path.isdir(directory):
+                raise
+        self.registry.write(self.file_name)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.registry.write(self.file_name)
+
+
+# Registry of the process, the modules declare their metrics on it
+REGISTRY = Registry()
+
+# Duration of every run of a check, shared by the checkers
+CHECK_SECONDS = REGISTRY.histogram('monitor_check_duration_seconds', 'Duration of a run of a check', ('check',))
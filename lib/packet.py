@@ -0,0 +1,65 @@
+import struct
+import array
+
+ICMP_ECHO_REQUEST = 8
+
+# Default payload of the echo requests, the 48 letters from 'A'
+PAYLOAD = bytes(bytearray(range(65, 65 + 48)))
+
+# ICMP echo header: type, code, checksum, id and sequence (native byte order, see checksum)
+ECHO_HEADER = struct.Struct('BBHHH')
+
+
+def ones_comp_sum(data):
+    """ Ones complement sum of the 16 bit words of data, not folded
+
+    The words are read in the native byte order, the result is valid as long as it is written back in the same
+    byte order (RFC 1071) which avoids any byte swapping.
+    """
+    if len(data) % 2:
+        data = data + b'\0'
+    return sum(array.array('H', data))
+
+
+def fold(total):
+    """ Fold the carries of a ones complement sum into 16 bits """
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return total
+
+
+def checksum(data):
+    """ Internet checksum of data in native byte order """
+    return ~fold(ones_comp_sum(data)) & 0xffff
+
+
+def make_payload(size):
+    """ Payload of size bytes repeating the letters from 'A' to 'p' like the default one """
+    if not isinstance(size, int):
+        raise TypeError("The payload size should be an integer")
+    if size < 0:
+        raise ValueError("The payload size should be greater than or equal to 0")
+    return (PAYLOAD * (size // len(PAYLOAD) + 1))[:size]
+
+
+class EchoTemplate():
+    """ Precomputed ICMP echo request
+
+    The payload and the ones complement sum of everything but the id and sequence fields are computed once, every
+    request then costs two additions, a fold and a struct pack.
+    """
+
+    def __init__(self, payload=PAYLOAD):
+        if not isinstance(payload, bytes):
+            raise TypeError("The payload should be bytes")
+
+        self.payload = payload
+        self.partial_sum = ones_comp_sum(ECHO_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, 0, 0) + payload)
+
+    def __len__(self):
+        return ECHO_HEADER.size + len(self.payload)
+
+    def build(self, id, sequence):
+        """ Echo request packet for id and sequence with a valid checksum """
+        csum = ~fold(self.partial_sum + id + sequence) & 0xffff
+        return ECHO_HEADER.pack(ICMP_ECHO_REQUEST, 0, csum, id, sequence) + self.payload
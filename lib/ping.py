@@ -0,0 +1,329 @@
+import socket
+import select
+import struct
+import collections
+import errno
+import time
+import sys
+import os
+import logging
+from .lib import monotonic
+from .metrics import REGISTRY
+from .packet import EchoTemplate, PAYLOAD
+
+MOD = 1 << 16
+
+ICMP_ECHO_REPLY = 0
+
+# Raw header fields needed to filter a received packet: version/ihl, protocol and source address
+IP_FILTER = struct.Struct('!B8xB2x4s')
+# ICMP type, code, checksum, id and sequence in the byte order used to send them
+ICMP_ECHO = struct.Struct('BBHHH')
+
+# Kernel receive timestamps, Linux only. The socket module does not export the constant
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35 if sys.platform.startswith('linux') else None)
+# struct timespec carried by the SCM_TIMESTAMPNS control message
+TIMESPEC = struct.Struct('@ll')
+# Errors of a non blocking socket with nothing left to read
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+# Largest IPv4 header, the ICMP header is added to it
+MAX_IP_HEADER = 60
+
+REQUESTS_SENT = REGISTRY.counter('monitor_ping_requests_total', 'Echo requests sent')
+TIMEOUTS = REGISTRY.counter('monitor_ping_timeouts_total', 'Echo requests without a reply before the timeout')
+SOCKET_ERRORS = REGISTRY.counter('monitor_ping_socket_errors_total', 'Errors sending or receiving', ('operation',))
+# Echo replies received: matched to a request, unmatched (duplicated or already expired), late (after the timeout)
+# or foreign (for an id or from a source not ours, dropped)
+REPLIES = REGISTRY.counter('monitor_ping_replies_total', 'Echo replies received by result', ('result',))
+REPLIES_MATCHED = REPLIES.labels('matched')
+REPLIES_UNMATCHED = REPLIES.labels('unmatched')
+REPLIES_LATE = REPLIES.labels('late')
+REPLIES_FOREIGN = REPLIES.labels('foreign')
+
+
+class PingTarget():
+
+    def __init__(self, dst_ip, id, count):
+        self.dst_ip = dst_ip
+        self.dst_addr = socket.inet_aton(socket.gethostbyname(dst_ip))
+        self.id = id
+        self.count = count
+
+        self.rtt_list = []
+        self.sent = 0
+
+    @property
+    def pkt_loss(self):
+        return self.sent - len(self.rtt_list)
+
+    @property
+    def rtt_avg(self):
+        if len(self.rtt_list) == 0:
+            return 0
+        return sum(self.rtt_list) / float(len(self.rtt_list))
+
+    @property
+    def rtt_min(self):
+        return min(self.rtt_list) if self.rtt_list else None
+
+    @property
+    def rtt_max(self):
+        return max(self.rtt_list) if self.rtt_list else None
+
+
+class InFlightTable():
+    """ Echo requests waiting for a reply keyed by (icmp id, sequence)
+
+    Matching a reply is a dict lookup, so out of order, duplicated and late replies are resolved in O(1). The
+    requests are also queued in send order, which lets the timed out ones expire from the head of the queue.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.order = collections.deque()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, id, sequence, target, send_time):
+        key = (id, sequence)
+        self.pending[key] = (target, send_time)
+        self.order.append((send_time, key))
+
+    def pop(self, id, sequence):
+        """ Remove and return the (target, send_time) waiting for this reply, None if there is nothing """
+        return self.pending.pop((id, sequence), None)
+
+    def oldest(self):
+        """ Send time of the oldest request still in the queue, None if the queue is empty """
+        while self.order:
+            send_time, key = self.order[0]
+            entry = self.pending.get(key)
+            if entry is not None and entry[1] == send_time:
+                return send_time
+            # Already answered or replaced, discard it
+            self.order.popleft()
+        return None
+
+    def expire(self, limit):
+        """ Remove and return the (target, send_time) of the requests sent before limit """
+        expired = []
+        while self.order and self.order[0][0] <= limit:
+            send_time, key = self.order.popleft()
+            entry = self.pending.get(key)
+            if entry is not None and entry[1] == send_time:
+                del self.pending[key]
+                expired.append(entry)
+        return expired
+
+
+class PingEngine():
+    """ Ping many targets over a single raw ICMP socket
+
+    Every target gets its own ICMP id so the replies can be demultiplexed by (id, sequence), the sends of each
+    round are spread evenly over the interval to avoid bursts and a select loop drives sending and receiving from
+    a single thread.
+
+    Every wakeup drains the socket into a ring of preallocated buffers, up to batch packets, without allocating a
+    new string per packet. Where the kernel can timestamp the packets (SO_TIMESTAMPNS and recvmsg_into) the RTT is
+    measured up to that timestamp instead of up to the moment the reply is processed.
+    """
+
+    def __init__(self, sock, base_id, count=3, timeout=2, interval=1, payload=PAYLOAD, batch=64, logger=None):
+        # Error Checks
+        if not isinstance(count, int):
+            raise TypeError("The number of packets should be an integer")
+        if count <= 0:
+            raise ValueError("The number of packets should be greater than or equal to 1")
+        if count >= MOD:
+            raise ValueError("The number of packets should be lower than %i" % MOD)
+        if timeout <= 0:
+            raise ValueError("The timeout should be greater than 0")
+        if batch <= 0:
+            raise ValueError("The batch should be greater than 0")
+
+        self.sock = sock
+        self.base_id = base_id
+        self.count = count
+        self.timeout = timeout
+        self.interval = interval
+        self.template = EchoTemplate(payload)
+        self.logger = logger if logger is not None else logging.getLogger('ping_engine')
+
+        self.targets = []
+        self.targets_by_id = {}
+        self.in_flight = InFlightTable()
+
+        # Ring of receive buffers, big enough for the echo reply of our payload
+        buffer_size = MAX_IP_HEADER + 8 + len(payload)
+        self.buffers = [bytearray(buffer_size) for _ in range(batch)]
+        self.views = [memoryview(buf) for buf in self.buffers]
+        self.kernel_timestamps = self._enable_timestamps()
+
+        # Replies without a request waiting for them (duplicated, late or not ours)
+        self.unmatched = 0
+
+    def add_target(self, dst_ip):
+        """ Add a destination to ping, returns the PingTarget holding its results """
+        if len(self.targets) >= MOD:
+            raise ValueError("Too many targets, only %i ICMP ids available" % MOD)
+
+        id = (self.base_id + len(self.targets)) % MOD
+        target = PingTarget(dst_ip, id, self.count)
+        self.targets.append(target)
+        self.targets_by_id[id] = target
+        return target
+
+    def _schedule(self, start):
+        """ Generator of (send_time, target, sequence) spreading every round over the interval """
+        slot = self.interval / float(len(self.targets))
+        for i in range(0, self.count):
+            for k, target in enumerate(self.targets):
+                yield start + i * self.interval + k * slot, target, i + 1
+
+    def _send(self, target, sequence):
+        self.logger.debug("Sending icmp packet seq %i to %s" % (sequence, target.dst_ip))
+        packet = self.template.build(target.id, sequence)
+        # Taken before sending, a kernel timestamp of the reply can be earlier than the return of sendto
+        send_time = monotonic()
+        try:
+            self.sock.sendto(packet, (target.dst_ip, 0))
+        except socket.error as e:
+            self.logger.error("Error sending icmp packet to %s: %s" % (target.dst_ip, e))
+            SOCKET_ERRORS.labels('send').inc()
+            return
+        self.in_flight.add(target.id, sequence, target, send_time)
+        target.sent += 1
+        REQUESTS_SENT.inc()
+
+    def _enable_timestamps(self):
+        """ Ask the kernel to timestamp the received packets, returns False if it is not available """
+        if SO_TIMESTAMPNS is None or not hasattr(self.sock, 'recvmsg_into'):
+            return False
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        except socket.error as e:
+            self.logger.debug("Kernel timestamps not available: %s" % e)
+            return False
+        self.ancillary_size = socket.CMSG_SPACE(TIMESPEC.size)
+        return True
+
+    def _receive_one(self, index):
+        """ Read a packet into the buffer index, returns its length and its kernel timestamp (None if unknown) """
+        if not self.kernel_timestamps:
+            return self.sock.recvfrom_into(self.buffers[index])[0], None
+
+        length, ancillary, flags, addr = self.sock.recvmsg_into([self.views[index]], self.ancillary_size)
+        for level, kind, data in ancillary:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(data) >= TIMESPEC.size:
+                seconds, nanoseconds = TIMESPEC.unpack_from(data)
+                return length, seconds + nanoseconds / 1e9
+        return length, None
+
+    def _receive(self):
+        """ Drain up to batch packets from the socket """
+        for index in range(len(self.buffers)):
+            try:
+                length, stamp = self._receive_one(index)
+            except socket.error as e:
+                if e.args and e.args[0] not in WOULD_BLOCK:
+                    self.logger.error("Error receiving icmp packet: %s" % e)
+                    SOCKET_ERRORS.labels('receive').inc()
+                return
+
+            now = monotonic()
+            if stamp is not None:
+                # Move the kernel timestamp to the monotonic clock, only the time spent queued uses the wall clock
+                now -= max(time.time() - stamp, 0)
+            self.process_reply(self.buffers[index], now, length)
+
+    def process_reply(self, data, now, length=None):
+        """ Match a received packet, the first length bytes of data, against the requests in flight using only
+        its raw header bytes """
+        length = len(data) if length is None else length
+        if length < 28:
+            return
+        version_ihl, protocol, src_addr = IP_FILTER.unpack_from(data)
+        if protocol != socket.IPPROTO_ICMP:
+            return
+        ihl = (version_ihl & 0x0f) * 4
+        if length < ihl + 8:
+            return
+        icmp_type, icmp_code, _, id, sequence = ICMP_ECHO.unpack_from(data, ihl)
+        if icmp_type != ICMP_ECHO_REPLY or icmp_code != 0:
+            return
+
+        target = self.targets_by_id.get(id)
+        if target is None or src_addr != target.dst_addr:
+            REPLIES_FOREIGN.inc()
+            return
+
+        entry = self.in_flight.pop(id, sequence)
+        if entry is None:
+            self.unmatched += 1
+            REPLIES_UNMATCHED.inc()
+            self.logger.debug("Duplicated or late reply from %s icmp_seq=%i" % (target.dst_ip, sequence))
+            return
+
+        rtt = (now - entry[1]) * 1000
+        if rtt > self.timeout * 1000:
+            self.logger.debug("Late reply from %s icmp_seq=%i" % (target.dst_ip, sequence))
+            REPLIES_LATE.inc()
+            return
+        target.rtt_list.append(rtt)
+        REPLIES_MATCHED.inc()
+        self.logger.info("%i bytes from %s: icmp_seq=%i time=%0.2f ms" % (length - ihl, target.dst_ip,
+                                                                         sequence, rtt))
+
+    def _expire(self, now):
+        for target, send_time in self.in_flight.expire(now - self.timeout):
+            self.logger.info("Ping timeout to %s" % target.dst_ip)
+            TIMEOUTS.inc()
+
+    def run(self):
+        """ Ping every target and return the list of PingTarget with the results """
+        if len(self.targets) == 0:
+            return []
+
+        if os.name == 'nt':
+            self.logger.info('Windows OS, enabling RCVALL')
+            # receive all packages in windows
+            self.sock.ioctl(socket.SIO_RCVALL, socket.RCVALL_ON)
+
+        # The socket is drained until it would block
+        previous_timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            schedule = self._schedule(monotonic())
+            next_send = next(schedule, None)
+
+            while True:
+                now = monotonic()
+                while next_send is not None and next_send[0] <= now:
+                    self._send(next_send[1], next_send[2])
+                    next_send = next(schedule, None)
+                self._expire(now)
+
+                # Wake up for the next send or for the next request to time out
+                oldest = self.in_flight.oldest()
+                if next_send is None and oldest is None:
+                    break
+                wakeups = []
+                if oldest is not None:
+                    wakeups.append(oldest + self.timeout)
+                if next_send is not None:
+                    wakeups.append(next_send[0])
+                wait = min(wakeups) - now
+
+                readable, _, _ = select.select([self.sock], [], [], max(wait, 0))
+                if readable:
+                    self._receive()
+        finally:
+            self.sock.settimeout(previous_timeout)
+            if os.name == 'nt':
+                # disabled promiscuous mode in windows
+                self.sock.ioctl(socket.SIO_RCVALL, socket.RCVALL_OFF)
+                self.logger.info('Windows OS, disabling RCVALL')
+
+        return self.targets
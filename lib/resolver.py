@@ -0,0 +1,95 @@
+import json
+import time
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+from .cache import TTLCache
+
+
+class CachedAnswer():
+    """ Answer of a lookup served by CachingResolver, iterates the records like dns.resolver.Answer """
+
+    def __init__(self, rrset):
+        self.rrset = rrset
+
+    def __iter__(self):
+        return iter(self.rrset)
+
+    def __len__(self):
+        return len(self.rrset)
+
+
+class CachingResolver():
+    """ Resolver answering from a bounded cache of the previous lookups
+
+    Every answer is kept during the TTL of its records, the least recently used answers are evicted when the cache is
+    full. Failed lookups are not cached. The cache can be saved to a lib.sqlite.SQLite database and loaded on the
+    next run, the entries expired by then are skipped.
+    """
+
+    def __init__(self, resolver=None, max_size=10000, clock=time.time):
+        self.resolver = resolver if resolver is not None else dns.resolver.Resolver()
+        self.cache = TTLCache(max_size=max_size, clock=clock)
+        self.clock = clock
+
+    @property
+    def lifetime(self):
+        return self.resolver.lifetime
+
+    @lifetime.setter
+    def lifetime(self, value):
+        self.resolver.lifetime = value
+
+    def query(self, name, rdtype):
+        """ Answer of the lookup, from the cache while its TTL has not expired """
+        name = name.to_text() if hasattr(name, 'to_text') else name
+        key = (name.lower(), int(rdtype))
+        answer = self.cache.get(key)
+        if answer is None:
+            rrset = self.resolver.query(name, rdtype).rrset
+            answer = CachedAnswer(rrset)
+            self.cache.set(key, answer, ttl=rrset.ttl)
+        return answer
+
+    def rows(self):
+        """ Rows of the dns_cache_table with the cached answers """
+        return [(name, rdtype, answer.rrset.ttl, json.dumps([r.to_text() for r in answer.rrset]), expiration)
+                for (name, rdtype), answer, expiration in self.cache.items()]
+
+    def add_rows(self, rows):
+        """ Add the rows of the dns_cache_table not expired yet, returns the number of entries added """
+        now = self.clock()
+        added = 0
+        for name, rdtype, ttl, records, expiration in rows:
+            if expiration <= now:
+                continue
+            rrset = dns.rrset.from_text_list(name, ttl, 'IN', dns.rdatatype.to_text(rdtype), json.loads(records))
+            self.cache.set((name.lower(), rdtype), CachedAnswer(rrset), ttl=expiration - now)
+            added += 1
+        return added
+
+    def load(self, db, table_name='dns_cache_table'):
+        """ Add the entries saved on the database not expired yet, returns the number of entries added """
+        return self.add_rows(read_rows(db, self.clock(), table_name))
+
+    def save(self, db, table_name='dns_cache_table'):
+        """ Write the cache on the database, returns the number of entries saved. The entries saved of the same
+        lookups are replaced and the expired ones deleted, so several processes can save their caches """
+        rows = self.rows()
+        db.query('''DELETE FROM {tbl} WHERE expiration <= ?'''.format(tbl=table_name), (self.clock(),))
+        replace_rows(db, rows, table_name)
+        db.commit()
+        return len(rows)
+
+
+def read_rows(db, now, table_name='dns_cache_table'):
+    """ Rows of the answers saved on the database not expired at now """
+    return db.query('''SELECT name, rdtype, ttl, records, expiration FROM {tbl} WHERE expiration > ?'''.format(
+        tbl=table_name), (now,))
+
+
+def replace_rows(db, rows, table_name='dns_cache_table'):
+    """ Save the rows of the answers, replacing the ones saved of the same lookups. Not committed """
+    for row in rows:
+        db.query('''INSERT OR REPLACE INTO {tbl}(name, rdtype, ttl, records, expiration)
+                    VALUES(?, ?, ?, ?, ?)'''.format(tbl=table_name), tuple(row))
@@ -0,0 +1,123 @@
+import threading
+import time
+
+
+class RingBuffer():
+    """ Fixed size buffer keeping the last capacity items appended
+
+    The items live in a preallocated list used as a circular array, appending overwrites the oldest item once the
+    buffer is full. Reading the last n items is O(n).
+    """
+
+    def __init__(self, capacity):
+        # Error Checks
+        if not isinstance(capacity, int):
+            raise TypeError("The capacity of the buffer should be an integer")
+        if capacity <= 0:
+            raise ValueError("The capacity of the buffer should be greater than or equal to 1")
+
+        self.capacity = capacity
+        self.items = [None] * capacity
+        # Position of the next item and number of items stored
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, item):
+        self.items[self.head] = item
+        self.head = (self.head + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def get(self, i):
+        """ The i-th newest item, 0 is the last one appended """
+        if not 0 <= i < self.size:
+            raise IndexError("The buffer holds %i items" % self.size)
+        return self.items[(self.head - 1 - i) % self.capacity]
+
+    def latest(self, n=None, skip=0):
+        """ List of the last n items (all of them when n is None) newest first, after skipping the skip newest """
+        count = self.size - skip if n is None else min(n, self.size - skip)
+        return [self.items[(self.head - 1 - skip - i) % self.capacity] for i in range(max(count, 0))]
+
+    def clear(self):
+        self.items = [None] * self.capacity
+        self.head = 0
+        self.size = 0
+
+
+class HotWindow():
+    """ Last rows of a table kept in memory to serve the newest results without reading the database
+
+    The window is filled from the table when it is created and then refreshed, once it is stale (every
+    refresh_interval seconds), with the rows inserted since, found by their primary key. The window is reloaded when
+    the largest id of the table goes down, the newest rows were deleted and SQLite can hand out their ids again. The
+    database stays the durable store: the rows are answered from the window only when it holds all of them,
+    otherwise rows returns None.
+    """
+
+    def __init__(self, db, table_name, capacity=1000, refresh_interval=1.0, clock=time.time):
+        if refresh_interval < 0:
+            raise ValueError("The refresh interval should be greater than or equal to 0")
+
+        self.table_name = table_name
+        self.ring = RingBuffer(capacity)
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        self.columns = db.get_columns_from_table(table_name)
+        self.last_id = 0
+        # True while the window holds every row of the table
+        self.complete = True
+        self.last_refresh = None
+        self.refresh(db)
+
+    @property
+    def stale(self):
+        """ True when the window was refreshed more than refresh_interval seconds ago """
+        return self.last_refresh is None or self.clock() - self.last_refresh >= self.refresh_interval
+
+    def refresh(self, db):
+        """ Append the rows inserted after the newest one of the window, returns the number of rows added """
+        with self.lock:
+            self.last_refresh = self.clock()
+
+            max_id = db.query('''SELECT max(id) FROM {tbl}'''.format(tbl=self.table_name))[0][0] or 0
+            if max_id < self.last_id:
+                self.ring.clear()
+                self.last_id = 0
+                self.complete = True
+
+            rows = db.query('''SELECT * FROM {tbl} WHERE id > ? ORDER BY id DESC LIMIT ?'''.format(
+                tbl=self.table_name), (self.last_id, self.ring.capacity + 1))
+            if len(rows) > self.ring.capacity or len(rows) + len(self.ring) > self.ring.capacity:
+                self.complete = False
+            for row in reversed(rows[:self.ring.capacity]):
+                self.ring.append(row)
+            if rows:
+                self.last_id = rows[0][0]
+            return len(rows)
+
+    def rows(self, n, after_id=None):
+        """ The last n rows newest first, only the rows older than after_id when given, like
+        lib.sqlite.SQLite.iter_last_n. None if the window does not hold all of them """
+        with self.lock:
+            skip = 0
+            if after_id is not None:
+                # The ids decrease from the newest row, binary search the first one older than after_id
+                high = len(self.ring)
+                while skip < high:
+                    middle = (skip + high) // 2
+                    if self.ring.get(middle)[0] >= after_id:
+                        skip = middle + 1
+                    else:
+                        high = middle
+                if skip == len(self.ring) and not self.complete:
+                    return None
+            rows = self.ring.latest(n, skip)
+            if len(rows) < n and not self.complete:
+                return None
+            return rows
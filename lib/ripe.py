@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+URL = 'https://stat.ripe.net/data/ris-prefixes/data.json'
+
+
+def fixture_name(autonomous_system, list_prefixes):
+    """ File name of the response of a query, in the cache and in the replay directory """
+    return '%s_%s.json' % (re.sub('[^A-Za-z0-9]', '_', str(autonomous_system)),
+                           'list' if list_prefixes else 'counts')
+
+
+class RipeClient():
+    """ Fetch the ris-prefixes of autonomous systems from RIPEstat
+
+    The requests share a pooled requests.Session. Every response is kept in cache_dir and served from there during
+    cache_ttl seconds, after that it is revalidated with a conditional request (ETag / Last-Modified) so an unchanged
+    document is not downloaded again. With replay_dir the responses are read from the JSON fixtures in that
+    directory and the network is never used, with record_dir the responses fetched are also saved as fixtures.
+    """
+
+    def __init__(self, cache_dir=None, cache_ttl=300, replay_dir=None, record_dir=None, verify=False, timeout=30,
+                 logger=None):
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.replay_dir = replay_dir
+        self.record_dir = record_dir
+        self.verify = verify
+        self.timeout = timeout
+        self.logger = logger if logger is not None else logging.getLogger('ripe')
+
+        self.session = None
+        for directory in (cache_dir, record_dir):
+            if directory is not None and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def _get_session(self):
+        # requests is only needed when the network is used
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+        return self.session
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, path, content):
+        """ Write the file atomically, a reader never sees it half written """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(content, f)
+        os.rename(tmp, path)
+
+    def fetch(self, autonomous_system, list_prefixes=False):
+        """ ris-prefixes document of the autonomous system, raises IOError if it can not be retrieved """
+        name = fixture_name(autonomous_system, list_prefixes)
+
+        if self.replay_dir is not None:
+            data = self._read(os.path.join(self.replay_dir, name))
+            if data is None:
+                raise IOError("No fixture %s in %s" % (name, self.replay_dir))
+            self.logger.info("Replaying %s" % name)
+            return data
+
+        cache_path = os.path.join(self.cache_dir, name) if self.cache_dir is not None else None
+        cached = self._read(cache_path) if cache_path is not None else None
+        if cached is not None and time.time() - cached['fetched_at'] < self.cache_ttl:
+            self.logger.info("Serving %s from the cache" % name)
+            return cached['data']
+
+        headers = {}
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        self.logger.info("Sending GET request to RIPE")
+        params = {'resource': autonomous_system, 'list_prefixes': 'true' if list_prefixes else 'false'}
+        r = self._get_session().get(URL, params=params, headers=headers, verify=self.verify, timeout=self.timeout)
+
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if r.status_code == 304 and cached is not None:
+            self.logger.info("%s not modified" % name)
+            data = cached['data']
+            # A 304 may leave the validators out, the ones of the cached response still hold
+            etag = etag or cached.get('etag')
+            last_modified = last_modified or cached.get('last_modified')
+        elif r.status_code == 200:
+            data = r.json()
+        else:
+            raise IOError("Error connecting to the url status code %i" % r.status_code)
+
+        if cache_path is not None:
+            self._write(cache_path, {'fetched_at': time.time(), 'etag': etag, 'last_modified': last_modified,
+                                     'data': data})
+        if self.record_dir is not None:
+            self._write(os.path.join(self.record_dir, name), data)
+        return data
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
@@ -0,0 +1,174 @@
+import datetime
+import logging
+from . import schema
+
+# Bucket resolutions and the strftime format truncating created_at to the start of the bucket
+RESOLUTIONS = (('minute', '%Y-%m-%d %H:%M:00'),
+               ('hour', '%Y-%m-%d %H:00:00'),
+               ('day', '%Y-%m-%d 00:00:00'))
+
+# Raw table: (rollup table, target field)
+SOURCES = {'ping_table': ('ping_rollup_table', 'dst_ip'),
+           'tcp_table': ('tcp_rollup_table', 'url')}
+
+
+class Rollup():
+    """ Incremental rollup of the raw results in 1 minute, 1 hour and 1 day buckets per target
+
+    The raw rows are aggregated in id order, the last id aggregated of every raw table is kept in
+    rollup_state_table so every run only reads the rows inserted since the previous one. Ping buckets keep the
+    min/max/sum of the rtt and the packets sent/lost, tcp buckets keep one row per response code (the histogram).
+    """
+
+    def __init__(self, db, batch_size=10000, logger=None):
+        # Error Checks
+        if not isinstance(batch_size, int):
+            raise TypeError("The batch size should be an integer")
+        if batch_size <= 0:
+            raise ValueError("The batch size should be greater than or equal to 1")
+
+        self.db = db
+        self.batch_size = batch_size
+        self.logger = logger if logger is not None else logging.getLogger('rollup')
+
+        for table_name in list(SOURCES) + ['ping_rollup_table', 'tcp_rollup_table', 'rollup_state_table']:
+            schema.create_table(self.db, table_name)
+        self.db.commit()
+
+    def last_id(self, table_name):
+        """ Last id of the raw table already aggregated """
+        resp = self.db.query('''SELECT last_id FROM rollup_state_table WHERE table_name = ?''', (table_name,))
+        return resp[0][0] if resp else 0
+
+    def _set_last_id(self, table_name, last_id):
+        self.db.query('''UPDATE rollup_state_table SET last_id = ? WHERE table_name = ?''', (last_id, table_name))
+        if self.db.c.rowcount == 0:
+            self.db.query('''INSERT INTO rollup_state_table(table_name, last_id) VALUES(?, ?)''',
+                          (table_name, last_id))
+
+    def _rollup_ping(self, first_id, last_id):
+        for resolution, bucket in RESOLUTIONS:
+            groups = self.db.query(
+                '''SELECT strftime(?, created_at), dst_ip, count(*),
+                          sum(CASE WHEN pkt_sent > pkt_loss THEN 1 ELSE 0 END),
+                          min(CASE WHEN pkt_sent > pkt_loss THEN rtt END),
+                          max(CASE WHEN pkt_sent > pkt_loss THEN rtt END),
+                          sum(CASE WHEN pkt_sent > pkt_loss THEN rtt ELSE 0 END),
+                          sum(pkt_sent), sum(pkt_loss)
+                   FROM ping_table WHERE id > ? AND id <= ? GROUP BY 1, 2''', (bucket, first_id, last_id))
+
+            for created_at, dst_ip, samples, rtt_samples, rtt_min, rtt_max, rtt_sum, pkt_sent, pkt_loss in groups:
+                self.db.query(
+                    '''UPDATE ping_rollup_table SET samples = samples + ?, rtt_samples = rtt_samples + ?,
+                              rtt_min = min(coalesce(rtt_min, ?), coalesce(?, rtt_min)),
+                              rtt_max = max(coalesce(rtt_max, ?), coalesce(?, rtt_max)),
+                              rtt_sum = rtt_sum + ?, pkt_sent = pkt_sent + ?, pkt_loss = pkt_loss + ?
+                       WHERE resolution = ? AND dst_ip = ? AND created_at = ?''',
+                    (samples, rtt_samples, rtt_min, rtt_min, rtt_max, rtt_max, rtt_sum, pkt_sent, pkt_loss,
+                     resolution, dst_ip, created_at))
+                if self.db.c.rowcount == 0:
+                    self.db.query(
+                        '''INSERT INTO ping_rollup_table(created_at, resolution, dst_ip, samples, rtt_samples,
+                                  rtt_min, rtt_max, rtt_sum, pkt_sent, pkt_loss)
+                           VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                        (created_at, resolution, dst_ip, samples, rtt_samples, rtt_min, rtt_max, rtt_sum, pkt_sent,
+                         pkt_loss))
+
+    def _rollup_tcp(self, first_id, last_id):
+        for resolution, bucket in RESOLUTIONS:
+            groups = self.db.query(
+                '''SELECT strftime(?, created_at), url, response_code, count(*)
+                   FROM tcp_table WHERE id > ? AND id <= ? GROUP BY 1, 2, 3''', (bucket, first_id, last_id))
+
+            for created_at, url, response_code, samples in groups:
+                self.db.query(
+                    '''UPDATE tcp_rollup_table SET samples = samples + ?
+                       WHERE resolution = ? AND url = ? AND created_at = ? AND response_code = ?''',
+                    (samples, resolution, url, created_at, response_code))
+                if self.db.c.rowcount == 0:
+                    self.db.query(
+                        '''INSERT INTO tcp_rollup_table(created_at, resolution, url, response_code, samples)
+                           VALUES(?, ?, ?, ?, ?)''', (created_at, resolution, url, response_code, samples))
+
+    def run(self):
+        """ Aggregate the raw rows inserted since the last run, batch_size rows per transaction """
+        aggregated = {}
+        for table_name, rollup in (('ping_table', self._rollup_ping), ('tcp_table', self._rollup_tcp)):
+            aggregated[table_name] = 0
+            last_id = self.last_id(table_name)
+            max_id = self.db.query('''SELECT max(id) FROM {tbl}'''.format(tbl=table_name))[0][0] or 0
+
+            while last_id < max_id:
+                batch_end = min(last_id + self.batch_size, max_id)
+                try:
+                    rollup(last_id, batch_end)
+                    self._set_last_id(table_name, batch_end)
+                    self.db.commit()
+                except Exception:
+                    self.db.conn.rollback()
+                    raise
+                self.logger.debug("Aggregated %s rows %i to %i" % (table_name, last_id + 1, batch_end))
+                aggregated[table_name] += batch_end - last_id
+                last_id = batch_end
+
+            self.logger.info("%s aggregated up to id %i" % (table_name, last_id))
+        return aggregated
+
+    def _prune_batches(self, sql, values):
+        """ Run the DELETE statement until it removes less than batch_size rows, commit after every batch """
+        deleted = 0
+        while True:
+            self.db.query(sql, values)
+            rowcount = self.db.c.rowcount
+            self.db.commit()
+            deleted += rowcount
+            if rowcount < self.batch_size:
+                return deleted
+
+    def prune(self, retention, now=None):
+        """ Delete the rows older than their retention, retention is a dict of days by 'raw' or resolution name,
+        a missing or 0 retention keeps the rows forever. Only raw rows already aggregated are deleted. """
+        now = now if now is not None else datetime.datetime.utcnow()
+        deleted = {}
+
+        days = retention.get('raw', 0)
+        if days:
+            cutoff = now - datetime.timedelta(days=days)
+            for table_name in sorted(SOURCES):
+                # The ids grow with the time, so the oldest rows are at the start of the table. The row with the
+                # largest id is always kept: without it SQLite would hand out its id and the ones below again, the
+                # new rows would look already aggregated and be pruned without being aggregated
+                sql = '''DELETE FROM {tbl} WHERE id IN (SELECT id FROM {tbl} WHERE id <= ? ORDER BY id LIMIT ?)
+                         AND created_at < ? AND id < (SELECT max(id) FROM {tbl})'''.format(tbl=table_name)
+                deleted[table_name] = self._prune_batches(sql, (self.last_id(table_name), self.batch_size,
+                                                                cutoff))
+
+        for resolution, bucket in RESOLUTIONS:
+            days = retention.get(resolution, 0)
+            if not days:
+                continue
+            cutoff = now - datetime.timedelta(days=days)
+            for rollup_table, _ in sorted(SOURCES.values()):
+                sql = '''DELETE FROM {tbl} WHERE id IN (SELECT id FROM {tbl} WHERE resolution = ? AND created_at < ?
+                         LIMIT ?)'''.format(tbl=rollup_table)
+                deleted[rollup_table + ' ' + resolution] = self._prune_batches(sql, (resolution, cutoff,
+                                                                                     self.batch_size))
+
+        for name, n in sorted(deleted.items()):
+            self.logger.info("Pruned %i rows from %s" % (n, name))
+        return deleted
+
+    def get_range(self, table_name, resolution, target, start, end):
+        """ Get the buckets of a target between start (included) and end (excluded) from a rollup table """
+        # Error Checks
+        rollups = dict(SOURCES.values())
+        if table_name not in rollups:
+            raise ValueError("The table %s is not a rollup table" % table_name)
+        if resolution not in dict(RESOLUTIONS):
+            raise ValueError("The resolution should be one of %s" % ", ".join(r for r, b in RESOLUTIONS))
+        if not isinstance(start, datetime.datetime) or not isinstance(end, datetime.datetime):
+            raise TypeError("The start and end of the range should be datetime objects")
+
+        sql = '''SELECT * FROM {tbl} WHERE resolution = ? AND {tgt} = ? AND created_at >= ? AND created_at < ?
+                 ORDER BY created_at'''.format(tbl=table_name, tgt=rollups[table_name])
+        return self.db.query(sql, (resolution, target, start, end))
@@ -0,0 +1,395 @@
+import heapq
+import logging
+import multiprocessing
+import random
+import signal
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from .lib import monotonic
+from .metrics import REGISTRY
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+RUNS = REGISTRY.counter('monitor_scheduler_runs_total', 'Runs of the checks started')
+SKIPPED = REGISTRY.counter('monitor_scheduler_skipped_total', 'Runs skipped, the previous run was still going')
+ERRORS = REGISTRY.counter('monitor_scheduler_errors_total', 'Runs of the checks that raised an exception')
+# Delay between the time a run was due and its dispatch to the pool
+LAG_SECONDS = REGISTRY.histogram('monitor_scheduler_lag_seconds', 'Delay of the dispatch of the due runs')
+PENDING_RESULTS = REGISTRY.gauge('monitor_scheduler_pending_results', 'Results of the runs waiting to be written, '
+                                 'at the last time they were written')
+
+
+def write(db, rows, logger):
+    """ Queue the (table name, row) on db, a failed write is logged, db keeps the rows it can retry """
+    for table_name, row in rows:
+        try:
+            db.buffered_insert(table_name, row)
+        except Exception as e:
+            logger.exception("Writing the results failed: %s" % e)
+
+
+def flush(db, logger):
+    """ Write the rows buffered on db, returns False and logs the error if the write failed """
+    try:
+        db.flush()
+        return True
+    except Exception as e:
+        logger.exception("Writing the results failed: %s" % e)
+        return False
+
+
+class Job():
+    """ Check run every interval seconds, func returns a list of (table name, row) with its results. The target of a
+    batched job is passed to func in a list with the targets of the other jobs due with it """
+
+    def __init__(self, name, interval, func, args, target=None, batched=False):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.target = target
+        self.batched = batched
+
+        # Start of the current period, the runs are jittered around it so the offsets do not accumulate
+        self.period_start = 0
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+
+
+class Scheduler():
+    """ Run the checks of many targets from a single resident process
+
+    The jobs are kept in a heap ordered by their next run. The first run of every job is placed at a random offset
+    of its interval and every run is moved by a random jitter (a fraction of the interval), so the checks with the
+    same interval are spread out instead of firing in bursts. Due jobs run on a thread pool and their rows are
+    queued to the thread calling run, which owns the database and writes them with buffered inserts.
+
+    The jobs added with add_batch and due within batch_window seconds of each other run in a single call of their
+    function with all their targets, so checks like ping share a single socket instead of opening one per target.
+    """
+
+    def __init__(self, workers=8, jitter=0.1, batch_window=1.0, logger=None, clock=monotonic, stopped=None):
+        # Error Checks
+        if not isinstance(workers, int):
+            raise TypeError("The number of workers should be an integer")
+        if workers <= 0:
+            raise ValueError("The number of workers should be greater than or equal to 1")
+        if not 0 <= jitter < 1:
+            raise ValueError("The jitter should be a fraction of the interval between 0 and 1")
+        if batch_window < 0:
+            raise ValueError("The batch window should be greater than or equal to 0")
+
+        self.workers = workers
+        self.jitter = jitter
+        self.batch_window = batch_window
+        self.logger = logger if logger is not None else logging.getLogger('scheduler')
+        self.clock = clock
+
+        self.jobs = []
+        self.heap = []
+        self.results = queue.Queue()
+        # Set to stop run, a multiprocessing.Event when it is stopped from another process
+        self.stopped = stopped if stopped is not None else threading.Event()
+        # Tie breaker of the jobs due at the same time
+        self.counter = 0
+
+    def add(self, name, interval, func, *args):
+        """ Add a check run every interval seconds, returns its Job """
+        if interval <= 0:
+            raise ValueError("The interval of %s should be greater than 0" % name)
+
+        job = Job(name, interval, func, args)
+        job.period_start = self.clock() + random.uniform(0, interval)
+        self.jobs.append(job)
+        self._push(job, job.period_start)
+        return job
+
+    def add_batch(self, name, interval, func, target, *args):
+        """ Add a check of target run every interval seconds, returns its Job. The due jobs with the same func and
+        args run together as func(targets, *args) """
+        job = self.add(name, interval, func, *args)
+        job.target = target
+        job.batched = True
+        return job
+
+    def _push(self, job, run_at):
+        self.counter += 1
+        heapq.heappush(self.heap, (run_at, self.counter, job))
+
+    def _reschedule(self, job, now):
+        job.period_start += job.interval
+        # Skip the periods already missed
+        if job.period_start < now:
+            missed = int((now - job.period_start) / job.interval) + 1
+            job.period_start += missed * job.interval
+        offset = random.uniform(-self.jitter, self.jitter) * job.interval
+        self._push(job, job.period_start + offset)
+
+    def _run_job(self, job):
+        """ Run the check on a worker thread and queue its rows """
+        try:
+            rows = job.func(*job.args)
+        except Exception as e:
+            job.errors += 1
+            ERRORS.inc()
+            self.logger.exception("Check %s failed: %s" % (job.name, e))
+            rows = []
+        self.results.put((job, rows))
+
+    def _run_batch(self, jobs):
+        """ Run the check of the targets of the jobs in a single call on a worker thread and queue its rows """
+        try:
+            rows = jobs[0].func([job.target for job in jobs], *jobs[0].args)
+        except Exception as e:
+            for job in jobs:
+                job.errors += 1
+            ERRORS.inc(len(jobs))
+            self.logger.exception("Check %s failed: %s" % (', '.join(job.name for job in jobs), e))
+            rows = []
+        # The rows go with the first job, the others only have to be marked as done
+        self.results.put((jobs[0], rows))
+        for job in jobs[1:]:
+            self.results.put((job, []))
+
+    def _due(self, now):
+        """ Pop the jobs due at now, with the batched jobs due within batch_window when one of them is due """
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap))
+
+        if any(job.batched for _, _, job in due):
+            later = []
+            while self.heap and self.heap[0][0] <= now + self.batch_window:
+                entry = heapq.heappop(self.heap)
+                (due if entry[2].batched else later).append(entry)
+            for entry in later:
+                heapq.heappush(self.heap, entry)
+        return due
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self, db, max_wait=1.0):
+        """ Dispatch the due jobs and write their rows on db until stop is called, the rows still buffered are
+        written at least every max_wait seconds """
+        pool = ThreadPool(self.workers)
+        try:
+            while not self.stopped.is_set():
+                now = self.clock()
+                batches = []
+                for run_at, _, job in self._due(now):
+                    self._reschedule(job, now)
+                    if job.running:
+                        # The previous run did not finish yet, do not pile them up
+                        job.skipped += 1
+                        SKIPPED.inc()
+                        self.logger.warning("Check %s still running, skipping this run" % job.name)
+                        continue
+                    job.running = True
+                    job.runs += 1
+                    RUNS.inc()
+                    LAG_SECONDS.observe(max(now - run_at, 0))
+                    self.logger.debug("Running check %s" % job.name)
+                    if not job.batched:
+                        pool.apply_async(self._run_job, (job,))
+                        continue
+                    for batch in batches:
+                        if batch[0].func == job.func and batch[0].args == job.args:
+                            batch.append(job)
+                            break
+                    else:
+                        batches.append([job])
+                for batch in batches:
+                    pool.apply_async(self._run_batch, (batch,))
+
+                # Write the results while waiting for the next job
+                wait = min(self.heap[0][0] - now, max_wait) if self.heap else max_wait
+                try:
+                    job, rows = self.results.get(timeout=max(wait, 0.001))
+                    PENDING_RESULTS.set(self.results.qsize() + 1)
+                    self._store(db, job, rows)
+                    while True:
+                        job, rows = self.results.get_nowait()
+                        self._store(db, job, rows)
+                except queue.Empty:
+                    pass
+                if db.buffered and time.time() - db.last_flush >= db.flush_interval:
+                    flush(db, self.logger)
+        finally:
+            # Let the running checks finish and write their rows
+            pool.close()
+            pool.join()
+            while not self.results.empty():
+                job, rows = self.results.get_nowait()
+                self._store(db, job, rows)
+            flush(db, self.logger)
+
+    def _store(self, db, job, rows):
+        job.running = False
+        write(db, rows, self.logger)
+
+
+class QueueWriter():
+    """ Stand in for the database of a Scheduler running in a worker process
+
+    The rows are buffered like SQLite.buffered_insert does and sent in batches over a multiprocessing queue to the
+    process owning the database.
+    """
+
+    def __init__(self, results, flush_rows=500, flush_interval=1.0):
+        self.results = results
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = time.time()
+
+    def buffered_insert(self, table_name, values):
+        self.buffer.append((table_name, values))
+        self.buffered += 1
+
+        if self.buffered >= self.flush_rows or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.results.put(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = time.time()
+
+
+class StoreWriter():
+    """ Database of a Scheduler or a ShardPool with rows written through stores
+
+    The checks keeping state on the database return their results as rows of a pseudo table, stores maps the
+    pseudo table to a function called with the row in the process owning the database. The function updates the
+    state and returns the (table name, row) to insert, the other rows are inserted as they are.
+    """
+
+    def __init__(self, db, stores):
+        self.db = db
+        self.stores = stores
+
+    @property
+    def buffered(self):
+        return self.db.buffered
+
+    @property
+    def last_flush(self):
+        return self.db.last_flush
+
+    @property
+    def flush_interval(self):
+        return self.db.flush_interval
+
+    def buffered_insert(self, table_name, values):
+        store = self.stores.get(table_name)
+        if store is None:
+            self.db.buffered_insert(table_name, values)
+            return
+        for table_name, row in store(values):
+            self.db.buffered_insert(table_name, row)
+
+    def flush(self):
+        self.db.flush()
+
+
+def shard(items, n):
+    """ Split the items round robin in n lists of about the same size """
+    return [items[i::n] for i in range(n) if items[i::n]]
+
+
+def _run_shard(func, items, results, stopped, flush_rows, flush_interval):
+    # Ctrl-C reaches the whole process group, the parent stops the workers with the stopped event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    writer = QueueWriter(results, flush_rows=flush_rows, flush_interval=flush_interval)
+    try:
+        func(items, writer, stopped)
+    finally:
+        writer.flush()
+
+
+class ShardPool():
+    """ Run the checks sharded across worker processes with a single database writer
+
+    Every worker process gets a shard of the items and runs func(items, writer, stopped) with its own sockets and
+    threads, so the checks use all the cores instead of contending for the GIL. The rows come back in batches over
+    a queue to the process calling run, the only one writing on the SQLite database.
+    """
+
+    def __init__(self, func, items, processes=None, logger=None, stopped=None):
+        processes = processes if processes is not None else multiprocessing.cpu_count()
+        # Error Checks
+        if not isinstance(processes, int):
+            raise TypeError("The number of processes should be an integer")
+        if processes <= 0:
+            raise ValueError("The number of processes should be greater than or equal to 1")
+
+        self.func = func
+        self.shards = shard(items, processes)
+        self.logger = logger if logger is not None else logging.getLogger('scheduler')
+
+        self.results = multiprocessing.Queue()
+        # Set to stop run and the workers
+        self.stopped = stopped if stopped is not None else multiprocessing.Event()
+        self.processes = []
+
+    def stop(self):
+        self.stopped.set()
+
+    def _write(self, db, batch):
+        write(db, batch, self.logger)
+
+    def run(self, db, max_wait=1.0, flush_rows=500, flush_interval=1.0):
+        """ Start the workers and write their rows on db until stop is called or all the workers exit """
+        for i, items in enumerate(self.shards):
+            process = multiprocessing.Process(target=_run_shard, name='shard-%i' % i,
+                                              args=(self.func, items, self.results, self.stopped, flush_rows,
+                                                    flush_interval))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+            self.logger.info("Started worker %s with %i items" % (process.name, len(items)))
+
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self._write(db, self.results.get(timeout=max_wait))
+                except queue.Empty:
+                    pass
+                if db.buffered and time.time() - db.last_flush >= db.flush_interval:
+                    flush(db, self.logger)
+
+                alive = [p for p in self.processes if p.is_alive()]
+                if len(alive) < len(self.processes):
+                    for process in self.processes:
+                        if not process.is_alive():
+                            self.logger.error("Worker %s exited with code %s" % (process.name, process.exitcode))
+                    self.processes = alive
+                if len(alive) == 0:
+                    break
+        finally:
+            self.stopped.set()
+            # Keep reading while the workers finish, a worker exits only once its rows are consumed
+            while any(p.is_alive() for p in self.processes):
+                try:
+                    self._write(db, self.results.get(timeout=0.1))
+                except queue.Empty:
+                    pass
+            while True:
+                try:
+                    self._write(db, self.results.get(timeout=0.1))
+                except queue.Empty:
+                    break
+            for process in self.processes:
+                process.join()
+            flush(db, self.logger)
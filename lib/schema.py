@@ -0,0 +1,69 @@
+# Tables of the monitoring database, shared by the checkers and the API
+
+# Table name: (fields, target), target is the field holding the monitored host/url of the time series tables, it
+# gets indexed together with created_at. New fields are added at the end, they are added to existing tables.
+TABLES = {
+    'ping_table': (('id integer PRIMARY KEY', 'created_at DATETIME', 'version integer', 'dst_ip text', 'rtt real',
+                    'pkt_sent integer', 'pkt_loss integer'), 'dst_ip'),
+    'tcp_table': (('id integer PRIMARY KEY', 'created_at DATETIME', 'version integer', 'url text',
+                   'response_code integer', 'connect_ms real', 'tls_ms real', 'first_byte_ms real', 'handshake_ms real',
+                   'tls_resumed integer', 'connect_start_ms real', 'request_sent_ms real', 'last_byte_ms real'),
+                  'url'),
+    # The MX and NS servers are answer sets of dns_set_table (lib.answers), the JSON lists ipv4_mx_servers to
+    # ipv6_ns_servers are only filled in the rows written before it
+    'dns_table': (('id integer PRIMARY KEY', 'created_at DATETIME', 'ipv4_mx_servers text', 'ipv6_mx_servers text',
+                   'ipv4_ns_servers text', 'ipv6_ns_servers text', 'soa_record text', 'a_record text',
+                   'aaaa_record text', 'dnskey_record text', 'domain text', 'mx_v4_set integer',
+                   'mx_v6_set integer', 'ns_v4_set integer', 'ns_v6_set integer'), 'domain'),
+    'dns_name_table': (('id integer PRIMARY KEY', 'name text'), None),
+    'dns_address_table': (('id integer PRIMARY KEY', 'address text'), None),
+    # digest is the content address of the (name, address) pairs of the set
+    'dns_set_table': (('id integer PRIMARY KEY', 'digest text', 'size integer'), None),
+    'dns_set_member_table': (('id integer PRIMARY KEY', 'set_id integer', 'name_id integer', 'address_id integer'),
+                             None),
+    # The prefixes of the snapshots are kept in bgp_prefix_table (lib.bgp), v4_prefixes and v6_prefixes are only
+    # filled in the rows written before it
+    'bgp_table': (('id integer PRIMARY KEY', 'created_at DATETIME', 'v4_prefixes text', 'v6_prefixes text',
+                   'query_time text', 'autonomous_system text', 'v4_count integer', 'v6_count integer',
+                   'announced integer', 'withdrawn integer'), 'autonomous_system'),
+    'bgp_prefix_table': (('id integer PRIMARY KEY', 'autonomous_system text', 'prefix text', 'version integer',
+                          'first_seen DATETIME', 'last_seen DATETIME'), None),
+    'tokens_table': (('id integer PRIMARY KEY', 'token TEXT', 'expiration DATETIME'), None),
+    # Rollups of the raw results (lib.rollup), created_at is the start of the bucket
+    'ping_rollup_table': (('id integer PRIMARY KEY', 'created_at DATETIME', 'resolution text', 'dst_ip text',
+                           'samples integer', 'rtt_samples integer', 'rtt_min real', 'rtt_max real', 'rtt_sum real',
+                           'pkt_sent integer', 'pkt_loss integer'), None),
+    'tcp_rollup_table': (('id integer PRIMARY KEY', 'created_at DATETIME', 'resolution text', 'url text',
+                          'response_code integer', 'samples integer'), None),
+    'rollup_state_table': (('id integer PRIMARY KEY', 'table_name text', 'last_id integer'), None),
+    # DNS answers cached between the runs of dns_check.py (lib.resolver), expiration is a unix timestamp
+    'dns_cache_table': (('id integer PRIMARY KEY', 'name text', 'rdtype integer', 'ttl integer', 'records text',
+                         'expiration real'), None),
+}
+
+# Other indexes of the tables: (fields, unique)
+INDEXES = {
+    'tokens_table': ((('token',), False),),
+    'ping_rollup_table': ((('resolution', 'dst_ip', 'created_at'), True),
+                          (('resolution', 'created_at'), False)),
+    'tcp_rollup_table': ((('resolution', 'url', 'created_at', 'response_code'), True),
+                         (('resolution', 'created_at'), False)),
+    'rollup_state_table': ((('table_name',), True),),
+    'dns_cache_table': ((('name', 'rdtype'), True),),
+    'bgp_prefix_table': ((('autonomous_system', 'last_seen'), False),
+                         (('prefix', 'first_seen'), False)),
+    'dns_name_table': ((('name',), True),),
+    'dns_address_table': ((('address',), True),),
+    'dns_set_table': ((('digest',), True),),
+    'dns_set_member_table': ((('set_id',), False),
+                             (('name_id',), False),
+                             (('address_id',), False)),
+}
+
+
+def create_table(db, table_name):
+    """ Create the table with its indexes on the lib.sqlite.SQLite database db """
+    fields, target = TABLES[table_name]
+    db.create_table(table_name, fields, target=target)
+    for index_fields, unique in INDEXES.get(table_name, ()):
+        db.create_index(table_name, index_fields, unique=unique)
@@ -1,23 +1,80 @@
 import sqlite3
 import re
 import datetime
+import time
+import threading
+import contextlib
+from .metrics import REGISTRY
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+
+WRITE_SECONDS = REGISTRY.histogram('monitor_sqlite_write_seconds', 'Time blocked writing and committing rows',
+                                   ('operation',))
+ROWS_WRITTEN = REGISTRY.counter('monitor_sqlite_rows_written_total', 'Rows inserted', ('table',))
+BUFFERED_ROWS = REGISTRY.gauge('monitor_sqlite_buffered_rows', 'Rows queued by buffered_insert not written yet')
+ROWS_DROPPED = REGISTRY.counter('monitor_sqlite_rows_dropped_total', 'Rows queued by buffered_insert that could not be '
+                                'written')
+
+
+class RowsDropped(RuntimeError):
+    """ The rows queued by buffered_insert could not be written and were dropped """
 
 
 class SQLite():
 
-    def __init__(self, db_name):
+    def __init__(self, db_name, journal_mode='WAL', flush_rows=500, flush_interval=1.0, flush_retries=60,
+                 check_same_thread=True):
         # Error Checks
         if not isinstance(db_name, str):
             raise TypeError("The name of the database should be a string")
         if len(db_name) == 0:
             raise ValueError("The database name should not be empty")
+        if journal_mode is not None and journal_mode.upper() not in JOURNAL_MODES:
+            raise ValueError("The journal mode should be one of %s" % ", ".join(JOURNAL_MODES))
+        if not isinstance(flush_rows, int):
+            raise TypeError("The number of rows to flush should be an integer")
+        if flush_rows <= 0:
+            raise ValueError("The number of rows to flush should be greater than or equal to 1")
+        if flush_interval < 0:
+            raise ValueError("The flush interval should be greater than or equal to 0")
+        if not isinstance(flush_retries, int):
+            raise TypeError("The number of flush retries should be an integer")
+        if flush_retries < 0:
+            raise ValueError("The number of flush retries should be greater than or equal to 0")
 
         # Create the connection and the cursor
-        self.conn = sqlite3.connect(db_name)
+        self.conn = sqlite3.connect(db_name, check_same_thread=check_same_thread)
         self.c = self.conn.cursor()
 
+        # WAL lets the readers work while the checkers write and only syncs on checkpoints
+        if journal_mode is not None:
+            self.c.execute('PRAGMA journal_mode={mode}'.format(mode=journal_mode.upper()))
+            if journal_mode.upper() == 'WAL':
+                self.c.execute('PRAGMA synchronous=NORMAL')
+
         self.tables = {}
 
+        # Column identifying the monitored target of the time series tables
+        self.targets = {}
+
+        # INSERT statement of every table, sqlite3 keeps them prepared as long as the same string is used
+        self.insert_statements = {}
+
+        # Rows waiting to be written by buffered_insert
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.buffer = {}
+        self.buffered = 0
+        self.last_flush = time.time()
+        # Failed flushes in a row, while there are any the next one waits flush_interval instead of flush_rows more
+        # rows. After flush_retries of them the rows are dropped
+        self.flush_retries = flush_retries
+        self.flush_failures = 0
+
     def __valid_input(self, string):
         '''Private function to validate input'''
         for l in string:
@@ -25,6 +82,11 @@ class SQLite():
                 raise ValueError("Forbidden character found on the string '%s'" % string)
         return True
 
+    def __transient(self, error):
+        ''' Private function to determine if a failed write can succeed when it is retried '''
+        message = str(error).lower()
+        return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
     def __fields_not_primary_key(self, fields):
         ''' Private function to determine if the table have a Primary Key'''
         new_fields = []
@@ -41,8 +103,31 @@ class SQLite():
 
         raise RuntimeError("No primary key on table")
 
-    def create_table(self, table_name, fields):
-        """ Create table"""
+    def __valid_values(self, values):
+        ''' Private function to validate a row of values '''
+        if type(values) is not tuple:
+            raise TypeError("The values should be a tuple containing the values to insert")
+        if len(values) == 0:
+            raise ValueError("You need at least one value to insert on the table")
+        for v in values:
+            if isinstance(v, str):
+                self.__valid_input(v)
+
+    def __insert_statement(self, table_name):
+        ''' Private function returning the cached INSERT statement of the table '''
+        try:
+            return self.insert_statements[table_name]
+        except KeyError:
+            fields = self.__fields_not_primary_key(self.tables[table_name])
+            sql = '''INSERT INTO {tbl}({flds}) VALUES({vals})'''.format(tbl=table_name,
+                                                                      flds=",".join(f for f in fields),
+                                                                      vals=",".join("?" for f in fields))
+            self.insert_statements[table_name] = sql
+            return sql
+
+    def create_table(self, table_name, fields, target=None):
+        """ Create table, add the fields missing on an existing table and when target is given (the field holding
+        the monitored host/url of a time series table) index it together with created_at """
         # Error Checks
         if not isinstance(table_name, str):
             raise TypeError("The name of the table on database should be a string")
@@ -54,13 +139,51 @@ class SQLite():
             raise ValueError("You need at least one field to create a table")
         for f in fields:
             self.__valid_input(f)
+        if target is not None and target not in [f.split(" ")[0] for f in fields]:
+            raise ValueError("The target %s is not a field of the table %s" % (target, table_name))
 
         try:
             self.tables[table_name] = fields
+            self.insert_statements.pop(table_name, None)
             sql = '''CREATE TABLE IF NOT EXISTS {tbl} ({flds})'''.format(tbl=table_name,
                                                                          flds=",".join(f for f in fields))
             self.c.execute(sql)
 
+            # Add the fields created after the table
+            self.c.execute('''PRAGMA table_info({tbl})'''.format(tbl=table_name))
+            existing = [r[1] for r in self.c.fetchall()]
+            for f in fields:
+                if f.split(" ")[0] not in existing and not re.match('.*primary key.*', f.lower()):
+                    sql = '''ALTER TABLE {tbl} ADD COLUMN {fld}'''.format(tbl=table_name, fld=f)
+                    self.c.execute(sql)
+
+            if target is not None:
+                self.targets[table_name] = target
+                self.create_index(table_name, (target, 'created_at'))
+
+        except Exception as e:
+            raise e
+
+    def create_index(self, table_name, fields, unique=False):
+        """ Create an index on the fields of the table """
+        # Error Checks
+        if not isinstance(table_name, str):
+            raise TypeError("The name of the table on database should be a string")
+        if type(fields) is not tuple:
+            raise TypeError("The fields should be a tuple ('field_name', ...)")
+        if len(table_name) == 0:
+            raise ValueError("The table name should not be empty")
+        if len(fields) == 0:
+            raise ValueError("You need at least one field to create an index")
+        for f in fields:
+            self.__valid_input(f)
+
+        try:
+            sql = '''CREATE {unq}INDEX IF NOT EXISTS {idx} ON {tbl} ({flds})'''.format(
+                unq='UNIQUE ' if unique else '', idx='idx_%s_%s' % (table_name, '_'.join(fields)), tbl=table_name,
+                flds=",".join(fields))
+            self.c.execute(sql)
+
         except Exception as e:
             raise e
 
@@ -69,27 +192,96 @@ class SQLite():
         # Error Checks
         if not isinstance(table_name, str):
             raise TypeError("The name of the table on database should be a string")
-        if type(values) is not tuple:
-           raise TypeError("The values should be a tuple containing the values to insert")
         if len(table_name) == 0:
             raise ValueError("The table name should not be empty")
-        if len(values) == 0:
-            raise ValueError("You need at least one value to insert on the table")
-        for v in values:
-            if isinstance(v, str):
-                self.__valid_input(v)
+        self.__valid_values(values)
 
         try:
-            fields = self.__fields_not_primary_key(self.tables[table_name])
-            sql = '''INSERT INTO {tbl}({flds}) VALUES({vals})'''.format(tbl=table_name,
-                                                                      flds=",".join(f for f in fields),
-                                                                      vals=",".join("?" for i in range(len(values))))
-            self.c.execute(sql, values)
-            self.conn.commit()
+            with WRITE_SECONDS.labels('insert').time():
+                self.c.execute(self.__insert_statement(table_name), values)
+                self.conn.commit()
+            ROWS_WRITTEN.labels(table_name).inc()
 
         except Exception as e:
             raise e
 
+    def insert_many(self, table_name, rows):
+        """ Insert several rows into table with a single commit """
+        # Error Checks
+        if not isinstance(table_name, str):
+            raise TypeError("The name of the table on database should be a string")
+        if type(rows) is not list:
+            raise TypeError("The rows should be a list of tuples containing the values to insert")
+        if len(table_name) == 0:
+            raise ValueError("The table name should not be empty")
+        if len(rows) == 0:
+            return
+        for values in rows:
+            self.__valid_values(values)
+
+        try:
+            with WRITE_SECONDS.labels('insert_many').time():
+                self.c.executemany(self.__insert_statement(table_name), rows)
+                self.conn.commit()
+            ROWS_WRITTEN.labels(table_name).inc(len(rows))
+
+        except Exception as e:
+            raise e
+
+    def buffered_insert(self, table_name, values):
+        """ Queue a row to insert, the rows are written with a single commit every flush_rows rows or
+        flush_interval seconds, whichever comes first. The interval is only checked when a row is queued, a caller
+        that can go quiet has to call flush on its own timer (lib.scheduler.Scheduler does on every tick) """
+        # Error Checks
+        if not isinstance(table_name, str):
+            raise TypeError("The name of the table on database should be a string")
+        if len(table_name) == 0:
+            raise ValueError("The table name should not be empty")
+        if table_name not in self.tables:
+            raise ValueError("The table %s was not created" % table_name)
+        self.__valid_values(values)
+
+        self.buffer.setdefault(table_name, []).append(values)
+        self.buffered += 1
+        BUFFERED_ROWS.set(self.buffered)
+
+        if ((self.buffered >= self.flush_rows and not self.flush_failures) or
+                time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """ Write the rows queued by buffered_insert. If the database is locked or busy the rows stay queued for
+        the next flush, up to flush_retries times. Any other error, or the last retry, drops them and raises
+        RowsDropped """
+        self.last_flush = time.time()
+        try:
+            with WRITE_SECONDS.labels('flush').time():
+                for table_name, rows in self.buffer.items():
+                    if rows:
+                        self.c.executemany(self.__insert_statement(table_name), rows)
+                self.conn.commit()
+
+        except Exception as e:
+            self.conn.rollback()
+            self.flush_failures += 1
+            if self.__transient(e) and self.flush_failures <= self.flush_retries:
+                raise e
+            message = "Dropped %i rows after %i failed writes: %s" % (self.buffered, self.flush_failures, e)
+            ROWS_DROPPED.inc(self.buffered)
+            self.__clear_buffer()
+            raise RowsDropped(message)
+
+        for table_name, rows in self.buffer.items():
+            ROWS_WRITTEN.labels(table_name).inc(len(rows))
+        self.__clear_buffer()
+
+    def __clear_buffer(self):
+        ''' Private function to empty the rows queued by buffered_insert '''
+        self.flush_failures = 0
+        self.buffer = {}
+        self.buffered = 0
+        BUFFERED_ROWS.set(0)
+
     def get_last_n(self, table_name, n=1):
         """ Get the last n values on table """
         # Error Checks
@@ -112,6 +304,70 @@ class SQLite():
         except Exception as e:
             raise e
 
+    def iter_last_n(self, table_name, n=1, after_id=None, batch_size=500):
+        """ Iterate the last n values on table newest first, starting after the row after_id (the rows with a
+        lower primary key) when given. Returns the list of columns and a generator of rows fetched batch_size at a
+        time from its own cursor """
+        # Error Checks
+        if not isinstance(table_name, str):
+            raise TypeError("The name of the table on database should be a string")
+        if not isinstance(n, int):
+            raise TypeError("The number of records (n) asked should be an integer")
+        if after_id is not None and not isinstance(after_id, int):
+            raise TypeError("The id to start after should be an integer")
+        if len(table_name) == 0:
+            raise ValueError("The table name should not be empty")
+        if n <= 0:
+            raise ValueError("The number of records should be greater than or equal to 1")
+
+        pk = self.__get_primary_key(self.tables[table_name])
+        if after_id is None:
+            sql = '''SELECT * FROM {tbl} ORDER by {pk} DESC LIMIT ?'''.format(tbl=table_name, pk=pk)
+            values = (n,)
+        else:
+            sql = '''SELECT * FROM {tbl} WHERE {pk} < ? ORDER by {pk} DESC LIMIT ?'''.format(tbl=table_name, pk=pk)
+            values = (after_id, n)
+
+        cursor = self.conn.cursor()
+        cursor.execute(sql, values)
+        columns = [d[0] for d in cursor.description]
+
+        def rows():
+            try:
+                while True:
+                    batch = cursor.fetchmany(batch_size)
+                    if not batch:
+                        return
+                    for row in batch:
+                        yield row
+            finally:
+                cursor.close()
+
+        return columns, rows()
+
+    def get_range(self, table_name, target, start, end):
+        """ Get the values of a target between start (included) and end (excluded) ordered by creation date """
+        # Error Checks
+        if not isinstance(table_name, str):
+            raise TypeError("The name of the table on database should be a string")
+        if len(table_name) == 0:
+            raise ValueError("The table name should not be empty")
+        if table_name not in self.targets:
+            raise ValueError("The table %s was not created with a target" % table_name)
+        if not isinstance(start, datetime.datetime) or not isinstance(end, datetime.datetime):
+            raise TypeError("The start and end of the range should be datetime objects")
+        if start > end:
+            raise ValueError("The start of the range should be before the end")
+
+        try:
+            sql = '''SELECT * FROM {tbl} WHERE {tgt} = ? AND created_at >= ? AND created_at < ?
+                     ORDER BY created_at'''.format(tbl=table_name, tgt=self.targets[table_name])
+            self.c.execute(sql, (target, start, end))
+            return self.c.fetchall()
+
+        except Exception as e:
+            raise e
+
     def query(self, query, values=None):
         """ Query """
         # Error Checks
@@ -153,9 +409,98 @@ class SQLite():
         except Exception as e:
             raise e
 
+    def commit(self):
+        """ Commit the changes done with query """
+        try:
+            self.conn.commit()
+        except Exception as e:
+            raise e
+
     def close(self):
         """ Close connection"""
         try:
+            if self.buffered:
+                self.flush()
             self.conn.close()
         except Exception as e:
-            raise e
\ No newline at end of file
+            raise e
+
+
+class PoolTimeout(RuntimeError):
+    """ No connection of the SQLitePool was released in time """
+
+
+class SQLitePool():
+    """ Pool of connections to the same database shared by several threads
+
+    The tables are created once by setup (a function receiving the first connection), the other connections only
+    inherit the tables definitions. Up to size connections are opened on demand and handed to one thread at a time,
+    when all of them are busy connection() waits up to timeout seconds for one to be released.
+    """
+
+    def __init__(self, db_name, size=8, setup=None, timeout=10, **kwargs):
+        # Error Checks
+        if not isinstance(size, int):
+            raise TypeError("The size of the pool should be an integer")
+        if size <= 0:
+            raise ValueError("The size of the pool should be greater than or equal to 1")
+        if timeout is not None and timeout <= 0:
+            raise ValueError("The timeout should be greater than 0")
+
+        self.db_name = db_name
+        self.size = size
+        self.timeout = timeout
+        self.kwargs = kwargs
+        self.kwargs['check_same_thread'] = False
+
+        self.idle = queue.LifoQueue()
+        self.opened = []
+        self.lock = threading.Lock()
+
+        # Create the tables with the first connection
+        first = self.__open()
+        if setup is not None:
+            setup(first)
+            first.commit()
+        self.tables = dict(first.tables)
+        self.targets = dict(first.targets)
+        self.idle.put(first)
+
+    def __open(self):
+        ''' Private function to open a new connection of the pool '''
+        db = SQLite(self.db_name, **self.kwargs)
+        if hasattr(self, 'tables'):
+            db.tables.update(self.tables)
+            db.targets.update(self.targets)
+        self.opened.append(db)
+        return db
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Context manager lending a connection of the pool, uncommitted changes are rolled back on errors. Raises
+        PoolTimeout when none is released in timeout seconds """
+        try:
+            db = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                db = self.__open() if len(self.opened) < self.size else None
+            if db is None:
+                try:
+                    db = self.idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeout("No connection of the pool released in %s seconds" % self.timeout)
+
+        try:
+            yield db
+        except Exception:
+            db.conn.rollback()
+            raise
+        finally:
+            self.idle.put(db)
+
+    def close(self):
+        """ Close all the connections """
+        with self.lock:
+            for db in self.opened:
+                db.close()
+            self.opened = []
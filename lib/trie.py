@@ -0,0 +1,108 @@
+import socket
+import binascii
+
+# Address family and width in bits of every IP version
+FAMILIES = {4: (socket.AF_INET, 32), 6: (socket.AF_INET6, 128)}
+
+
+def parse_prefix(prefix):
+    """ (version, address as an integer, length) of an address or a prefix in CIDR notation, the host bits are
+    cleared. Raises ValueError if it is not valid """
+    address, _, length = prefix.strip().partition('/')
+    version = 6 if ':' in address else 4
+    family, width = FAMILIES[version]
+    try:
+        packed = socket.inet_pton(family, address)
+    except (socket.error, ValueError):
+        raise ValueError("Invalid address %s" % address)
+
+    if length:
+        try:
+            length = int(length)
+        except ValueError:
+            raise ValueError("Invalid prefix length %s" % length)
+        if not 0 <= length <= width:
+            raise ValueError("The prefix length should be between 0 and %i" % width)
+    else:
+        length = width
+
+    value = int(binascii.hexlify(packed), 16)
+    return version, value >> (width - length) << (width - length), length
+
+
+def format_prefix(version, value, length):
+    family, width = FAMILIES[version]
+    packed = binascii.unhexlify('%0*x' % (width // 4, value))
+    return '%s/%i' % (socket.inet_ntop(family, packed), length)
+
+
+class PrefixTrie():
+    """ Binary radix trie of IPv4 and IPv6 prefixes
+
+    Every prefix holds the set of values (the autonomous systems originating it) given to insert. A lookup walks at
+    most one node per bit of the address or prefix looked up, so the longest prefix match is O(prefix length)
+    whatever the number of prefixes.
+    """
+
+    def __init__(self):
+        # Node: [child for bit 0, child for bit 1, set of values or None]
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, prefix, value):
+        version, bits, length = parse_prefix(prefix)
+        width = FAMILIES[version][1]
+
+        node = self.roots[version]
+        for i in range(length):
+            bit = (bits >> (width - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+
+        if node[2] is None:
+            node[2] = set()
+            self.size += 1
+        node[2].add(value)
+
+    def covering(self, prefix):
+        """ List of (prefix, values) of the prefixes covering the address or prefix, the most specific last """
+        version, bits, length = parse_prefix(prefix)
+        width = FAMILIES[version][1]
+
+        matches = []
+        node = self.roots[version]
+        for i in range(length + 1):
+            if node[2] is not None:
+                matches.append((format_prefix(version, bits >> (width - i) << (width - i), i), node[2]))
+            if i == length:
+                break
+            node = node[(bits >> (width - 1 - i)) & 1]
+            if node is None:
+                break
+        return matches
+
+    def longest_match(self, prefix, value=None):
+        """ (prefix, values) of the most specific prefix covering the address or prefix, only among the prefixes
+        holding value when given. None if it is not covered """
+        for match in reversed(self.covering(prefix)):
+            if value is None or value in match[1]:
+                return match
+        return None
+
+    @classmethod
+    def from_db(cls, db, autonomous_system=None):
+        """ Trie of the prefixes announced (lib.bgp.PrefixStore) with the autonomous systems originating them """
+        sql = '''SELECT prefix, autonomous_system FROM bgp_prefix_table WHERE last_seen IS NULL'''
+        if autonomous_system is None:
+            rows = db.query(sql)
+        else:
+            rows = db.query(sql + ''' AND autonomous_system = ?''', (autonomous_system,))
+
+        trie = cls()
+        for prefix, asn in rows:
+            trie.insert(prefix, asn)
+        return trie
@@ -1,14 +1,13 @@
 import socket
-import os
-from lib.lib import IP, ICMPv4
+from lib.ping import PingEngine
+from lib.packet import make_payload
+from lib.metrics import CHECK_SECONDS
 import lib.sqlite as db
+import lib.schema as schema
 import datetime
-import threading
-import struct
 import random
 import argparse
 import logging
-import time
 import yaml
 import sys
 
@@ -18,123 +17,73 @@ LEVEL = {'debug': logging.DEBUG,
          'error': logging.ERROR,
          'critical': logging.CRITICAL}
 
-MOD = 1 << 16
-
-
-def ones_comp_add16(num1,num2):
-    result = num1 + num2
-    return result if result < MOD else (result+1) % MOD
-
-
-def calculate_checksum(icmp_packet):
-    # Converting packet in hex string
-    hex_packet = "".join("%02x" % ord(i) for i in icmp_packet)
-
-    # Create list of 16 bits
-    hex_packet_list = []
-    for i in range(0, len(hex_packet), 4):
-        if i == 4:
-            hex_packet_list.append('0000')
-        else:
-            hex_packet_list.append(hex_packet[i:i+4])
-
-    sum = ones_comp_add16(int(hex_packet_list[0], 16), int(hex_packet_list[1], 16))
-    for word in hex_packet_list[2:]:
-        sum = ones_comp_add16(sum, int(word, 16))
-
-    return 65535 - sum
-
-
-def threaded_sender(sock, id, dst_ip, n, logger):
-
-    print "PING %s 48 bytes of data:" %(dst_ip)
-
-    for i in range(0, n):
-        header = struct.pack('bbHHh', 8, 0, 0, id, i + 1)
-        data = "".join(chr(i) for i in range(65, 65 + 48))
-
-        packet = header + data
-        checksum = calculate_checksum(packet)
-
-        header = struct.pack('bbHHh', 8, 0, socket.htons(checksum), id, i + 1)
-
-        logger.info("Sending icmp packet seq %i to %s" %(i+1, dst_ip))
-        send_date_list.append(datetime.datetime.utcnow())
-        sock.sendto(header + data, (dst_ip, 0))
-        time.sleep(1)
-
-
-
-def threaded_receiver(sock, timeout, id, n, dst_ip, logger, db_name):
-    i = 0
-    rtt_list = []
-    pkt_loss = 0
-    time_left = timeout
-    if os.name == 'nt':
-        logger.info('Windows OS, enabling RCVALL')
-        # receive all packages in windows
-        sock.ioctl(socket.SIO_RCVALL, socket.RCVALL_ON)
-    while i < n:
-        sock.settimeout(timeout)
-        # Receive Data and send to a thread for processing
-        try:
-            data, addr = server_socket.recvfrom(65535)
-        except socket.timeout:
-            pass
-        else:
-            ip_header = IP(data[0:20])
-            if ip_header.src_address == dst_ip:
-                icmp_header = ICMPv4(data[20:29])
-                if icmp_header.icmp_type == 0 and icmp_header.icmp_code == 0 and icmp_header.id_le == id:
-                    rtt = (datetime.datetime.utcnow() - send_date_list[i])
-                    rtt = rtt.seconds * 1000 + rtt.microseconds / float(1000)
-                    rtt_list.append(rtt)
-                    print "%i bytes from %s: icmp_seq=%i ttl=%i time=%i ms" % (len(data[28:]), ip_header.src_address,
-                                                                            icmp_header.sequence_le, ip_header.ttl,
-                                                                            rtt)
-                    i += 1
-
-        try:
-            time_left -= (datetime.datetime.utcnow() - send_date_list[i]).total_seconds()
-        except:
-            pass
-
-        if time_left < 0:
-            print "*** Ping timeout ***"
-            i += 1
-            pkt_loss += 1
-            time_left = timeout
-
-    if os.name =='nt':
-        # disabled promiscuous mode in windows
-        sock.ioctl(socket.SIO_RCVALL, socket.RCVALL_OFF)
-        logger.info('Windows OS, disabling RCVALL')
-
-    print "**** %s Ping Statistics ****" % dst_ip
-    avg = 0
-    for ms in rtt_list:
-        avg = avg + ms
-    try:
-        avg = avg / float(len(rtt_list))
-    except ZeroDivisionError:
+
+def read_targets(file_name):
+    """ Read the destination ip addresses from a file, one per line """
+    targets = []
+    with open(file_name, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                targets.append(line)
+    return targets
+
+
+def print_statistics(target):
+    print "**** %s Ping Statistics ****" % target.dst_ip
+    print "%i packets transmitted, %i received" % (target.sent, target.sent - target.pkt_loss)
+    if len(target.rtt_list) == 0:
         print "rtt min/avg/max = */*/*"
     else:
-        print "rtt min/avg/max = %0.2f/%0.2f/%0.2f" % (min(rtt_list), avg, max(rtt_list))
+        print "rtt min/avg/max = %0.2f/%0.2f/%0.2f" % (target.rtt_min, target.rtt_avg, target.rtt_max)
+
+
+def ping(dst_ips, count=3, timeout=2, interval=1, size=48, source=None, logger=None):
+    """ Ping the destinations over a new raw socket, returns the list of PingTarget with the results """
+    logger = logger if logger is not None else logging.getLogger('pingv4')
+
+    logger.info("Creating Socket!!!")
+
+    # Create the raw socket
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+
+    try:
+        # Bind the socket
+        if source is not None:
+            server_socket.bind((source, 0))
+            logger.info("Binding socket to %s" % source)
+
+        base_id = random.randint(0, 65535)
 
+        engine = PingEngine(server_socket, base_id, count=count, timeout=timeout, interval=interval,
+                            payload=make_payload(size), logger=logger)
+        for dst_ip in dst_ips:
+            engine.add_target(dst_ip)
+
+        logger.info("Launching ping engine")
+        with CHECK_SECONDS.labels('ping').time():
+            return engine.run()
+    finally:
+        server_socket.close()
+
+
+def ping_rows(targets):
+    """ Rows of the ping_table with the results of the targets """
+    now = datetime.datetime.utcnow()
+    return [(now, 4, t.dst_ip, t.rtt_avg, t.sent, t.pkt_loss) for t in targets]
+
+
+def store_results(targets, logger, db_name):
     logger.info('Creating Database if does not exist')
     p = db.SQLite(db_name)
     logger.info('Creating ping_table if does not exist')
-    p.create_table('ping_table', ('id integer PRIMARY KEY', 'created_at DATETIME', 'version integer', 'dst_ip text',
-                                  'rtt real', 'pkt_sent integer', 'pkt_loss integer'))
-    logger.info('Inserting data in ping_table')
-    p.insert('ping_table', (datetime.datetime.utcnow(), 4, dst_ip, avg, n, pkt_loss))
+    schema.create_table(p, 'ping_table')
+    logger.info('Inserting %i rows in ping_table' % len(targets))
+    p.insert_many('ping_table', ping_rows(targets))
     p.close()
 
 
 if __name__ == "__main__":
-    global send_date_list
-
-    send_date_list = []
 
     # Create the parser for the arguments
     parser = argparse.ArgumentParser()
@@ -143,7 +92,12 @@ if __name__ == "__main__":
                         default=socket.gethostbyname(socket.gethostname()))
     parser.add_argument("-n", dest="number", help="Specify the number of packets", action="store", default=3)
     parser.add_argument("-t", dest="timeout", help="Specify the timeout in seconds", action="store", default=2)
-    parser.add_argument("dst_ip", help="Specify the destination ip address", action="store")
+    parser.add_argument("-i", dest="interval", help="Specify the interval between packets in seconds",
+                        action="store", default=1)
+    parser.add_argument("-l", dest="size", help="Specify the payload size in bytes", action="store", default=48)
+    parser.add_argument("-f", dest="file", help="Specify a file with one destination ip address per line",
+                        action="store")
+    parser.add_argument("dst_ip", help="Specify the destination ip addresses", action="store", nargs="*")
 
     args = parser.parse_args()
 
@@ -176,34 +130,19 @@ if __name__ == "__main__":
         logger.critical('You have to configure the database name on the config file')
         sys.exit(1)
 
-    timeout = int(args.timeout)
-    number_of_pings = int(args.number)
-    src_ip = args.source
-    dst_ip = args.dst_ip
+    dst_ips = list(args.dst_ip)
+    if args.file is not None:
+        dst_ips.extend(read_targets(args.file))
 
-    logger.info("Creating Socket!!!")
-
-    # Create the raw socket
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
-
-    # Bind the socket
-    server_socket.bind((src_ip, 0))
-
-    logger.info("Binding socket to %s" % src_ip)
+    if len(dst_ips) == 0:
+        logger.critical('You have to specify at least one destination ip address')
+        sys.exit(1)
 
-    id = int((id(timeout) * random.random()) % 65535)
+    print "PING %i hosts %i bytes of data:" % (len(dst_ips), int(args.size))
+    targets = ping(dst_ips, count=int(args.number), timeout=int(args.timeout), interval=float(args.interval),
+                   size=int(args.size), source=args.source, logger=logger)
 
-    receive_threads = []
-    r = threading.Thread(name="receiver_thread", target=threaded_receiver,
-                         args=(server_socket, timeout, id, number_of_pings, dst_ip, logger, db_name))
-    receive_threads.append(r)
-    logger.info("Launching Receiver thread")
-    r.start()
+    for target in targets:
+        print_statistics(target)
 
-    send_threads = []
-    s = threading.Thread(name="sender_thread", target=threaded_sender,
-                         args=(server_socket, id, dst_ip, number_of_pings, logger))
-    send_threads.append(s)
-    receive_threads.append(s)
-    logger.info("Launching Sender Thread")
-    s.start()
\ No newline at end of file
+    store_results(targets, logger, db_name)
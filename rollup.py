@@ -0,0 +1,69 @@
+import lib.sqlite as db
+from lib.rollup import Rollup
+import argparse
+import logging
+import yaml
+import sys
+
+LEVEL = {'debug': logging.DEBUG,
+         'info': logging.INFO,
+         'warning': logging.WARNING,
+         'error': logging.ERROR,
+         'critical': logging.CRITICAL}
+
+
+if __name__ == "__main__":
+
+    # Create the parser for the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", help="Turn on verbosity on the output", action="store_true", default=False)
+    parser.add_argument("--no-prune", dest="prune", help="Only aggregate, do not delete the expired rows",
+                        action="store_false", default=True)
+
+    args = parser.parse_args()
+
+    # Load the config.yaml file
+    with open('config.yaml', 'r') as f:
+        config = yaml.load(f)
+
+    # Set the logging level
+    try:
+        log_level = LEVEL[config["log_level"]]
+    except:
+        log_level = logging.INFO
+
+    # Create and format the logger and the handler for logging
+    logger = logging.getLogger('rollup')
+    logger.setLevel(level=log_level)
+    handler = logging.StreamHandler()
+    handler_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                                          datefmt='%m/%d/%Y %I:%M:%S %p')
+    handler.setFormatter(handler_formatter)
+    logger.addHandler(handler)
+
+    # Turn logger on or off depending on the arguments
+    logger.disabled = not args.verbose
+
+    # Set the database name
+    try:
+        db_name = config["db_name"]
+    except:
+        logger.critical('You have to configure the database name on the config file')
+        sys.exit(1)
+
+    rollup_config = config.get("rollup", {})
+
+    logger.info('Opening Database')
+    p = db.SQLite(db_name)
+    r = Rollup(p, batch_size=int(rollup_config.get("batch_size", 10000)), logger=logger)
+
+    logger.info('Aggregating the raw results')
+    for table_name, n in sorted(r.run().items()):
+        print "%i rows of %s aggregated" % (n, table_name)
+
+    if args.prune:
+        logger.info('Pruning the expired rows')
+        for name, n in sorted(r.prune(rollup_config.get("retention", {})).items()):
+            print "%i rows of %s pruned" % (n, name)
+
+    p.close()
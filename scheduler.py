@@ -0,0 +1,273 @@
+import lib.sqlite as db
+import lib.schema as schema
+from lib.scheduler import Scheduler, ShardPool, StoreWriter
+from lib.metrics import REGISTRY, Exporter
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import yaml
+import sys
+
+LEVEL = {'debug': logging.DEBUG,
+         'info': logging.INFO,
+         'warning': logging.WARNING,
+         'error': logging.ERROR,
+         'critical': logging.CRITICAL}
+
+# Table written by every type of check
+CHECK_TABLES = {'ping': 'ping_table', 'tcp': 'tcp_table', 'dns': 'dns_table', 'bgp': 'bgp_table'}
+
+
+def run_ping(dst_ips, options, logger):
+    import pingv4
+    # The targets due together share the raw socket and the engine of a single run
+    targets = pingv4.ping(dst_ips, count=int(options.get('count', 3)), timeout=int(options.get('timeout', 2)),
+                          interval=float(options.get('packet_interval', 1)), size=int(options.get('size', 48)),
+                          source=options.get('source'), logger=logger)
+    return [('ping_table', row) for row in pingv4.ping_rows(targets)]
+
+
+def run_tcp(target, options, logger, idle, context, sessions):
+    import tcp_connect
+    probes = tcp_connect.probe([target], path=options.get('path', '/'), use_ssl=options.get('ssl', False),
+                               ipv6=options.get('ipv6', False), timeout=float(options.get('timeout', 2)),
+                               keepalive=options.get('keepalive', False), idle=idle, context=context,
+                               sessions=sessions, logger=logger)
+    return [('tcp_table', row) for row in tcp_connect.probe_rows(probes)]
+
+
+def run_dns(domain, options, logger, resolver, pool):
+    import dns_check
+    rows = dns_check.check_domains(resolver, [domain], pool, float(options.get('timeout', 5)), logger)
+    # The answer sets are interned by the writer, the dns_table rows only reference them
+    return [('dns_answers', rows)]
+
+
+def run_bgp(autonomous_system, options, logger, client):
+    import bgp_check
+    v4_prefixes, v6_prefixes, query_time = bgp_check.fetch_prefixes(
+        client, autonomous_system, list_prefixes=options.get('list_prefixes', False), logger=logger)
+    # The snapshot is applied to the prefix store by the writer
+    return [('bgp_snapshot', (autonomous_system, v4_prefixes, v6_prefixes, query_time))]
+
+
+def start_metrics(config, name):
+    """ Exporter writing the metrics of this process as name in the metrics directory, None if there is none """
+    metrics_config = config.get('metrics') or {}
+    if not metrics_config.get('dir'):
+        return None
+    return Exporter(REGISTRY, os.path.join(metrics_config['dir'], '%s.json' % name),
+                    interval=float(metrics_config.get('interval', 10))).start()
+
+
+def make_writer(p, types, config, logger):
+    """ Writer of the rows of the checks on p, with the stores of the pseudo tables of the checks keeping state on
+    the database. They run in this process, the only one writing on the database """
+    stores = {}
+
+    if 'dns' in types:
+        from lib.answers import AnswerStore
+        answers = AnswerStore(p)
+        stores['dns_answers'] = lambda rows: [('dns_table', row) for row in answers.encode(rows)]
+
+    # Every process sends its DNS cache when it stops, it replaces the answers saved of the same lookups
+    if 'dns' in types and (config.get('dns') or {}).get('persist_cache', True):
+        from lib.resolver import replace_rows
+
+        def save_cache(rows):
+            replace_rows(p, rows)
+            p.commit()
+            return []
+        stores['dns_cache'] = save_cache
+
+    # The prefixes of the bgp snapshots are compared with the ones of the previous snapshot
+    if 'bgp' in types:
+        import bgp_check
+        from lib.bgp import PrefixStore
+        prefixes = PrefixStore(p)
+
+        def save_snapshot(snapshot):
+            autonomous_system, v4_prefixes, v6_prefixes, query_time = snapshot
+            return [('bgp_table', bgp_check.store_snapshot(prefixes, autonomous_system, v4_prefixes, v6_prefixes,
+                                                          query_time, logger))]
+        stores['bgp_snapshot'] = save_snapshot
+
+    return StoreWriter(p, stores)
+
+
+def run_shard(config, items, writer, stopped, logger, cache_rows):
+    """ Run the checks of a worker process of the ShardPool, with its own metrics """
+    # Forked from the scheduler process, whose exporter thread may have held a lock of the registry
+    REGISTRY.reset()
+    exporter = start_metrics(config, 'scheduler-%s' % multiprocessing.current_process().name)
+    try:
+        run_checks(config, items, writer, stopped, logger, cache_rows)
+    finally:
+        if exporter is not None:
+            exporter.stop()
+
+
+def iter_targets(checks):
+    """ Generator of (type, target, interval, options) of the checks of the configuration, a target is a string or a
+    dict with the target and the options overriding the ones of its check """
+    for check in checks:
+        options = dict((k, v) for k, v in check.items() if k != 'targets')
+        for target in check.get('targets', []):
+            target_options = dict(options)
+            if isinstance(target, dict):
+                target_options.update(target)
+                target = target_options.pop('target')
+            yield target_options.pop('type'), str(target), float(target_options.pop('interval')), target_options
+
+
+def run_checks(config, targets, writer, stopped, logger, cache_rows=()):
+    """ Schedule the checks of the targets and run them until stopped is set, their rows are written on writer. The
+    dns checks start with the answers of the cache_rows """
+    scheduler_config = config.get("scheduler") or {}
+    scheduler = Scheduler(workers=int(scheduler_config.get("workers", 8)),
+                          jitter=float(scheduler_config.get("jitter", 0.1)),
+                          batch_window=float(scheduler_config.get("batch_window", 1)), logger=logger,
+                          stopped=stopped)
+    types = set(t[0] for t in targets)
+
+    # The dns checks share the resolution cache and a pool for their queries
+    if 'dns' in types:
+        from multiprocessing.pool import ThreadPool
+        from lib.resolver import CachingResolver
+        import dns.resolver
+        dns_config = config.get('dns') or {}
+        resolver = CachingResolver(dns.resolver.Resolver(), max_size=dns_config.get('cache_size', 10000))
+        dns_pool = ThreadPool(int(dns_config.get('workers', 20)))
+        logger.info('Loaded %i cached answers' % resolver.add_rows(cache_rows))
+
+    # The tcp checks share their keep-alive connections, TLS context and sessions
+    if 'tcp' in types:
+        from lib.http_probe import IdleConnections, make_context
+        from lib.cache import TTLCache
+        idle = IdleConnections()
+        context = make_context()
+        sessions = TTLCache(max_size=10000, ttl=300)
+
+    # The bgp checks share the RIPE client, its connections and its cache
+    if 'bgp' in types:
+        import bgp_check
+        client = bgp_check.make_client(config, logger=logger)
+
+    for check_type, target, interval, options in targets:
+        if check_type == 'ping':
+            scheduler.add_batch('ping %s' % target, interval, run_ping, target, options, logger)
+        elif check_type == 'dns':
+            scheduler.add('dns %s' % target, interval, run_dns, target, options, logger, resolver, dns_pool)
+        elif check_type == 'tcp':
+            scheduler.add('tcp %s' % target, interval, run_tcp, target, options, logger, idle, context, sessions)
+        elif check_type == 'bgp':
+            scheduler.add('bgp %s' % target, interval, run_bgp, target, options, logger, client)
+
+    try:
+        scheduler.run(writer)
+    finally:
+        if 'tcp' in types:
+            idle.close()
+        if 'bgp' in types:
+            client.close()
+        if 'dns' in types:
+            dns_pool.close()
+            if dns_config.get('persist_cache', True):
+                rows = resolver.rows()
+                writer.buffered_insert('dns_cache', rows)
+                logger.info('Saved %i cached answers' % len(rows))
+
+
+if __name__ == "__main__":
+
+    # Create the parser for the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", help="Turn on verbosity on the output", action="store_true", default=False)
+    parser.add_argument("-p", dest="processes", help="Specify the number of worker processes sharing the targets, "
+                        "0 runs the checks in this process", action="store")
+
+    args = parser.parse_args()
+
+    # Load the config.yaml file
+    with open('config.yaml', 'r') as f:
+        config = yaml.load(f)
+
+    # Set the logging level
+    try:
+        log_level = LEVEL[config["log_level"]]
+    except:
+        log_level = logging.INFO
+
+    # Create and format the logger and the handler for logging
+    logger = logging.getLogger('scheduler')
+    logger.setLevel(level=log_level)
+    handler = logging.StreamHandler()
+    handler_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                                          datefmt='%m/%d/%Y %I:%M:%S %p')
+    handler.setFormatter(handler_formatter)
+    logger.addHandler(handler)
+
+    # Turn logger on or off depending on the arguments
+    logger.disabled = not args.verbose
+
+    # Set the database name
+    try:
+        db_name = config["db_name"]
+    except:
+        logger.critical('You have to configure the database name on the config file')
+        sys.exit(1)
+
+    scheduler_config = config.get("scheduler") or {}
+    targets = list(iter_targets(scheduler_config.get("checks", [])))
+    if len(targets) == 0:
+        logger.critical('You have to configure at least one check on the config file')
+        sys.exit(1)
+    types = set(t[0] for t in targets)
+    for check_type in types - set(CHECK_TABLES):
+        logger.critical('Unknown check type %s' % check_type)
+        sys.exit(1)
+
+    logger.info('Creating Database if does not exist')
+    p = db.SQLite(db_name, flush_interval=float(scheduler_config.get("flush_interval", 1)),
+                  flush_retries=int(scheduler_config.get("flush_retries", 60)))
+    for check_type in types:
+        schema.create_table(p, CHECK_TABLES[check_type])
+
+    # The cached DNS answers are read once and handed to every process
+    cache_rows = []
+    if 'dns' in types and (config.get('dns') or {}).get('persist_cache', True):
+        from lib.resolver import read_rows
+        schema.create_table(p, 'dns_cache_table')
+        p.query('''DELETE FROM dns_cache_table WHERE expiration <= ?''', (time.time(),))
+        p.commit()
+        cache_rows = read_rows(p, time.time())
+
+    writer = make_writer(p, types, config, logger)
+
+    processes = int(args.processes if args.processes is not None else scheduler_config.get("processes", 0))
+    stopped = multiprocessing.Event()
+
+    # Stop cleanly on SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+
+    exporter = start_metrics(config, 'scheduler')
+
+    try:
+        if processes > 0:
+            print "Scheduling %i checks on %i processes" % (len(targets), processes)
+            pool = ShardPool(lambda items, writer, stopped: run_shard(config, items, writer, stopped, logger,
+                                                                      cache_rows),
+                             targets, processes=processes, logger=logger, stopped=stopped)
+            pool.run(writer, flush_interval=p.flush_interval)
+        else:
+            print "Scheduling %i checks" % len(targets)
+            run_checks(config, targets, writer, stopped, logger, cache_rows)
+    except KeyboardInterrupt:
+        logger.info('Interrupted, stopping')
+    finally:
+        p.close()
+        if exporter is not None:
+            exporter.stop()
@@ -1,18 +1,62 @@
 import socket
 import argparse
 import lib.sqlite as db
+import lib.schema as schema
+from lib.http_probe import Probe, ProbeEngine
+from lib.metrics import REGISTRY, CHECK_SECONDS
 import logging
 import sys
-import ssl
 import yaml
 import datetime
 
+PROBES = REGISTRY.counter('monitor_http_probes_total', 'HTTP probes by result, ok when a status line was read',
+                          ('result', 'reused'))
+
 LEVEL = {'debug': logging.DEBUG,
          'info': logging.INFO,
          'warning': logging.WARNING,
          'error': logging.ERROR,
          'critical': logging.CRITICAL}
 
+def parse_target(target, port=80, path='/'):
+    """ Host, port and path of a host[:port][/path] target, an ipv6 address with a port goes between brackets """
+    if '/' in target:
+        target, path = target.split('/', 1)
+        path = '/' + path
+    if target.startswith('['):
+        host, _, rest = target[1:].partition(']')
+        if rest.startswith(':'):
+            port = int(rest[1:])
+    elif target.count(':') == 1:
+        host, port = target.split(':')
+        port = int(port)
+    else:
+        host = target
+    return host, port, path
+
+
+def probe(targets, port=80, path='/', use_ssl=False, ipv6=False, timeout=2, keepalive=False, idle=None,
+          context=None, sessions=None, logger=None):
+    """ Probe the targets concurrently, returns the list of Probe with the results """
+    engine = ProbeEngine(timeout=timeout, keepalive=keepalive, idle=idle, context=context, sessions=sessions,
+                         logger=logger)
+    for target in targets:
+        host, target_port, target_path = parse_target(target, port, path)
+        engine.add(Probe(host, target_port, target_path, use_ssl=use_ssl, ipv6=ipv6))
+    with CHECK_SECONDS.labels('tcp').time():
+        probes = engine.run()
+    for p in probes:
+        PROBES.labels('ok' if p.response_code else 'error', 'yes' if p.reused else 'no').inc()
+    return probes
+
+
+def probe_rows(probes):
+    """ Rows of the tcp_table with the results of the probes """
+    now = datetime.datetime.utcnow()
+    return [(now, 6 if p.ipv6 else 4, p.url, p.response_code, p.connect_ms, p.tls_ms, p.first_byte_ms,
+             p.handshake_ms, p.tls_resumed, p.connect_start_ms, p.request_sent_ms, p.last_byte_ms) for p in probes]
+
+
 if __name__ == "__main__":
 
     # Create the parser for the arguments
@@ -23,9 +67,12 @@ if __name__ == "__main__":
                         default=socket.gethostbyname(socket.gethostname()))
     parser.add_argument("-t", dest="timeout", help="Specify the timeout in seconds", action="store", default=2)
     parser.add_argument("-6", dest="ipv6", help="Use ipv6", action="store_true", default=False)
-    parser.add_argument("-p", dest="port", help="Specify port", action="store", default=80)
-    parser.add_argument("--path", help="Specify path", action="store", default='/')
-    parser.add_argument("dst_ip", help="Specify the timeout in seconds", action="store")
+    parser.add_argument("-p", dest="port", help="Specify the port of the targets without one", action="store",
+                        default=80)
+    parser.add_argument("--path", help="Specify the path of the targets without one", action="store", default='/')
+    parser.add_argument("--keepalive", help="Read the whole responses and reuse the connections to the same host",
+                        action="store_true", default=False)
+    parser.add_argument("dst_ip", help="Specify the targets as host[:port][/path]", action="store", nargs="+")
 
     args = parser.parse_args()
 
@@ -58,87 +105,21 @@ if __name__ == "__main__":
         logger.critical('You have to configure the database name on the config file')
         sys.exit(1)
 
-    timeout = int(args.timeout)
-    src_ip = args.source
-    dst_ip = args.dst_ip
-    port = int(args.port)
+    probes = probe(args.dst_ip, port=int(args.port), path=args.path, use_ssl=args.ssl, ipv6=args.ipv6,
+                   timeout=float(args.timeout), keepalive=args.keepalive, logger=logger)
 
-    logger.info("Creating Socket!!!")
-
-    # Create the raw socket
-    if args.ipv6:
-        server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-    else:
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-    if args.ssl:
-        logger.info("Using SSL!!!")
-        wrapped_socket = ssl.wrap_socket(server_socket, ssl_version=ssl.PROTOCOL_SSLv23)
-
-    try:
-        logger.info("Connecting to %s:%i" %(dst_ip, port))
-        # Connecting to dst host
-        if args.ssl:
-            wrapped_socket.connect((dst_ip, port))
-        else:
-            server_socket.connect((dst_ip, port))
-    except Exception as e:
-        logger.critical(e)
-        logger.info('Creating Database if does not exist')
-        p = db.SQLite(db_name)
-        logger.info('Creating tcp_table if does not exist')
-        p.create_table('tcp_table', ('id integer PRIMARY KEY', 'created_at DATETIME', 'version integer', 'url text',
-                                      'response_code integer'))
-        logger.info('Inserting data in tcp_table')
-        p.insert('tcp_table', (datetime.datetime.utcnow(), 6 if args.ipv6 else 4, dst_ip + ':' + str(port), 0))
-        p.close()
-        sys.exit(1)
-
-    logger.info("Sending data to retrieve the webpage")
-    if args.ssl:
-        wrapped_socket.send('GET %s HTTP/1.1\nHost: %s\r\n'
-                            'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:59.0) Gecko/20100101 Firefox/59.0\n\n'
-                            % (args.path, dst_ip))
-    else:
-        server_socket.send('GET %s HTTP/1.1\nHost: %s\r\n'
-                            'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:59.0) Gecko/20100101 Firefox/59.0\n\n'
-                            % (args.path, dst_ip))
-
-    data = ''
-    server_socket.settimeout(timeout)
-    logger.info("Waiting for data")
-    while True:
-        if args.ssl:
-            try:
-                d = wrapped_socket.recv(1024)
-            except Exception as e:
-                logger.info(e)
-                server_socket.close()
-                break
-        else:
-            try:
-                d = server_socket.recv(1024)
-            except socket.timeout:
-                logger.info("Receive timeout")
-                server_socket.close()
-                break
-        logger.info("Received 1024 bytes")
-        if not d:
-            logger.info("Received nothing")
-            server_socket.close()
-            break
-        data += d
-
-    logger.info("Closing Socket")
-    server_socket.close()
-
-    print "Response code: %s" % data[9:12]
+    for result in probes:
+        print "%s%s response code: %s" % (result.url, result.path, result.response_code)
+        if result.first_byte_ms is not None:
+            print "  resolve %s connect %s tls %s sent %s first byte %s last byte %s ms" % tuple(
+                '-' if t is None else '%0.2f' % t for t in (result.connect_start_ms, result.connect_ms,
+                                                            result.tls_ms, result.request_sent_ms,
+                                                            result.first_byte_ms, result.last_byte_ms))
 
     logger.info('Creating Database if does not exist')
     p = db.SQLite(db_name)
     logger.info('Creating tcp_table if does not exist')
-    p.create_table('tcp_table', ('id integer PRIMARY KEY', 'created_at DATETIME', 'version integer', 'url text',
-                                  'response_code integer'))
-    logger.info('Inserting data in tcp_table')
-    p.insert('tcp_table', (datetime.datetime.utcnow(), 6 if args.ipv6 else 4, dst_ip + ':' + str(port), int(data[9:12])))
-    p.close()
\ No newline at end of file
+    schema.create_table(p, 'tcp_table')
+    logger.info('Inserting %i rows in tcp_table' % len(probes))
+    p.insert_many('tcp_table', probe_rows(probes))
+    p.close()
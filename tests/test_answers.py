@@ -0,0 +1,71 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import lib.sqlite as db
+from lib.answers import AnswerStore
+
+
+def dns_row(mx_v4=(), ns_v4=(), domain='example.org'):
+    return (datetime.datetime(2020, 1, 1), list(mx_v4), [], list(ns_v4), [], 'soa', 'a', 'aaaa', 'dnskey', domain)
+
+
+class AnswerStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='answers')
+        self.db = db.SQLite(os.path.join(self.workdir, 'test.db'))
+        self.store = AnswerStore(self.db)
+
+    def tearDown(self):
+        self.db.conn.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def count(self, table_name):
+        return self.db.query('''SELECT count(*) FROM {tbl}'''.format(tbl=table_name))[0][0]
+
+    def test_same_servers_share_a_set(self):
+        servers = [('ns1.example.org', '10.0.0.1'), ('ns2.example.org', '10.0.0.2')]
+        first, = self.store.encode([dns_row(ns_v4=servers)])
+        second, = self.store.encode([dns_row(ns_v4=reversed(servers), domain='example.com')])
+
+        self.assertEqual(first[-2], second[-2])
+        self.assertEqual(self.store.servers(first[-2]), servers)
+        # The empty lists of the other fields are a single set too
+        self.assertEqual(first[-1], first[-3])
+        self.assertEqual(self.count('dns_set_table'), 2)
+        self.assertEqual(self.count('dns_set_member_table'), 2)
+
+    def test_failed_encode_is_rolled_back(self):
+        servers = [('ns1.example.org', '10.0.0.1')]
+        encoded, = self.store.encode([dns_row(ns_v4=servers)])
+
+        # The address can not be bound, the set and the host name of the row are written before the failure
+        with self.assertRaises(Exception):
+            self.store.encode([dns_row(ns_v4=servers, mx_v4=[('mx.example.org', ('10.0.0.3',))])])
+        self.assertEqual(self.count('dns_set_table'), 2)
+        self.assertEqual(self.count('dns_name_table'), 1)
+        self.assertEqual(self.store.sets, {})
+
+        # The ids cached before the failure are resolved again and still point to committed rows
+        retried, = self.store.encode([dns_row(ns_v4=servers, mx_v4=[('mx.example.org', '10.0.0.3')])])
+        self.assertEqual(retried[-2], encoded[-2])
+        self.assertEqual(self.store.servers(retried[-4]), [('mx.example.org', '10.0.0.3')])
+        self.assertEqual(self.count('dns_set_member_table'), 2)
+
+    def test_changes(self):
+        self.store.encode([dns_row(ns_v4=[('ns1.example.org', '10.0.0.1')])])
+        self.store.encode([dns_row(ns_v4=[('ns1.example.org', '10.0.0.1')])])
+        last, = self.store.encode([dns_row(ns_v4=[('ns1.example.org', '10.0.0.2')])])
+        rows = self.store.encode([dns_row(ns_v4=[('ns1.example.org', '10.0.0.1')])])
+        self.db.insert_many('dns_table', rows + [last])
+
+        changes = self.store.changes('ns_v4_set', 'example.org')
+        self.assertEqual([(previous, current) for _, _, previous, current in changes],
+                         [(rows[0][-2], last[-2])])
+        self.assertRaises(ValueError, self.store.changes, 'soa_record')
+
+
+if __name__ == "__main__":
+    unittest.main()
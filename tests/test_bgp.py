@@ -0,0 +1,38 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import lib.sqlite as db
+from lib.bgp import PrefixStore
+from lib.trie import PrefixTrie
+
+
+class PrefixStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='bgp')
+        self.db = db.SQLite(os.path.join(self.workdir, 'test.db'))
+        self.store = PrefixStore(self.db)
+
+    def tearDown(self):
+        self.db.conn.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def snapshot(self, day, v4, v6=()):
+        return self.store.update('AS1', v4, v6, datetime.datetime(2020, 1, day))
+
+    def test_update(self):
+        self.assertEqual(self.snapshot(1, ['10.0.0.0/8', '10.1.0.0/16'], ['2001:db8::/32']),
+                         (['10.0.0.0/8', '10.1.0.0/16', '2001:db8::/32'], []))
+        self.assertEqual(self.snapshot(2, ['10.0.0.0/8'], ['2001:db8::/32']), ([], ['10.1.0.0/16']))
+        self.assertEqual(self.snapshot(3, ['10.0.0.0/8', '10.1.0.0/16'], ['2001:db8::/32']), (['10.1.0.0/16'], []))
+
+        # Announced again, the prefix gets a second row
+        self.assertEqual(len(self.store.history('10.1.0.0/16')), 2)
+        self.assertEqual(sorted(self.store.announced('AS1')), ['10.0.0.0/8', '10.1.0.0/16', '2001:db8::/32'])
+        self.assertEqual(PrefixTrie.from_db(self.db, 'AS1').longest_match('10.1.2.3')[0], '10.1.0.0/16')
+
+
+if __name__ == "__main__":
+    unittest.main()
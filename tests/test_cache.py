@@ -0,0 +1,35 @@
+import unittest
+from lib.cache import TTLCache
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = TTLCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def test_expiration(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=20)
+        self.cache.set('c', 3, ttl=0)
+        self.assertNotIn('c', self.cache)
+        self.assertEqual(self.cache.ttl_left('a'), 10)
+
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+        self.assertEqual(self.cache.ttl_left('b'), 10)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertEqual([key for key, _, _ in self.cache.items()], ['a', 'c'])
+        self.assertEqual(self.cache.evictions, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from lib.metrics import Registry, render
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.rows = self.registry.counter('rows_total', "Rows written", ('table',))
+        self.seconds = self.registry.histogram('write_seconds', "Write time", buckets=(0.1, 1))
+
+    def test_render(self):
+        self.rows.labels('ping_table').inc(2)
+        self.seconds.observe(0.5)
+        self.seconds.observe(5)
+
+        lines = render([('worker-1', self.registry.snapshot())]).splitlines()
+        self.assertIn('# TYPE rows_total counter', lines)
+        self.assertIn('rows_total{process="worker-1",table="ping_table"} 2', lines)
+        self.assertIn('write_seconds_bucket{process="worker-1",le="0.1"} 0', lines)
+        self.assertIn('write_seconds_bucket{process="worker-1",le="1.0"} 1', lines)
+        self.assertIn('write_seconds_bucket{process="worker-1",le="+Inf"} 2', lines)
+        self.assertIn('write_seconds_sum{process="worker-1"} 5.5', lines)
+        self.assertIn('write_seconds_count{process="worker-1"} 2', lines)
+
+    def test_declare(self):
+        self.assertIs(self.registry.counter('rows_total', "Rows written", ('table',)), self.rows)
+        self.assertRaises(ValueError, self.registry.gauge, 'rows_total', "Rows written", ('table',))
+
+    def test_reset(self):
+        self.rows.labels('ping_table').inc()
+        self.seconds.observe(0.5)
+        self.registry.reset()
+
+        # The metrics declared before the reset keep working
+        self.rows.labels('ping_table').inc()
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot['rows_total']['samples'], [[['ping_table'], 1]])
+        self.assertEqual(snapshot['write_seconds']['samples'][0][1], [[0, 0, 0], 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import lib.sqlite as db
+import lib.schema as schema
+from lib.ring import RingBuffer, HotWindow
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_latest(self):
+        ring = RingBuffer(3)
+        for i in range(5):
+            ring.append(i)
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.latest(), [4, 3, 2])
+        self.assertEqual(ring.latest(2, 1), [3, 2])
+        self.assertEqual(ring.latest(5, 3), [])
+        self.assertEqual(ring.get(0), 4)
+        self.assertRaises(IndexError, ring.get, 3)
+
+    def test_capacity(self):
+        self.assertRaises(ValueError, RingBuffer, 0)
+        self.assertRaises(TypeError, RingBuffer, 1.5)
+
+
+class HotWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='ring')
+        self.db = db.SQLite(os.path.join(self.workdir, 'test.db'))
+        schema.create_table(self.db, 'ping_table')
+        self.now = 0
+        self.insert(3)
+
+    def tearDown(self):
+        self.db.conn.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def clock(self):
+        return self.now
+
+    def insert(self, n):
+        for i in range(n):
+            self.db.insert('ping_table', (datetime.datetime(2020, 1, 1), 4, '10.0.0.1', float(i), 3, 0))
+
+    def ids(self, rows):
+        return [row[0] for row in rows]
+
+    def test_refresh(self):
+        window = HotWindow(self.db, 'ping_table', capacity=5, refresh_interval=1, clock=self.clock)
+        self.assertEqual(self.ids(window.rows(2)), [3, 2])
+
+        self.insert(1)
+        self.assertFalse(window.stale)
+        self.now = 1
+        self.assertTrue(window.stale)
+        self.assertEqual(window.refresh(self.db), 1)
+        self.assertFalse(window.stale)
+        self.assertEqual(self.ids(window.rows(3, after_id=4)), [3, 2, 1])
+        # Every row of the table is in the window, asking for more is not a miss
+        self.assertEqual(self.ids(window.rows(10)), [4, 3, 2, 1])
+
+    def test_incomplete_window(self):
+        window = HotWindow(self.db, 'ping_table', capacity=2, clock=self.clock)
+        self.assertEqual(self.ids(window.rows(2)), [3, 2])
+        self.assertIsNone(window.rows(3))
+        self.assertIsNone(window.rows(1, after_id=2))
+
+    def test_reload_after_delete(self):
+        window = HotWindow(self.db, 'ping_table', capacity=5, clock=self.clock)
+        self.db.query('''DELETE FROM ping_table''')
+        self.db.commit()
+        self.insert(1)
+
+        # SQLite hands out the id 1 again, the window drops the deleted rows instead of skipping the new one
+        window.refresh(self.db)
+        self.assertEqual(self.ids(window.rows(5)), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import lib.sqlite as db
+from lib.rollup import Rollup
+
+
+class PruneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='rollup')
+        self.db = db.SQLite(os.path.join(self.workdir, 'test.db'))
+        self.rollup = Rollup(self.db)
+        self.old = datetime.datetime(2020, 1, 1)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def insert(self, created_at, n):
+        self.db.insert_many('ping_table', [(created_at, 4, '10.0.0.1', 1.0, 3, 0)] * n)
+
+    def samples(self):
+        return self.db.query('''SELECT sum(samples) FROM ping_rollup_table WHERE resolution = ?''', ('minute',))[0][0]
+
+    def test_prune_all_then_insert(self):
+        self.insert(self.old, 5)
+        self.rollup.run()
+        self.rollup.prune({'raw': 1}, now=self.old + datetime.timedelta(days=2))
+
+        # The last row is kept so the ids of the new rows are not reused
+        self.assertEqual(self.db.query('''SELECT count(*) FROM ping_table''')[0][0], 1)
+
+        self.insert(self.old + datetime.timedelta(days=2), 3)
+        self.rollup.run()
+        self.assertEqual(self.samples(), 8)
+
+        # The new rows are aggregated and too recent, prune deletes only the old ones
+        self.rollup.prune({'raw': 1}, now=self.old + datetime.timedelta(days=2))
+        self.assertEqual(self.db.query('''SELECT count(*) FROM ping_table''')[0][0], 3)
+
+    def test_prune_keeps_rows_not_aggregated(self):
+        self.insert(self.old, 5)
+        self.rollup.run()
+        self.insert(self.old, 2)
+        self.rollup.prune({'raw': 1}, now=self.old + datetime.timedelta(days=2))
+        self.assertEqual(self.db.query('''SELECT count(*) FROM ping_table''')[0][0], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import lib.sqlite as db
+import lib.schema as schema
+
+
+def ping_row():
+    return (datetime.datetime(2020, 1, 1), 4, '10.0.0.1', 1.0, 3, 0)
+
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='sqlite')
+        self.pool = db.SQLitePool(os.path.join(self.workdir, 'test.db'), size=2, timeout=0.1,
+                                  setup=lambda d: schema.create_table(d, 'ping_table'))
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_connections_are_reused(self):
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            self.assertIs(first, second)
+            # The connections opened later know the tables created by setup
+            self.assertIn('ping_table', second.tables)
+
+    def test_timeout_when_every_connection_is_busy(self):
+        with self.pool.connection():
+            with self.pool.connection():
+                with self.assertRaises(db.PoolTimeout):
+                    with self.pool.connection():
+                        pass
+        with self.pool.connection():
+            pass
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.pool.connection() as d:
+                d.query('''INSERT INTO ping_table(created_at, version, dst_ip, rtt, pkt_sent, pkt_loss)
+                           VALUES(?, ?, ?, ?, ?, ?)''', ping_row())
+                raise RuntimeError("failed")
+        with self.pool.connection() as d:
+            self.assertEqual(d.query('''SELECT count(*) FROM ping_table''')[0][0], 0)
+
+
+class BufferedInsertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='sqlite')
+        self.db_name = os.path.join(self.workdir, 'test.db')
+        self.db = db.SQLite(self.db_name, flush_interval=100, flush_retries=2)
+        schema.create_table(self.db, 'ping_table')
+        self.db.commit()
+        self.db.conn.execute('PRAGMA busy_timeout=10')
+
+    def tearDown(self):
+        self.db.conn.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def count(self):
+        return self.db.query('''SELECT count(*) FROM ping_table''')[0][0]
+
+    def lock(self):
+        other = sqlite3.connect(self.db_name)
+        other.execute('BEGIN IMMEDIATE')
+        return other
+
+    def test_rows_kept_while_locked(self):
+        other = self.lock()
+        self.db.buffered_insert('ping_table', ping_row())
+        self.assertRaises(sqlite3.OperationalError, self.db.flush)
+        self.assertEqual(self.db.buffered, 1)
+
+        other.rollback()
+        self.db.flush()
+        self.assertEqual(self.db.buffered, 0)
+        self.assertEqual(self.count(), 1)
+
+    def test_rows_dropped_after_the_retries(self):
+        other = self.lock()
+        self.db.buffered_insert('ping_table', ping_row())
+        for i in range(2):
+            self.assertRaises(sqlite3.OperationalError, self.db.flush)
+        self.assertRaises(db.RowsDropped, self.db.flush)
+        self.assertEqual(self.db.buffered, 0)
+        other.rollback()
+
+    def test_rows_that_can_not_be_written_are_dropped(self):
+        self.db.buffered_insert('ping_table', ping_row())
+        self.db.buffered_insert('ping_table', (1, 2))
+        self.assertRaises(db.RowsDropped, self.db.flush)
+
+        # The next rows are not blocked by them
+        self.db.buffered_insert('ping_table', ping_row())
+        self.db.flush()
+        self.assertEqual(self.count(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
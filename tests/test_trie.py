@@ -0,0 +1,35 @@
+import unittest
+from lib.trie import PrefixTrie, parse_prefix
+
+
+class PrefixTrieTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = PrefixTrie()
+        self.trie.insert('0.0.0.0/0', 'AS9')
+        self.trie.insert('10.0.0.0/8', 'AS1')
+        self.trie.insert('10.1.0.0/16', 'AS2')
+        self.trie.insert('10.1.0.0/16', 'AS3')
+        self.trie.insert('2001:db8::/32', 'AS4')
+
+    def test_covering(self):
+        self.assertEqual(len(self.trie), 4)
+        self.assertEqual(self.trie.covering('10.1.2.3'), [('0.0.0.0/0', set(['AS9'])), ('10.0.0.0/8', set(['AS1'])),
+                                                          ('10.1.0.0/16', set(['AS2', 'AS3']))])
+
+    def test_longest_match(self):
+        self.assertEqual(self.trie.longest_match('10.2.0.0/16'), ('10.0.0.0/8', set(['AS1'])))
+        self.assertEqual(self.trie.longest_match('10.1.2.3', 'AS1'), ('10.0.0.0/8', set(['AS1'])))
+        self.assertEqual(self.trie.longest_match('2001:db8:1::1')[0], '2001:db8::/32')
+        self.assertIsNone(self.trie.longest_match('2001:db9::1'))
+        # A prefix is not covered by a more specific one
+        self.assertEqual(self.trie.longest_match('10.0.0.0/7'), ('0.0.0.0/0', set(['AS9'])))
+
+    def test_parse_prefix(self):
+        self.assertEqual(parse_prefix('10.1.2.3/16'), (4, 0x0a010000, 16))
+        for prefix in ('10.0.0.0/33', '10.0.0/8', '10.0.0.0/x'):
+            self.assertRaises(ValueError, parse_prefix, prefix)
+
+
+if __name__ == "__main__":
+    unittest.main()